@@ -0,0 +1,110 @@
+"""
+Offline simulation of adaptive bitrate over a lossy channel
+
+Replays a channel trace through AimdBitrateController, with the same 500 ms update interval as the client's
+stats requests, and compares it against fixed bitrates.
+
+A trace is a json list of segments, each with a duration in seconds, a capacity in bits per second and a
+random loss rate that happens regardless of bitrate (interference), for example:
+[{"duration": 10, "capacity": 3000000, "loss": 0.0}, {"duration": 5, "capacity": 400000, "loss": 0.05}]
+
+Packets that do not fit through the channel are queued (which raises the round trip time), and dropped once
+the queue is full.
+
+usage: python3 bench/abr_simulation.py [--trace TRACE_JSON] [--floor BPS] [--ceiling BPS] [--fixed BPS ...]
+"""
+import os
+import sys
+import json
+import random
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rpividctrl_lib.abr import AimdBitrateController  # noqa: E402
+
+UPDATE_INTERVAL = 0.5  # seconds, same as the client's stats requests
+PACKET_SIZE = 1400  # bytes
+BASE_RTT = 0.005  # seconds
+QUEUE_LIMIT = 64 * 1024  # bytes queued in the access point before packets are dropped
+
+# field wi-fi: fine, then other robots start streaming, then a short dropout, then interference
+DEFAULT_TRACE = [
+    {'duration': 20, 'capacity': 4000000, 'loss': 0.0},
+    {'duration': 20, 'capacity': 900000, 'loss': 0.01},
+    {'duration': 3, 'capacity': 100000, 'loss': 0.3},
+    {'duration': 20, 'capacity': 2500000, 'loss': 0.04},
+    {'duration': 20, 'capacity': 4000000, 'loss': 0.0},
+]
+
+
+def simulate(trace, choose_bitrate, seed=1874):
+    """
+    :param trace: list of segments, see module docstring
+    :param choose_bitrate: called with (loss_rate, rtt, actual_bitrate, time) after each interval, returns the next bitrate
+    :return: list of (time, bitrate, capacity, loss_rate, rtt) for each interval
+    """
+    rand = random.Random(seed)
+    queue_bytes = 0
+    bitrate = choose_bitrate(0, BASE_RTT, None, 0)
+    results = []
+    time = 0
+    for segment in trace:
+        capacity = segment['capacity']
+        segment_end = time + segment['duration']
+        while time < segment_end:
+            sent_bytes = bitrate * UPDATE_INTERVAL / 8
+            num_packets = max(int(sent_bytes / PACKET_SIZE), 1)
+
+            # channel queue: whatever exceeds capacity waits, and is dropped once the queue is full
+            queue_bytes += sent_bytes - capacity * UPDATE_INTERVAL / 8
+            overflow_bytes = max(queue_bytes - QUEUE_LIMIT, 0)
+            queue_bytes = min(max(queue_bytes, 0), QUEUE_LIMIT)
+            overflow_packets = min(int(overflow_bytes / PACKET_SIZE), num_packets)
+
+            random_lost = sum(1 for i in range(num_packets - overflow_packets) if rand.random() < segment['loss'])
+            loss_rate = (overflow_packets + random_lost) / num_packets
+            rtt = BASE_RTT + queue_bytes * 8 / capacity
+
+            results.append((time, bitrate, capacity, loss_rate, rtt))
+            time += UPDATE_INTERVAL
+            bitrate = choose_bitrate(loss_rate, rtt, bitrate, time)
+    return results
+
+
+def summarize(name, results):
+    delivered = sum(bitrate * (1 - loss_rate) for time, bitrate, capacity, loss_rate, rtt in results) / len(results)
+    mean_loss = sum(loss_rate for time, bitrate, capacity, loss_rate, rtt in results) / len(results)
+    lossy_intervals = sum(1 for time, bitrate, capacity, loss_rate, rtt in results if loss_rate > 0.05) / len(results)
+    mean_rtt = sum(rtt for time, bitrate, capacity, loss_rate, rtt in results) / len(results)
+    print(f'{name:>16}: {delivered / 1e3:7.0f} kbps delivered, {mean_loss * 100:5.1f}% loss, '
+          f'{lossy_intervals * 100:5.1f}% of time above 5% loss, {mean_rtt * 1e3:6.1f} ms mean rtt')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--trace', help='path to json channel trace (default: built in field wi-fi trace)')
+    parser.add_argument('--floor', type=int, default=150000)
+    parser.add_argument('--ceiling', type=int, default=2000000)
+    parser.add_argument('--fixed', type=int, nargs='*', default=[500000, 1000000, 2000000], help='fixed bitrates to compare against')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every interval of the adaptive run')
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace) as trace_file:
+            trace = json.load(trace_file)
+    else:
+        trace = DEFAULT_TRACE
+
+    controller = AimdBitrateController(args.floor, args.ceiling, initial=1000000)
+    abr_results = simulate(trace, lambda loss_rate, rtt, actual_bitrate, time: controller.update(loss_rate, rtt, actual_bitrate, time))
+    if args.verbose:
+        for time, bitrate, capacity, loss_rate, rtt in abr_results:
+            print(f'{time:6.1f} s  {bitrate / 1e3:6.0f} kbps  capacity {capacity / 1e3:6.0f} kbps  loss {loss_rate * 100:5.1f}%  rtt {rtt * 1e3:6.1f} ms')
+
+    summarize('adaptive', abr_results)
+    for fixed_bitrate in args.fixed:
+        summarize(f'fixed {fixed_bitrate / 1e3:.0f}k', simulate(trace, lambda loss_rate, rtt, actual_bitrate, time: fixed_bitrate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Round trip time of control commands with the asyncio client (rpividctrl_lib.aio)
+
+Sends TIME_SYNC_REQUEST (answered right away by the server) and STATS_REQUEST, one at a time, and reports how long
+each took to come back. With no --host, answers them itself over loopback, from a thread with a blocking socket, so
+this needs neither GStreamer nor GLib. A blocking socket client runs the same exchange first, as the floor.
+
+usage: python3 bench/control_rtt.py [--host HOST] [-n NUM_ROUND_TRIPS]
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import threading
+import statistics
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rpividctrl_lib.protocol import REMOTE_CONTROL_PORT, MessageType, MessageReader, MessageBuilder, STATS_RESPONSE_SECTIONS  # noqa: E402
+from rpividctrl_lib.aio import AsyncControlClient  # noqa: E402
+
+STATS_RESPONSE = MessageBuilder.stats_response({field_name: 1 for section_version, section_struct, field_names in STATS_RESPONSE_SECTIONS
+                                                for field_name in field_names})
+
+
+def serve(server_sock):
+    """Answers TIME_SYNC_REQUEST and STATS_REQUEST like the server, one connection after another"""
+    while True:
+        conn, addr = server_sock.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        message_reader = MessageReader()
+        with conn:
+            while True:
+                num_bytes = conn.recv_into(message_reader.get_write_buffer())
+                if not num_bytes:
+                    break
+                message_reader.commit(num_bytes)
+                message = message_reader.read_message()
+                while message is not None:
+                    if message['message_type'] == MessageType.TIME_SYNC_REQUEST:
+                        now = time.monotonic_ns()
+                        conn.sendall(MessageBuilder.time_sync_response(message['client_time'], now, now))
+                    elif message['message_type'] == MessageType.STATS_REQUEST:
+                        conn.sendall(STATS_RESPONSE)
+                    message = message_reader.read_message()
+
+
+def blocking_round_trips(host, port, num_round_trips):
+    times = []
+    with socket.create_connection((host, port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        message_reader = MessageReader()
+        for i in range(num_round_trips):
+            start = time.perf_counter()
+            sock.sendall(MessageBuilder.time_sync_request(time.monotonic_ns()))
+            message = None
+            while message is None or message['message_type'] != MessageType.TIME_SYNC_RESPONSE:
+                message = message_reader.read_message()
+                if message is None:
+                    message_reader.commit(sock.recv_into(message_reader.get_write_buffer()))
+            times.append(time.perf_counter() - start)
+    return times
+
+
+async def async_round_trips(host, port, num_round_trips):
+    ping_times = []
+    stats_times = []
+    async with await AsyncControlClient.connect(host, port) as client:
+        for i in range(num_round_trips):
+            start = time.perf_counter()
+            await client.time_sync()
+            ping_times.append(time.perf_counter() - start)
+        for i in range(num_round_trips):
+            start = time.perf_counter()
+            await client.request_stats()
+            stats_times.append(time.perf_counter() - start)
+    return ping_times, stats_times
+
+
+def print_times(name, times):
+    times = sorted(times)
+    p99 = times[min(int(len(times) * 0.99), len(times) - 1)]
+    print(f'{name:<28} mean {statistics.mean(times) * 1e6:7.1f} us, median {statistics.median(times) * 1e6:7.1f} us, '
+          f'p99 {p99 * 1e6:7.1f} us, max {times[-1] * 1e6:7.1f} us')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--host', help='a running server (default: answer over loopback from this process)')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('-n', '--num-round-trips', type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.host is None:
+        server_sock = socket.socket()
+        server_sock.bind(('127.0.0.1', 0))
+        server_sock.listen(1)
+        threading.Thread(target=serve, args=(server_sock,), daemon=True).start()
+        host, port = server_sock.getsockname()
+    else:
+        host, port = args.host, args.port or REMOTE_CONTROL_PORT
+
+    print_times('blocking socket time sync', blocking_round_trips(host, port, args.num_round_trips))
+    ping_times, stats_times = asyncio.run(async_round_trips(host, port, args.num_round_trips))
+    print_times('asyncio time sync', ping_times)
+    print_times('asyncio stats request', stats_times)
+
+
+if __name__ == '__main__':
+    main()
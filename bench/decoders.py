@@ -0,0 +1,60 @@
+"""
+Benchmarks every h264 decoder GStreamer has on this machine, the same way the client's h264_decoder "auto" setting does
+
+Encodes a short test clip at each resolution, decodes it one frame at a time with each decoder (tuned like the client
+tunes it), and prints decode latency and cpu time per frame, fastest first. Results are saved to the same cache the
+client reads, so running this once per resolution means the client never has to benchmark at startup, and switching
+resolutions in auto mode picks the best decoder for the new resolution.
+
+usage: python3 bench/decoders.py [--resolution WxH ...] [--no-cache]
+"""
+import os
+import sys
+from argparse import ArgumentParser
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import h264_decoders  # noqa: E402
+from common import RESOLUTIONS  # noqa: E402
+
+
+def print_results(width, height, results):
+    print(f'{width}x{height}')
+    print(f'  {"decoder":<24} {"p50 ms":>8} {"p95 ms":>8} {"cpu ms/frame":>13} {"fps":>8}')
+    for result in results:
+        if result['works']:
+            print(f'  {result["decoder"]:<24} {result["latency_p50"] * 1e3:8.2f} {result["latency_p95"] * 1e3:8.2f} '
+                  f'{result["cpu_per_frame"] * 1e3:13.2f} {result["fps"]:8.1f}')
+        else:
+            print(f'  {result["decoder"]:<24} does not work: {result.get("error")}')
+
+
+def main():
+    arg_parser = ArgumentParser(description='benchmark h264 decoders')
+    arg_parser.add_argument('--resolution', action='append', metavar='WxH',
+                            help='resolution to benchmark at, can be given more than once (default: all the client offers)')
+    arg_parser.add_argument('--no-cache', action='store_true', help='benchmark again even if the results are cached')
+    args = arg_parser.parse_args()
+
+    Gst.init(None)
+    if args.resolution:
+        resolutions = [tuple(int(n) for n in resolution.split('x')) for resolution in args.resolution]
+    else:
+        resolutions = RESOLUTIONS
+    fingerprint = h264_decoders.get_fingerprint()
+    if args.no_cache:
+        cache = h264_decoders.load_cache()
+        if cache.get('fingerprint') == fingerprint:
+            for width, height in resolutions:
+                cache['results'].pop(f'{width}x{height}', None)
+            h264_decoders.save_cache(cache)
+    for width, height in resolutions:
+        print_results(width, height, h264_decoders.get_ranking(width, height, fingerprint=fingerprint))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+End-to-end benchmark of the server -> client path over loopback, without a camera or a window
+
+Runs rpividctrl_server.Main in this process with videotestsrc (or a recorded video with --file) in place of the camera,
+and a headless client:
+
+udpsrc -> rtpjitterbuffer -> rtph264depay -> avdec_h264 -> fakesink
+
+connected to it over the control connection like the real client. For every combination of the resolutions,
+framerates and bitrates in the client's comboboxes (or the ones given on the command line), it reports:
+
+- throughput: frames per second at the client's sink, received bitrate
+- frame drops: frames the client did not get compared to the framerate, packets lost, frames the camera dropped
+- latency: the server's pipeline latency and its stages, and the client's udpsrc -> sink latency
+- cpu: process cpu time (server and client together) as a percentage of one core, and per frame
+
+Results are saved as json. --compare prints the change from an earlier results file, to compare commits.
+
+usage: python3 bench/end_to_end.py [--duration SECONDS] [--resolutions WxH ...] [--framerates FPS ...] [--bitrates BPS ...]
+                                   [--file VIDEO] [--image-processing] [--output FILE] [--compare FILE]
+"""
+import os
+import sys
+import time
+import json
+import struct
+import logging
+import subprocess
+import collections
+from argparse import ArgumentParser
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rpividctrl_lib.messaging import REMOTE_CONTROL_PORT, RTP_PORT, MessageBuilder, MessageType, SocketManager  # noqa: E402
+from common import get_pad, RESOLUTIONS, FRAMERATES, TARGET_BITRATES  # noqa: E402
+from stats import RollingStats  # noqa: E402
+import rpividctrl_server  # noqa: E402
+
+RTP_TIMESTAMP_STRUCT = struct.Struct('>I')  # at byte 4 of the rtp header
+FRAME_TIMES_LEN = 64
+# compared by --compare, with whether bigger is better
+COMPARED_RESULTS = [('fps', True), ('server_latency_p50', False), ('client_latency_p50', False), ('cpu_per_frame', False)]
+
+
+def run_until(mainloop, seconds, done=None):
+    """Runs the main loop for seconds, or until done() returns True"""
+    start = time.monotonic()
+
+    def check():
+        if (done is not None and done()) or time.monotonic() - start >= seconds:
+            mainloop.quit()
+            return GLib.SOURCE_REMOVE
+        return GLib.SOURCE_CONTINUE
+
+    GLib.timeout_add(10, check)
+    mainloop.run()
+
+
+class HeadlessClient:
+    """The client's pipeline with fakesink instead of gtkglsink, and its control connection"""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes_received = 0
+        self.latency_stats = RollingStats(1000)
+        self.last_rtp_timestamp = None
+        self.arrival_times = collections.OrderedDict()  # rtp timestamp -> time.monotonic() of the first packet
+        self.pts_to_rtp_timestamp = collections.OrderedDict()
+        self.stats = None
+        self.connected = False
+        self.closed_reason = None
+
+        self.pipeline = Gst.parse_launch(
+            f'udpsrc name=udpsrc port={RTP_PORT} caps="application/x-rtp,media=video,clock-rate=90000,encoding-name=H264,payload=96" ! '
+            'rtpjitterbuffer name=jitterbuffer latency=0 ! rtph264depay name=depay ! avdec_h264 ! fakesink name=sink sync=false')
+        self.jitterbuffer = self.pipeline.get_by_name('jitterbuffer')
+        get_pad(self.pipeline.get_by_name('udpsrc').iterate_src_pads()).add_probe(Gst.PadProbeType.BUFFER, self.udpsrc_probe)
+        get_pad(self.pipeline.get_by_name('depay').iterate_sink_pads()).add_probe(Gst.PadProbeType.BUFFER, self.depay_probe)
+        get_pad(self.pipeline.get_by_name('sink').iterate_sink_pads()).add_probe(Gst.PadProbeType.BUFFER, self.sink_probe)
+
+        self.sock_manager = SocketManager()
+        self.sock_manager.on_connected = self.on_connected
+        self.sock_manager.on_read_message = self.on_read_message
+        self.sock_manager.on_destroy = self.on_destroy
+
+    def connect(self):
+        self.pipeline.set_state(Gst.State.PLAYING)
+        self.sock_manager.connect('127.0.0.1', REMOTE_CONTROL_PORT)
+
+    def on_connected(self):
+        self.connected = True
+
+    def on_destroy(self, reason):
+        self.closed_reason = reason
+
+    def on_read_message(self, message):
+        if message['message_type'] == MessageType.STATS_RESPONSE:
+            self.stats = message['stats']
+
+    def request_stats(self, mainloop):
+        self.stats = None
+        self.sock_manager.sendall(MessageBuilder.STATS_REQUEST)
+        run_until(mainloop, 5, lambda: self.stats is not None)
+        if self.closed_reason is not None:
+            raise IOError(f'control connection closed: {self.closed_reason}')
+        if self.stats is None:
+            raise IOError('no stats response')
+        return self.stats
+
+    def udpsrc_probe(self, pad, probe_info):
+        buffer = probe_info.get_buffer()
+        self.bytes_received += buffer.get_size()
+        rtp_timestamp = RTP_TIMESTAMP_STRUCT.unpack(buffer.extract_dup(4, RTP_TIMESTAMP_STRUCT.size))[0]
+        if rtp_timestamp != self.last_rtp_timestamp:
+            self.last_rtp_timestamp = rtp_timestamp
+            self.arrival_times[rtp_timestamp] = time.monotonic()
+            if len(self.arrival_times) > FRAME_TIMES_LEN:
+                self.arrival_times.popitem(last=False)
+        return Gst.PadProbeReturn.OK
+
+    def depay_probe(self, pad, probe_info):
+        buffer = probe_info.get_buffer()
+        if buffer.pts not in self.pts_to_rtp_timestamp:
+            self.pts_to_rtp_timestamp[buffer.pts] = RTP_TIMESTAMP_STRUCT.unpack(buffer.extract_dup(4, RTP_TIMESTAMP_STRUCT.size))[0]
+            if len(self.pts_to_rtp_timestamp) > FRAME_TIMES_LEN:
+                self.pts_to_rtp_timestamp.popitem(last=False)
+        return Gst.PadProbeReturn.OK
+
+    def sink_probe(self, pad, probe_info):
+        self.frames += 1
+        rtp_timestamp = self.pts_to_rtp_timestamp.get(probe_info.get_buffer().pts)
+        if rtp_timestamp is not None:
+            arrival_time = self.arrival_times.pop(rtp_timestamp, None)
+            if arrival_time is not None:
+                self.latency_stats.add(time.monotonic() - arrival_time)
+        return Gst.PadProbeReturn.OK
+
+    def packets_lost(self):
+        return self.jitterbuffer.get_property('stats').get_uint64('num-lost')[1]
+
+
+def run_trial(mainloop, server, client, width, height, framerate, bitrate, duration, settle):
+    client.sock_manager.sendall(MessageBuilder.set_target_bitrate(bitrate) +
+                                MessageBuilder.set_resolution_framerate(width, height, framerate))
+    run_until(mainloop, settle)
+
+    for stats in (server.latency_stats, server.encoder_latency_stats, server.payloader_latency_stats):
+        stats.clear()
+    client.latency_stats.clear()
+    stats_before = client.request_stats(mainloop)
+    frames_before = client.frames
+    bytes_before = client.bytes_received
+    lost_before = client.packets_lost()
+    start_cpu = time.process_time()
+    start_wall = time.monotonic()
+
+    run_until(mainloop, duration)
+
+    cpu = time.process_time() - start_cpu
+    wall = time.monotonic() - start_wall
+    frames = client.frames - frames_before
+    stats_after = client.request_stats(mainloop)
+    client_latency = client.latency_stats.summary()
+    return {
+        'width': width,
+        'height': height,
+        'framerate': framerate,
+        'target_bitrate': bitrate,
+        'fps': frames / wall,
+        'received_bitrate': (client.bytes_received - bytes_before) * 8 / wall,
+        'frames_missing': max(round(framerate * wall) - frames, 0),
+        'packets_lost': client.packets_lost() - lost_before,
+        'camera_frames_dropped': stats_after['frames_dropped'] - stats_before['frames_dropped'],
+        'server_latency_mean': stats_after['pipeline_latency'],
+        'server_latency_p50': stats_after['pipeline_latency_p50'],
+        'server_latency_p95': stats_after['pipeline_latency_p95'],
+        'encoder_latency': stats_after['encoder_latency'],
+        'payloader_latency': stats_after['payloader_latency'],
+        'udpsink_latency': stats_after['udpsink_latency'],
+        'client_latency_mean': client_latency['mean'],
+        'client_latency_p50': client_latency['p50'],
+        'client_latency_p95': client_latency['p95'],
+        'cpu_percent': cpu / wall * 100,
+        'cpu_per_frame': cpu / frames if frames else None
+    }
+
+
+def print_trial(result):
+    cpu_per_frame = f'{result["cpu_per_frame"] * 1e3:.2f}' if result['cpu_per_frame'] is not None else '-'
+    print(f'{result["width"]}x{result["height"]} {result["framerate"]}fps {result["target_bitrate"] / 1e3:.0f}kbps: '
+          f'{result["fps"]:.1f} fps, {result["received_bitrate"] / 1e3:.0f} kbps received, '
+          f'{result["frames_missing"]} frames missing, {result["packets_lost"]} pkts lost, '
+          f'server {result["server_latency_p50"] * 1e3:.1f} ms p50 {result["server_latency_p95"] * 1e3:.1f} ms p95 '
+          f'({result["encoder_latency"] * 1e3:.1f}/{result["payloader_latency"] * 1e3:.1f}/{result["udpsink_latency"] * 1e3:.1f} enc/pay/udp), '
+          f'client {result["client_latency_p50"] * 1e3:.1f} ms p50 {result["client_latency_p95"] * 1e3:.1f} ms p95, '
+          f'cpu {result["cpu_percent"]:.0f}% {cpu_per_frame} ms/frame')
+
+
+def compare(results, old_results):
+    """Prints the change in COMPARED_RESULTS from old_results for every trial in both"""
+    def trial_key(trial):
+        return trial['width'], trial['height'], trial['framerate'], trial['target_bitrate']
+
+    old_trials = {trial_key(trial): trial for trial in old_results['trials']}
+    print(f'compared to {old_results.get("commit") or "unknown commit"} ({old_results.get("date")}):')
+    for trial in results['trials']:
+        old_trial = old_trials.get(trial_key(trial))
+        if old_trial is None:
+            continue
+        changes = []
+        for name, bigger_is_better in COMPARED_RESULTS:
+            old_value, value = old_trial.get(name), trial.get(name)
+            if not old_value or value is None:
+                continue
+            change = (value - old_value) / old_value * 100
+            better = (change > 0) == bigger_is_better
+            changes.append(f'{name} {change:+.1f}%{"" if abs(change) < 5 else (" (better)" if better else " (worse)")}')
+        print(f'{trial["width"]}x{trial["height"]} {trial["framerate"]}fps {trial["target_bitrate"] / 1e3:.0f}kbps: ' + ', '.join(changes))
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--duration', type=float, default=5, help='seconds measured per combination')
+    parser.add_argument('--settle', type=float, default=1.5, help='seconds to wait after changing settings')
+    parser.add_argument('--resolutions', nargs='+', default=[f'{width}x{height}' for width, height in RESOLUTIONS], metavar='WxH')
+    parser.add_argument('--framerates', type=int, nargs='+', default=FRAMERATES)
+    parser.add_argument('--bitrates', type=int, nargs='+', default=[bps for display_name, bps in TARGET_BITRATES])
+    parser.add_argument('--file', help='play back this video instead of videotestsrc')
+    parser.add_argument('--image-processing', action='store_true', help='raw frames from the source, encoded by the server')
+    parser.add_argument('--output', default='end_to_end.json', help='json results')
+    parser.add_argument('--compare', help='json results of an earlier run')
+    parser.add_argument('--verbose', action='store_true', help='show the server\'s log')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    Gst.init(None)
+    mainloop = GLib.MainLoop()
+
+    server = rpividctrl_server.Main({
+        'host': '127.0.0.1',
+        'source': 'filesrc' if args.file else 'videotestsrc',
+        'source_file': args.file,
+        'image_processing': '1' if args.image_processing else '0',
+        'latency_sample_interval': '1'
+    })
+    server.pipeline.set_state(Gst.State.PAUSED)
+
+    client = HeadlessClient()
+    client.connect()
+    run_until(mainloop, 5, lambda: client.connected)
+    if not client.connected:
+        raise IOError('could not connect to the server')
+    client.sock_manager.sendall(MessageBuilder.RESUME)
+
+    results = {
+        'commit': get_commit(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'source': args.file or 'videotestsrc',
+        'image_processing': args.image_processing,
+        'duration': args.duration,
+        'trials': []
+    }
+    for resolution in args.resolutions:
+        width, height = (int(value) for value in resolution.split('x'))
+        for framerate in args.framerates:
+            for bitrate in args.bitrates:
+                result = run_trial(mainloop, server, client, width, height, framerate, bitrate, args.duration, args.settle)
+                print_trial(result)
+                results['trials'].append(result)
+
+    client.sock_manager.on_destroy = None
+    client.sock_manager.destroy()
+    client.pipeline.set_state(Gst.State.NULL)
+    server.pipeline.set_state(Gst.State.NULL)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f'saved results to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as compare_file:
+            compare(results, json.load(compare_file))
+
+
+if __name__ == '__main__':
+    main()
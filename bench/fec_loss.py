@@ -0,0 +1,179 @@
+"""
+Loopback test of forward error correction under random packet loss
+
+Runs the server's rtp path and the client's fec decoders in one process, with a udp relay in between that drops
+packets at random:
+
+videotestsrc -> x264enc -> rtph264pay -> rtpulpfecenc -> rtpredenc -> udpsink
+    -> relay (drops packets) ->
+udpsrc -> rtpreddec -> rtpstorage -> rtpjitterbuffer -> rtpulpfecdec -> rtph264depay -> fakesink
+
+For each fec percentage, reports how many frames lost at least one h264 packet in the relay, how many of those
+fec fully recovered, and the latency from the payloader to after rtpulpfecdec (which includes the time the
+jitterbuffer waits for fec packets, the same as the client).
+
+usage: python3 bench/fec_loss.py [--loss RATE] [--percentages PERCENT ...] [--duration SECONDS] [--fec-latency MS]
+"""
+import os
+import sys
+import time
+import random
+import socket
+import struct
+import statistics
+import threading
+from argparse import ArgumentParser
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rpividctrl_lib.messaging import ULPFEC_PAYLOAD_TYPE, RED_PAYLOAD_TYPE  # noqa: E402
+from common import get_pad  # noqa: E402
+
+RTP_HEADER_STRUCT = struct.Struct('>BBHI')  # flags, marker + payload type, sequence number, timestamp
+RTP_HEADER_LEN = 12
+FEC_OVERHEAD = 1 + 10 + 6  # same as the server
+
+
+class LossyRelay(threading.Thread):
+    """Forwards rtp packets from one local port to another, dropping each one with probability loss"""
+
+    def __init__(self, listen_port, dest_port, loss, seed=None):
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', listen_port))
+        self.sock.settimeout(0.1)
+        self.dest = ('127.0.0.1', dest_port)
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.running = True
+        self.frames = set()  # rtp timestamps of every frame with an h264 packet through the relay
+        self.dropped = {}  # rtp timestamp -> sequence numbers of dropped h264 packets
+        self.dropped_fec = 0
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            flags, marker_pt, seq, timestamp = RTP_HEADER_STRUCT.unpack_from(data)
+            pt = marker_pt & 0x7f
+            if pt == RED_PAYLOAD_TYPE:
+                # primary block only (rtpredenc distance=0), a 1 byte header with the payload type inside
+                pt = data[RTP_HEADER_LEN] & 0x7f
+            is_fec = pt == ULPFEC_PAYLOAD_TYPE
+            if not is_fec:
+                self.frames.add(timestamp)
+            if self.random.random() < self.loss:
+                if is_fec:
+                    self.dropped_fec += 1
+                else:
+                    self.dropped.setdefault(timestamp, set()).add(seq)
+                continue
+            self.sock.sendto(data, self.dest)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.sock.close()
+
+
+def run_trial(percentage, loss, duration, fec_latency, relay_port, recv_port, seed):
+    sender = Gst.parse_launch(
+        'videotestsrc is-live=true pattern=ball ! video/x-raw,width=640,height=480,framerate=60/1 ! '
+        'x264enc tune=zerolatency speed-preset=ultrafast bitrate=1000 key-int-max=60 ! '
+        f'rtph264pay name=pay mtu={1500 - 28 - FEC_OVERHEAD} ! '
+        f'rtpulpfecenc pt={ULPFEC_PAYLOAD_TYPE} percentage={percentage} ! '
+        f'rtpredenc pt={RED_PAYLOAD_TYPE} allow-no-red-blocks={str(percentage > 0).lower()} ! '
+        f'udpsink host=127.0.0.1 port={relay_port} sync=false')
+    receiver = Gst.parse_launch(
+        f'udpsrc port={recv_port} caps="application/x-rtp,media=video,clock-rate=90000,encoding-name=H264,payload=96" ! '
+        f'rtpreddec pt={RED_PAYLOAD_TYPE} ! rtpstorage name=storage size-time={250 * Gst.MSECOND} ! '
+        f'rtpjitterbuffer latency={fec_latency if percentage > 0 else 0} do-lost=true ! '
+        f'rtpulpfecdec name=fecdec pt={ULPFEC_PAYLOAD_TYPE} ! rtph264depay ! fakesink sync=false')
+    fecdec = receiver.get_by_name('fecdec')
+    fecdec.set_property('storage', receiver.get_by_name('storage').get_property('internal-storage'))
+
+    send_times = {}  # rtp timestamp -> when the first packet of the frame left the payloader
+    received_seqs = set()
+    latencies = []
+
+    def pay_probe(pad, probe_info):
+        header = probe_info.get_buffer().extract_dup(0, RTP_HEADER_LEN)
+        timestamp = RTP_HEADER_STRUCT.unpack(header)[3]
+        send_times.setdefault(timestamp, time.monotonic())
+        return Gst.PadProbeReturn.OK
+
+    def fecdec_probe(pad, probe_info):
+        header = probe_info.get_buffer().extract_dup(0, RTP_HEADER_LEN)
+        flags, marker_pt, seq, timestamp = RTP_HEADER_STRUCT.unpack(header)
+        received_seqs.add(seq)
+        send_time = send_times.get(timestamp)
+        if marker_pt & 0x80 and send_time is not None:  # marker bit is set on the last packet of a frame
+            latencies.append(time.monotonic() - send_time)
+        return Gst.PadProbeReturn.OK
+
+    get_pad(sender.get_by_name('pay').iterate_src_pads()).add_probe(Gst.PadProbeType.BUFFER, pay_probe)
+    get_pad(fecdec.iterate_src_pads()).add_probe(Gst.PadProbeType.BUFFER, fecdec_probe)
+
+    relay = LossyRelay(relay_port, recv_port, loss, seed)
+    relay.start()
+
+    mainloop = GLib.MainLoop()
+    receiver.set_state(Gst.State.PLAYING)
+    sender.set_state(Gst.State.PLAYING)
+    GLib.timeout_add(int(duration * 1000), mainloop.quit)
+    mainloop.run()
+    sender.set_state(Gst.State.NULL)
+    receiver.set_state(Gst.State.NULL)
+    relay.stop()
+
+    frames_hit = len(relay.dropped)
+    frames_recovered = sum(1 for seqs in relay.dropped.values() if seqs <= received_seqs)
+    packets_dropped = sum(len(seqs) for seqs in relay.dropped.values())
+    return {
+        'frames': len(relay.frames),
+        'frames_hit': frames_hit,
+        'frames_recovered': frames_recovered,
+        'packets_dropped': packets_dropped,
+        'fec_dropped': relay.dropped_fec,
+        'recovered': fecdec.get_property('recovered'),
+        'latencies': latencies
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--loss', type=float, default=0.02, help='probability of dropping each packet')
+    parser.add_argument('--percentages', type=int, nargs='+', default=[0, 10, 20, 30, 50])
+    parser.add_argument('--duration', type=float, default=10, help='seconds per percentage')
+    parser.add_argument('--fec-latency', type=int, default=40, help='jitterbuffer latency in ms while fec is on')
+    parser.add_argument('--port', type=int, default=5600, help='relay listens here, receiver listens on port + 2')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    Gst.init(None)
+
+    baseline_latency = None
+    print(f'loss {args.loss * 100:.1f}%, {args.duration} s per trial')
+    for percentage in args.percentages:
+        result = run_trial(percentage, args.loss, args.duration, args.fec_latency, args.port, args.port + 2, args.seed)
+        latencies = sorted(result['latencies'])
+        mean_latency = statistics.mean(latencies) if latencies else float('nan')
+        p95_latency = latencies[int(len(latencies) * 0.95)] if latencies else float('nan')
+        if baseline_latency is None:
+            baseline_latency = mean_latency
+        recovered_pct = result['frames_recovered'] / result['frames_hit'] * 100 if result['frames_hit'] else 100.0
+        print(f'fec {percentage:3d}%: {result["frames_hit"]}/{result["frames"]} frames hit by loss, '
+              f'{result["frames_recovered"]} recovered ({recovered_pct:.1f}%), '
+              f'{result["recovered"]}/{result["packets_dropped"]} packets recovered ({result["fec_dropped"]} fec packets dropped), '
+              f'latency mean {mean_latency * 1e3:.1f} ms p95 {p95_latency * 1e3:.1f} ms '
+              f'({(mean_latency - baseline_latency) * 1e3:+.1f} ms vs first trial)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Draws every overlay plugin into a test stream with overlay mode gl, without a window
+
+videotestsrc -> glupload -> glcolorconvert -> overlaycomposition -> gloverlaycompositor -> fakesink
+
+Prints the time the overlay took to draw and the frame rate of the whole pipeline, for each overlay. Every frame gets
+a new vision result, so a dynamic overlay is drawn every frame, the worst case. Works
+without a gpu with mesa's software renderer (llvmpipe):
+
+LIBGL_ALWAYS_SOFTWARE=1 GST_GL_PLATFORM=egl GST_GL_WINDOW=surfaceless python3 bench/gl_overlay.py
+
+usage: python3 bench/gl_overlay.py [--width WIDTH] [--height HEIGHT] [-n NUM_FRAMES]
+"""
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gl_overlay  # noqa: E402
+from overlay import Overlay  # noqa: E402
+from rpividctrl_lib.protocol import VisionResult, Detection  # noqa: E402
+
+
+def get_vision_result(pts):
+    """A new vision result for every frame, with one target moving across"""
+    x = (pts // Gst.MSECOND % 1000) / 1000
+    return VisionResult(0, 0, [Detection('target', x, 0.5, 0.1, 0.1, 1.0)])
+
+
+def run(overlay_cls, width, height, num_frames):
+    pipeline = Gst.parse_launch(f'videotestsrc num-buffers={num_frames} ! video/x-raw,width={width},height={height} ! '
+                                'glupload ! glcolorconvert name=convert')
+    sink = Gst.ElementFactory.make('fakesink')
+    sink.set_property('sync', False)
+    pipeline.add(sink)
+    compositor = gl_overlay.OverlayCompositor(get_vision_result=get_vision_result)
+    compositor.set_overlay(overlay_cls())
+    compositor.add_to(pipeline, pipeline.get_by_name('convert'), sink)
+
+    start = time.monotonic()
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    elapsed = time.monotonic() - start
+    pipeline.set_state(Gst.State.NULL)
+    if message.type == Gst.MessageType.ERROR:
+        raise RuntimeError(str(message.parse_error().gerror))
+    return compositor.draw_stats, num_frames / elapsed
+
+
+def main():
+    arg_parser = ArgumentParser(description='benchmark overlays drawn with overlay mode gl')
+    arg_parser.add_argument('--width', type=int, default=640)
+    arg_parser.add_argument('--height', type=int, default=480)
+    arg_parser.add_argument('-n', '--num-frames', type=int, default=300)
+    args = arg_parser.parse_args()
+
+    Gst.init(None)
+    if not gl_overlay.is_available():
+        sys.exit(f'needs the {" and ".join(gl_overlay.ELEMENTS)} elements')
+    for overlay_plugin in Overlay.list_plugins():
+        draw_stats, fps = run(overlay_plugin.load(), args.width, args.height, args.num_frames)
+        if draw_stats.count == 0:
+            print(f'{overlay_plugin.display_name:<20} nothing drawn, {fps:.1f} fps')
+            continue
+        draw = draw_stats.summary()
+        # a static overlay is drawn once, and the same composition is reused for every frame after
+        print(f'{overlay_plugin.display_name:<20} {draw_stats.count} draws, {draw["mean"] * 1e3:.3f} ms mean, '
+              f'{draw["p95"] * 1e3:.3f} ms p95, {fps:.1f} fps')
+
+
+if __name__ == '__main__':
+    main()
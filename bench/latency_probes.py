@@ -0,0 +1,170 @@
+"""
+CPU cost of the latency measurement probes
+
+Runs a videotestsrc pipeline with the server's and client's probe points on it:
+
+videotestsrc -> x264enc -> rtph264pay (small mtu, many packets per frame) -> rtpjitterbuffer -> rtph264depay -> fakesink
+            ^ camera probe            ^ packet probe (like the client's udpsrc)                            ^ sink probe
+
+and measures process cpu time per frame with each way of tracking latency:
+
+none: only counts frames at the sink
+events: a custom downstream event after every buffer from the camera and every packet, like before
+pts: buffers are looked up by pts / rtp timestamp, every --interval th frame is measured
+
+usage: python3 bench/latency_probes.py [--duration SECONDS] [--interval N] [--mtu BYTES]
+"""
+import os
+import sys
+import time
+import struct
+import collections
+from argparse import ArgumentParser
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import get_pad  # noqa: E402
+from stats import RollingStats  # noqa: E402
+
+RTP_TIMESTAMP_STRUCT = struct.Struct('>I')  # at byte 4 of the rtp header
+
+
+class Trial:
+    def __init__(self, mode, interval, mtu):
+        self.mode = mode
+        self.interval = interval
+        self.frames = 0
+        self.latency_stats = RollingStats()
+        self.camsrc_buffers = 0
+        self.camsrc_times = collections.OrderedDict()
+        self.last_rtp_timestamp = None
+        self.packet_frames = 0
+        self.arrival_times = collections.OrderedDict()
+        self.pts_to_rtp_timestamp = collections.OrderedDict()
+
+        self.pipeline = Gst.parse_launch(
+            'videotestsrc name=src is-live=true pattern=ball ! video/x-raw,width=640,height=480,framerate=90/1 ! '
+            'x264enc tune=zerolatency speed-preset=ultrafast bitrate=4000 key-int-max=90 ! '
+            f'rtph264pay name=pay mtu={mtu} ! rtpjitterbuffer latency=0 ! rtph264depay name=depay ! fakesink name=sink sync=false')
+        src_pad = get_pad(self.pipeline.get_by_name('src').iterate_src_pads())
+        pay_pad = get_pad(self.pipeline.get_by_name('pay').iterate_src_pads())
+        depay_pad = get_pad(self.pipeline.get_by_name('depay').iterate_sink_pads())
+        sink_pad = get_pad(self.pipeline.get_by_name('sink').iterate_sink_pads())
+
+        if mode == 'events':
+            src_pad.add_probe(Gst.PadProbeType.BUFFER, self.event_probe, 'camsrc_time')
+            pay_pad.add_probe(Gst.PadProbeType.BUFFER, self.event_probe, 'udpsrc_time')
+            sink_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.sink_event_probe)
+            sink_pad.add_probe(Gst.PadProbeType.BUFFER, self.count_probe)
+        elif mode == 'pts':
+            src_pad.add_probe(Gst.PadProbeType.BUFFER, self.camsrc_pts_probe)
+            pay_pad.add_probe(Gst.PadProbeType.BUFFER, self.packet_pts_probe)
+            depay_pad.add_probe(Gst.PadProbeType.BUFFER, self.depay_pts_probe)
+            sink_pad.add_probe(Gst.PadProbeType.BUFFER, self.sink_pts_probe)
+        else:
+            sink_pad.add_probe(Gst.PadProbeType.BUFFER, self.count_probe)
+
+    def count_probe(self, pad, probe_info):
+        self.frames += 1
+        return Gst.PadProbeReturn.OK
+
+    # the way the server and client used to do it
+
+    def event_probe(self, pad, probe_info, name):
+        event_structure = Gst.Structure.new_empty(name)
+        event_structure.set_value('time', time.monotonic())
+        pad.get_peer().send_event(Gst.Event.new_custom(Gst.EventType.CUSTOM_DOWNSTREAM, event_structure))
+        return Gst.PadProbeReturn.OK
+
+    def sink_event_probe(self, pad, probe_info):
+        event = probe_info.get_event()
+        if event.type == Gst.EventType.CUSTOM_DOWNSTREAM:
+            structure = event.get_structure()
+            if structure.has_name('udpsrc_time'):
+                self.latency_stats.add(time.monotonic() - structure.get_value('time'))
+        return Gst.PadProbeReturn.OK
+
+    # the way the server and client do it now
+
+    def camsrc_pts_probe(self, pad, probe_info):
+        self.camsrc_buffers += 1
+        if self.camsrc_buffers % self.interval == 0:
+            self.camsrc_times[probe_info.get_buffer().pts] = time.monotonic()
+            if len(self.camsrc_times) > 32:
+                self.camsrc_times.popitem(last=False)
+        return Gst.PadProbeReturn.OK
+
+    def packet_pts_probe(self, pad, probe_info):
+        rtp_timestamp = RTP_TIMESTAMP_STRUCT.unpack(probe_info.get_buffer().extract_dup(4, RTP_TIMESTAMP_STRUCT.size))[0]
+        if rtp_timestamp != self.last_rtp_timestamp:
+            self.last_rtp_timestamp = rtp_timestamp
+            self.packet_frames += 1
+            if self.packet_frames % self.interval == 0:
+                self.arrival_times[rtp_timestamp] = time.monotonic()
+                if len(self.arrival_times) > 64:
+                    self.arrival_times.popitem(last=False)
+        return Gst.PadProbeReturn.OK
+
+    def depay_pts_probe(self, pad, probe_info):
+        buffer = probe_info.get_buffer()
+        if buffer.pts not in self.pts_to_rtp_timestamp:
+            self.pts_to_rtp_timestamp[buffer.pts] = RTP_TIMESTAMP_STRUCT.unpack(buffer.extract_dup(4, RTP_TIMESTAMP_STRUCT.size))[0]
+            if len(self.pts_to_rtp_timestamp) > 64:
+                self.pts_to_rtp_timestamp.popitem(last=False)
+        return Gst.PadProbeReturn.OK
+
+    def sink_pts_probe(self, pad, probe_info):
+        self.frames += 1
+        rtp_timestamp = self.pts_to_rtp_timestamp.get(probe_info.get_buffer().pts)
+        if rtp_timestamp is not None:
+            arrival_time = self.arrival_times.pop(rtp_timestamp, None)
+            if arrival_time is not None:
+                self.latency_stats.add(time.monotonic() - arrival_time)
+        return Gst.PadProbeReturn.OK
+
+    def run(self, duration):
+        mainloop = GLib.MainLoop()
+        self.pipeline.set_state(Gst.State.PLAYING)
+        # let the encoder warm up before measuring
+        time.sleep(1)
+        start_frames = self.frames
+        start_cpu = time.process_time()
+        start_wall = time.monotonic()
+        GLib.timeout_add(int(duration * 1000), mainloop.quit)
+        mainloop.run()
+        cpu = time.process_time() - start_cpu
+        wall = time.monotonic() - start_wall
+        frames = self.frames - start_frames
+        self.pipeline.set_state(Gst.State.NULL)
+        return frames, cpu, wall
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--duration', type=float, default=10, help='seconds per mode')
+    parser.add_argument('--interval', type=int, default=4, help='measure every nth frame in pts mode')
+    parser.add_argument('--mtu', type=int, default=400, help='smaller means more packets per frame')
+    parser.add_argument('--modes', nargs='+', default=['none', 'events', 'pts'], choices=['none', 'events', 'pts'])
+    args = parser.parse_args()
+
+    Gst.init(None)
+
+    baseline = None
+    for mode in args.modes:
+        trial = Trial(mode, args.interval, args.mtu)
+        frames, cpu, wall = trial.run(args.duration)
+        cpu_per_frame = cpu / frames if frames else float('nan')
+        if mode == 'none':
+            baseline = cpu_per_frame
+        latency = trial.latency_stats.summary()
+        print(f'{mode:6s}: {frames / wall:.1f} fps, {cpu_per_frame * 1e3:.3f} ms cpu per frame'
+              + (f' ({(cpu_per_frame - baseline) * 1e3:+.3f} ms vs none)' if baseline is not None and mode != 'none' else '')
+              + (f', latency mean {latency["mean"] * 1e3:.2f} ms p95 {latency["p95"] * 1e3:.2f} ms' if mode != 'none' else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Microbenchmark for MessageReader
+
+Compares the preallocated buffer MessageReader against the previous list-of-bytes implementation,
+for a burst of 1-byte commands and for mixed traffic.
+
+usage: python3 bench/message_reader.py [-n NUM_MESSAGES] [--chunk-size BYTES]
+"""
+import os
+import sys
+import time
+import random
+import struct
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rpividctrl_lib.protocol import MessageReader, MessageBuilder, DRCLevel, STATS_RESPONSE_SECTIONS  # noqa: E402
+
+STATS_RESPONSE = MessageBuilder.stats_response({field_name: 1 for section_version, section_struct, field_names in STATS_RESPONSE_SECTIONS
+                                                for field_name in field_names})
+
+
+class ListMessageReader(MessageReader):
+    """The previous MessageReader, which stores received bytes objects in a list"""
+
+    def __init__(self):
+        super().__init__()
+        self.bufs = []
+        self.list_bytes_available = 0
+        self.next_message_len = -1
+
+    def append(self, buf):
+        self.bufs.append(buf)
+        self.list_bytes_available += len(buf)
+        if self.list_bytes_available > MessageReader.MAX_BYTES_AVAILABLE:
+            raise IOError('bytes stored exceeds maximum')
+
+    def read_chunk(self, num_bytes):
+        if self.list_bytes_available >= num_bytes:
+            chunk_bufs = []
+            bytes_needed = num_bytes
+            while bytes_needed > 0:
+                next_buf = self.bufs[0]
+                next_buf_len = len(next_buf)
+                if next_buf_len > bytes_needed:
+                    chunk_bufs.append(next_buf[0:bytes_needed])
+                    self.bufs[0] = next_buf[bytes_needed:]
+                    bytes_needed = 0
+                else:
+                    chunk_bufs.append(next_buf)
+                    bytes_needed -= next_buf_len
+                    self.bufs.pop(0)
+            self.list_bytes_available -= num_bytes
+            return b''.join(chunk_bufs)
+        else:
+            return None
+
+    def read_message(self):
+        if self.next_message_len == -1:
+            next_message_len_bytes = self.read_chunk(2)
+            if next_message_len_bytes:
+                self.next_message_len = struct.unpack('>H', next_message_len_bytes)[0]
+            else:
+                return None
+
+        message = self.read_chunk(self.next_message_len)
+        if message:
+            self.next_message_len = -1
+            return self.parse_message(message)
+        else:
+            return None
+
+
+def single_byte_traffic(num_messages):
+    commands = [MessageBuilder.PAUSE, MessageBuilder.RESUME, MessageBuilder.STATS_REQUEST]
+    return b''.join(commands[i % len(commands)] for i in range(num_messages))
+
+
+def mixed_traffic(num_messages):
+    rand = random.Random(1875)
+    messages = []
+    for i in range(num_messages):
+        choice = rand.randrange(5)
+        if choice == 0:
+            messages.append(MessageBuilder.STATS_REQUEST)
+        elif choice == 1:
+            messages.append(MessageBuilder.set_resolution_framerate(640, 480, 90))
+        elif choice == 2:
+            messages.append(MessageBuilder.set_target_bitrate(rand.randrange(50000, 2000000)))
+        elif choice == 3:
+            messages.append(MessageBuilder.set_drc_level(DRCLevel.MEDIUM))
+        else:
+            messages.append(STATS_RESPONSE)
+    return b''.join(messages)
+
+
+def feed_list_reader(data, chunk_size):
+    reader = ListMessageReader()
+    num_read = 0
+    for i in range(0, len(data), chunk_size):
+        reader.append(data[i:i + chunk_size])  # sock.recv() returns a new bytes object
+        while reader.read_message():
+            num_read += 1
+    return num_read
+
+
+def feed_buffer_reader(data, chunk_size):
+    reader = MessageReader()
+    data_view = memoryview(data)
+    num_read = 0
+    pos = 0
+    while pos < len(data):
+        # stands in for sock.recv_into(), which receives at most the free space in the buffer
+        write_buffer = reader.get_write_buffer()
+        num_bytes = min(len(write_buffer), chunk_size, len(data) - pos)
+        write_buffer[:num_bytes] = data_view[pos:pos + num_bytes]
+        reader.commit(num_bytes)
+        pos += num_bytes
+        while reader.read_message():
+            num_read += 1
+    return num_read
+
+
+def bench(name, feed, data, num_messages, chunk_size):
+    start = time.perf_counter()
+    num_read = feed(data, chunk_size)
+    elapsed = time.perf_counter() - start
+    if num_read != num_messages:
+        raise ValueError(f'{name} read {num_read} messages, expected {num_messages}')
+    print(f'  {name:>14}: {num_messages / elapsed:12.0f} messages/sec')
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--num-messages', type=int, default=200000)
+    parser.add_argument('--chunk-size', type=int, default=4096, help='bytes received per recv() call')
+    args = parser.parse_args()
+
+    for traffic_name, generate in [('1-byte commands', single_byte_traffic), ('mixed traffic', mixed_traffic)]:
+        data = generate(args.num_messages)
+        print(f'{traffic_name} ({len(data)} bytes, {args.chunk_size} byte chunks)')
+        list_elapsed = bench('list reader', feed_list_reader, data, args.num_messages, args.chunk_size)
+        buffer_elapsed = bench('buffer reader', feed_buffer_reader, data, args.num_messages, args.chunk_size)
+        print(f'  speedup: {list_elapsed / buffer_elapsed:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
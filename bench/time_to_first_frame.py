@@ -0,0 +1,80 @@
+"""
+Measures time from connecting to the server to receiving the first rtp packet
+
+Connects like the client does (target bitrate, resolution/framerate, resume), waits for the first rtp packet,
+disconnects, and repeats. Compare a server started with RPIVIDCTRL_SERVER_WARM_STANDBY=0 (cold) against one with a
+linger timeout longer than --delay (warm). RPIVIDCTRL_SERVER_SOURCE=videotestsrc works without a camera.
+
+The server also logs its own connect -> first rtp packet time.
+
+usage: python3 bench/time_to_first_frame.py [--host HOST] [-n NUM_CONNECTIONS] [--delay SECONDS]
+"""
+import os
+import sys
+import time
+import socket
+import statistics
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rpividctrl_lib.protocol import REMOTE_CONTROL_PORT, RTP_PORT, MessageBuilder  # noqa: E402
+
+
+def time_to_first_packet(host, rtp_sock, width, height, framerate, bitrate, timeout):
+    # drop anything left over from the last connection
+    rtp_sock.setblocking(False)
+    try:
+        while True:
+            rtp_sock.recv(65536)
+    except BlockingIOError:
+        pass
+    rtp_sock.setblocking(True)
+    rtp_sock.settimeout(timeout)
+
+    start = time.monotonic()
+    with socket.create_connection((host, REMOTE_CONTROL_PORT), timeout=timeout) as control_sock:
+        control_sock.sendall(MessageBuilder.set_target_bitrate(bitrate) +
+                             MessageBuilder.set_resolution_framerate(width, height, framerate) +
+                             MessageBuilder.RESUME)
+        try:
+            rtp_sock.recv(65536)
+        except socket.timeout:
+            return None
+        return time.monotonic() - start
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-n', '--num-connections', type=int, default=10)
+    parser.add_argument('--delay', type=float, default=1.0, help='seconds to wait between disconnecting and connecting again')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--framerate', type=int, default=60)
+    parser.add_argument('--bitrate', type=int, default=1000000)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    args = parser.parse_args()
+
+    rtp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rtp_sock.bind(('', RTP_PORT))
+
+    times = []
+    for i in range(args.num_connections):
+        t = time_to_first_packet(args.host, rtp_sock, args.width, args.height, args.framerate, args.bitrate, args.timeout)
+        if t is None:
+            print(f'connection {i}: no rtp packet within {args.timeout} s')
+        else:
+            print(f'connection {i}: {t * 1e3:.1f} ms')
+            times.append(t)
+        time.sleep(args.delay)
+
+    if times:
+        print(f'first connection {times[0] * 1e3:.1f} ms')
+        if len(times) > 1:
+            rest = times[1:]
+            print(f'reconnections: mean {statistics.mean(rest) * 1e3:.1f} ms, median {statistics.median(rest) * 1e3:.1f} ms, '
+                  f'min {min(rest) * 1e3:.1f} ms, max {max(rest) * 1e3:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
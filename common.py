@@ -1,3 +1,4 @@
+import os
 from gi.repository import Gst
 
 
@@ -17,4 +18,15 @@ def dict_to_struct(fields, name='fields'):
     return struct
 
 
-STATS_BUFFER_LEN = 50  # average last n samples
+# options offered in the client's comboboxes, also swept by bench/end_to_end.py
+RESOLUTIONS = [(640, 480), (320, 240), (160, 120)]
+FRAMERATES = [90, 60, 45, 30, 15]
+TARGET_BITRATES = [('50K', 50000), ('150K', 150000), ('500K', 500000), ('1M', 1000000), ('2M', 2000000)]  # display name, bps
+FEC_PERCENTAGES = [('off', 0), ('10%', 10), ('20%', 20), ('30%', 30), ('50%', 50)]  # display name, percentage
+
+
+def get_cache_dir():
+    """$XDG_CACHE_HOME/rpividctrl (~/.cache/rpividctrl), created if it does not exist"""
+    cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'rpividctrl')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
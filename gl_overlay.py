@@ -0,0 +1,148 @@
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstVideo
+import sys
+import time
+import cairo
+import logging
+import threading
+from overlay import Overlay
+from stats import RollingStats
+
+logger = logging.getLogger('gl_overlay')
+
+# cairo's ARGB32 is premultiplied, in native byte order
+CAIRO_VIDEO_FORMAT = GstVideo.VideoFormat.BGRA if sys.byteorder == 'little' else GstVideo.VideoFormat.ARGB
+ELEMENTS = ('overlaycomposition', 'gloverlaycompositor')
+
+
+def is_available():
+    return all(Gst.ElementFactory.find(name) is not None for name in ELEMENTS)
+
+
+class OverlayCompositor:
+    """
+    Draws an Overlay into the video stream, for the gpu to blend in
+
+    glcolorconvert -> overlaycomposition -> gloverlaycompositor -> gtkglsink
+
+    overlaycomposition asks for the overlay of every frame on the streaming thread, and attaches it to the frame as a
+    GstVideoOverlayCompositionMeta. gloverlaycompositor uploads it as a texture and blends it over the frame, so the
+    overlay is always drawn for, and lined up with, the frame under it. The Overlay plugin API is the same as with the
+    Gtk.DrawingArea: draw_static() is cached, draw() runs for each frame, in video coordinates.
+
+    The static and dynamic layers are separate rectangles of the composition. gloverlaycompositor only uploads a
+    rectangle it has not seen before, so the static layer is uploaded once per video size. draw() runs again only when
+    the frame's vision result changes (or every frame for an Overlay.animated overlay); until then every frame gets
+    the same composition, and nothing is drawn or uploaded.
+    """
+
+    def __init__(self, get_vision_result=None, draw_stats=None):
+        self.element = Gst.ElementFactory.make('overlaycomposition')
+        self.element.connect('caps-changed', self.on_caps_changed)
+        self.element.connect('draw', self.on_draw)
+        self.compositor = Gst.ElementFactory.make('gloverlaycompositor')
+
+        self.get_vision_result = get_vision_result  # pts -> rpividctrl_lib.messaging.VisionResult or None
+        self.draw_stats = draw_stats if draw_stats is not None else RollingStats()
+
+        # the overlay changes on the main thread, and is drawn on the streaming thread
+        self.lock = threading.Lock()
+        self.overlay = None
+        self.video_size = None
+        self.static_rectangle = None
+        self.dynamic_surface = None  # reused for every draw() at this video size
+        self.dynamic_ctx = None
+        self.composition = None  # the last one, with the vision result it was drawn for
+        self.composition_vision_result = None
+
+    def add_to(self, pipeline, upstream, downstream):
+        pipeline.add(self.element)
+        pipeline.add(self.compositor)
+        upstream.link(self.element)
+        self.element.link(self.compositor)
+        self.compositor.link(downstream)
+
+    def set_overlay(self, overlay):
+        with self.lock:
+            self.overlay = overlay
+            self.static_rectangle = None
+            self.composition = None
+
+    def on_caps_changed(self, element, caps, window_width, window_height):
+        structure = caps.get_structure(0)
+        has_width, width = structure.get_int('width')
+        has_height, height = structure.get_int('height')
+        with self.lock:
+            self.video_size = (width, height) if has_width and has_height else None
+            self.static_rectangle = None
+            self.dynamic_surface = None
+            self.dynamic_ctx = None
+            self.composition = None
+
+    def create_surface(self):
+        width, height = self.video_size
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        ctx = cairo.Context(surface)
+        # (0, 0) -> top left of video stream, and
+        # (Overlay.CTX_WIDTH, Overlay.CTX_HEIGHT) -> bottom right of video stream
+        ctx.scale(width / Overlay.CTX_WIDTH, height / Overlay.CTX_HEIGHT)
+        return surface, ctx
+
+    def to_rectangle(self, surface):
+        width, height = self.video_size
+        surface.flush()
+        # a copy: the surface is drawn on again, while the gpu might not have uploaded this one yet
+        pixels = Gst.Buffer.new_wrapped(bytes(surface.get_data()))
+        GstVideo.buffer_add_video_meta(pixels, GstVideo.VideoFrameFlags.NONE, CAIRO_VIDEO_FORMAT, width, height)
+        return GstVideo.VideoOverlayRectangle.new_raw(pixels, 0, 0, width, height,
+                                                      GstVideo.VideoOverlayFormatFlags.PREMULTIPLIED_ALPHA)
+
+    def draw_dynamic(self, overlay):
+        if self.dynamic_surface is None:
+            self.dynamic_surface, self.dynamic_ctx = self.create_surface()
+        ctx = self.dynamic_ctx
+        ctx.save()
+        ctx.set_operator(cairo.OPERATOR_CLEAR)
+        ctx.paint()
+        ctx.restore()
+        ctx.save()
+        overlay.draw(ctx)
+        ctx.restore()
+        return self.to_rectangle(self.dynamic_surface)
+
+    def on_draw(self, element, sample):
+        with self.lock:
+            overlay = self.overlay
+            if overlay is None or self.video_size is None:
+                return None
+            vision_result = None
+            if overlay.has_dynamic_layer() and self.get_vision_result is not None:
+                vision_result = self.get_vision_result(sample.get_buffer().pts)
+            if self.composition is not None and vision_result is self.composition_vision_result and \
+                    not overlay.animated:
+                return self.composition
+            start = time.perf_counter()
+
+            rectangles = []
+            if overlay.has_static_layer():
+                if self.static_rectangle is None:
+                    static_surface, static_ctx = self.create_surface()
+                    overlay.draw_static(static_ctx)
+                    self.static_rectangle = self.to_rectangle(static_surface)
+                rectangles.append(self.static_rectangle)
+            if overlay.has_dynamic_layer():
+                overlay.set_vision_result(vision_result)
+                rectangles.append(self.draw_dynamic(overlay))
+            if not rectangles:
+                return None
+
+            composition = GstVideo.VideoOverlayComposition.new(rectangles[0])
+            for rectangle in rectangles[1:]:
+                composition.add_rectangle(rectangle)
+            self.composition = composition
+            self.composition_vision_result = vision_result
+            self.draw_stats.add(time.perf_counter() - start)
+            return composition
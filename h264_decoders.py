@@ -0,0 +1,346 @@
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+import os
+import json
+import time
+import hashlib
+import logging
+import platform
+from common import get_cache_dir
+from stats import RollingStats
+
+logger = logging.getLogger('h264_decoders')
+
+CACHE_FILE = 'h264_decoders.json'
+DECODER_LIST_FILE = 'h264_decoder_list.json'
+BENCHMARK_FRAMES = 90
+BENCHMARK_FRAMERATE = 30
+BENCHMARK_KEY_INTERVAL = 30
+FRAME_TIMEOUT = 0.5  # seconds to wait for a decoded frame before pushing the next one anyway
+# encoders for the benchmark clip, in order of preference. any of them is fine, the clip only has to be valid h264
+CLIP_ENCODERS = ('x264enc', 'openh264enc', 'avenc_h264', 'vah264enc', 'vaapih264enc', 'v4l2h264enc')
+
+decoder_list = None  # (registry hash, factories) from the last list_h264_decoders()
+
+
+def get_registry_hash():
+    """Changes whenever a plugin is installed, removed or updated. Only looks at plugins, not their elements"""
+    plugins = sorted(f'{plugin.get_name()} {plugin.get_version()} {plugin.get_filename()}'
+                     for plugin in Gst.Registry.get().get_plugin_list())
+    return hashlib.sha1('\n'.join(plugins).encode()).hexdigest()
+
+
+def list_h264_decoders():
+    """
+    Element factories that sink video/x-h264 and source video/x-raw, sorted by name
+
+    Looking at the pad templates of every element takes a while, so the names are cached on disk until the registry
+    changes (see get_registry_hash), and in memory for the rest of the process
+    """
+    global decoder_list
+    registry_hash = get_registry_hash()
+    if decoder_list is not None and decoder_list[0] == registry_hash:
+        return list(decoder_list[1])
+
+    path = os.path.join(get_cache_dir(), DECODER_LIST_FILE)
+    try:
+        with open(path) as cache_file:
+            cached = json.load(cache_file)
+        if cached['registry'] == registry_hash:
+            # finding a factory by name does not load its plugin
+            h264_decoders = [Gst.ElementFactory.find(name) for name in cached['decoders']]
+            if None not in h264_decoders:
+                decoder_list = (registry_hash, h264_decoders)
+                return list(h264_decoders)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    h264_decoders = scan_h264_decoders()
+    decoder_list = (registry_hash, h264_decoders)
+    try:
+        with open(path + '.tmp', 'w') as cache_file:
+            json.dump({'registry': registry_hash, 'decoders': [factory.get_name() for factory in h264_decoders]}, cache_file)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logger.warning(f'could not cache the h264 decoder list: {e}')
+    return list(h264_decoders)
+
+
+def scan_h264_decoders():
+    """list_h264_decoders() without the cache"""
+    h264_decoders = []
+    h264_caps = Gst.Caps.from_string('video/x-h264')
+    for element_factory in Gst.Registry.get().get_feature_list(Gst.ElementFactory):
+        h264_sink = False
+        raw_src = False
+        for pad_template in element_factory.get_static_pad_templates():
+            caps = pad_template.get_caps()
+            if pad_template.direction == Gst.PadDirection.SINK and caps.is_always_compatible(h264_caps):
+                h264_sink = True
+            if pad_template.direction == Gst.PadDirection.SRC and not caps.is_any() and \
+                    any(caps.get_structure(i).get_name() == 'video/x-raw' for i in range(caps.get_size())):
+                raw_src = True
+        if h264_sink and raw_src:
+            h264_decoders.append(element_factory)
+    h264_decoders.sort(key=Gst.ElementFactory.get_name)
+    return h264_decoders
+
+
+def tune_decoder(decoder):
+    """Sets the properties that make a decoder output each frame as soon as it can"""
+    name = decoder.get_factory().get_name()
+    if name == 'vaapih264dec':
+        # vaapi hardware-accelerated h264 decoding
+        # https://en.wikipedia.org/wiki/Video_Acceleration_API
+        try:
+            decoder.set_property('low-latency', True)
+        except TypeError:
+            logger.warning('vaapih264dec property low-latency does not exist, using an old version of libgstvaapi or version compiled without low-latency feature')
+    elif name == 'avdec_h264':
+        # frame threading holds back one frame per thread, slice threading does not
+        if decoder.find_property('thread-type') is not None:
+            Gst.util_set_object_arg(decoder, 'thread-type', 'slice')
+    if decoder.find_property('discard-corrupted-frames') is not None:
+        # a corrupted frame is still better than a frozen one, the client asks for a keyframe anyway
+        decoder.set_property('discard-corrupted-frames', False)
+    return decoder
+
+
+def needs_system_memory(factory):
+    """vaapih264dec has strange bugs with DMABuf output, see VideoWidget.create_decoder_elements"""
+    return factory.get_name() == 'vaapih264dec'
+
+
+def get_fingerprint():
+    """
+    Changes whenever the benchmark results could: a decoder was installed, removed or updated, or this is different
+    hardware. Not the whole registry, so unrelated plugins do not throw the results away
+    """
+    parts = [platform.machine(), platform.processor(), str(os.cpu_count())]
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            parts += sorted(set(line for line in cpuinfo if line.startswith(('model name', 'Hardware', 'Model'))))
+    except OSError:
+        pass
+    try:
+        parts += sorted(os.listdir('/dev/dri'))  # gpus
+    except OSError:
+        pass
+    for factory in list_h264_decoders():
+        plugin = factory.get_plugin()
+        parts.append(f'{factory.get_name()} {plugin.get_version() if plugin is not None else ""}')
+    # without an encoder nothing can be benchmarked, installing one should try again
+    parts += [name for name in CLIP_ENCODERS if Gst.ElementFactory.find(name) is not None]
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
+def encode_clip(width, height, frames=BENCHMARK_FRAMES):
+    """A moving test pattern, encoded to h264 (byte-stream, one frame per buffer). Returns (caps, list of Gst.Buffer)"""
+    for encoder_name in CLIP_ENCODERS:
+        if Gst.ElementFactory.find(encoder_name) is None:
+            continue
+        pipeline = Gst.parse_launch(
+            f'videotestsrc num-buffers={frames} pattern=ball ! '
+            f'video/x-raw,width={width},height={height},framerate={BENCHMARK_FRAMERATE}/1,format=I420 ! '
+            f'{encoder_name} name=encoder ! h264parse ! video/x-h264,stream-format=byte-stream,alignment=au ! '
+            'appsink name=sink sync=false')
+        encoder = pipeline.get_by_name('encoder')
+        if encoder_name == 'x264enc':
+            encoder.set_property('tune', 'zerolatency')
+            encoder.set_property('speed-preset', 'ultrafast')
+        for property_name in ('key-int-max', 'gop-size'):
+            if encoder.find_property(property_name) is not None:
+                encoder.set_property(property_name, BENCHMARK_KEY_INTERVAL)
+        sink = pipeline.get_by_name('sink')
+        pipeline.set_state(Gst.State.PLAYING)
+        caps = None
+        buffers = []
+        while True:
+            sample = sink.emit('try-pull-sample', 5 * Gst.SECOND)
+            if sample is None:
+                break
+            caps = sample.get_caps()
+            buffers.append(sample.get_buffer())
+        pipeline.set_state(Gst.State.NULL)
+        if buffers:
+            return caps, buffers
+        logger.warning(f'{encoder_name} did not encode the benchmark clip')
+    raise RuntimeError(f'no h264 encoder to make the benchmark clip with, install one of {", ".join(CLIP_ENCODERS)}')
+
+
+def benchmark_decoder(factory, caps, buffers):
+    """
+    Decodes the clip one frame at a time, like a live stream: a frame is pushed, and the next one once it came out
+    (or FRAME_TIMEOUT passed). Returns a dict with whether it works, its decode latency and cpu time per frame
+    """
+    result = {'decoder': factory.get_name(), 'works': False}
+    pipeline = Gst.Pipeline.new()
+    appsrc = Gst.ElementFactory.make('appsrc')
+    appsrc.set_property('caps', caps)
+    appsrc.set_property('format', Gst.Format.TIME)
+    decoder = tune_decoder(factory.create())
+    appsink = Gst.ElementFactory.make('appsink')
+    appsink.set_property('sync', False)
+    elements = [appsrc, decoder]
+    if needs_system_memory(factory):
+        post_decoder = Gst.ElementFactory.make('capsfilter')
+        post_decoder.set_property('caps', Gst.Caps.from_string('video/x-raw'))
+        elements.append(post_decoder)
+    elements.append(appsink)
+    for element in elements:
+        pipeline.add(element)
+    for upstream, downstream in zip(elements, elements[1:]):
+        if not upstream.link(downstream):
+            result['error'] = f'cannot link {upstream.get_name()} to {downstream.get_name()}'
+            return result
+
+    push_times = {}
+    latency_stats = RollingStats(len(buffers))
+    frames_decoded = 0
+    if pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+        result['error'] = 'cannot start'
+        pipeline.set_state(Gst.State.NULL)
+        return result
+
+    start_cpu = time.process_time()
+    start = time.monotonic()
+    for buffer in buffers:
+        push_times[buffer.pts] = time.monotonic()
+        if appsrc.emit('push-buffer', buffer) != Gst.FlowReturn.OK:
+            break
+        sample = appsink.emit('try-pull-sample', int(FRAME_TIMEOUT * Gst.SECOND))
+        while sample is not None:
+            push_time = push_times.pop(sample.get_buffer().pts, None)
+            if push_time is not None:
+                latency_stats.add(time.monotonic() - push_time)
+            frames_decoded += 1
+            # the decoder might have held frames back, and let them out together
+            sample = appsink.emit('try-pull-sample', 0)
+    appsrc.emit('end-of-stream')
+    while appsink.emit('try-pull-sample', int(FRAME_TIMEOUT * Gst.SECOND)) is not None:
+        frames_decoded += 1
+    cpu = time.process_time() - start_cpu
+    wall = time.monotonic() - start
+
+    message = pipeline.get_bus().pop_filtered(Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message is not None:
+        result['error'] = str(message.parse_error().gerror)
+        return result
+    if latency_stats.count == 0:
+        result['error'] = 'decoded nothing'
+        return result
+
+    latency = latency_stats.summary()
+    result.update({
+        'works': frames_decoded >= len(buffers) * 0.9,
+        'frames_decoded': frames_decoded,
+        'latency_mean': latency['mean'],
+        'latency_p50': latency['p50'],
+        'latency_p95': latency['p95'],
+        'cpu_per_frame': cpu / len(buffers),
+        'fps': frames_decoded / wall if wall > 0 else 0.0
+    })
+    if not result['works']:
+        result['error'] = f'decoded {frames_decoded} of {len(buffers)} frames'
+    return result
+
+
+def rank(results):
+    """Working decoders first, fastest first. Cpu time only breaks ties between decoders within 1 ms of each other"""
+    working = [result for result in results if result['works']]
+    return sorted(working, key=lambda result: (round(result['latency_p50'] * 1e3), result['cpu_per_frame']))
+
+
+def benchmark_all(width, height, factories=None):
+    """Benchmark results for every h264 decoder at this resolution, best first, then the ones that do not work"""
+    factories = list_h264_decoders() if factories is None else factories
+    caps, buffers = encode_clip(width, height)
+    results = []
+    for factory in factories:
+        logger.info(f'benchmark {factory.get_name()} at {width}x{height}')
+        try:
+            result = benchmark_decoder(factory, caps, buffers)
+        except Exception as e:  # a broken decoder plugin should not stop the others from being tried
+            result = {'decoder': factory.get_name(), 'works': False, 'error': str(e)}
+        if result['works']:
+            logger.info(f'{factory.get_name()}: {result["latency_p50"] * 1e3:.2f} ms p50, '
+                        f'{result["cpu_per_frame"] * 1e3:.2f} ms cpu per frame')
+        else:
+            logger.info(f'{factory.get_name()} does not work: {result.get("error")}')
+        results.append(result)
+    ranked = rank(results)
+    return ranked + [result for result in results if not result['works']]
+
+
+def load_cache():
+    try:
+        with open(os.path.join(get_cache_dir(), CACHE_FILE)) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    path = os.path.join(get_cache_dir(), CACHE_FILE)
+    with open(path + '.tmp', 'w') as cache_file:
+        json.dump(cache, cache_file, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def get_ranking(width, height, benchmark=True, fingerprint=None):
+    """
+    Benchmark results at this resolution, best first, from the cache if this machine and its decoders have not
+    changed since. Otherwise benchmarks (which takes a few seconds) if benchmark is True, or returns None
+    """
+    fingerprint = get_fingerprint() if fingerprint is None else fingerprint
+    key = f'{width}x{height}'
+    cache = load_cache()
+    if cache.get('fingerprint') != fingerprint:
+        cache = {'fingerprint': fingerprint, 'results': {}}
+    results = cache['results'].get(key)
+    if results is None:
+        if not benchmark:
+            return None
+        try:
+            results = benchmark_all(width, height)
+        except RuntimeError as e:
+            logger.warning(f'cannot benchmark h264 decoders: {e}')
+            results = []  # cached as well, so every start does not try again
+        cache['results'][key] = results
+        try:
+            save_cache(cache)
+        except OSError as e:
+            logger.warning(f'could not cache decoder benchmark: {e}')
+    return results
+
+
+def fallback_decoder():
+    """The decoder to use without benchmark results: the software decoder, or else the highest ranked one"""
+    factory = Gst.ElementFactory.find('avdec_h264')
+    if factory is not None:
+        return factory
+    ranked = sorted(list_h264_decoders(), key=Gst.PluginFeature.get_rank, reverse=True)
+    return ranked[0] if ranked else None
+
+
+def select_decoder(width, height, benchmark=True):
+    """
+    The element factory of the fastest working h264 decoder at this resolution. If the benchmark found none that
+    works, fallback_decoder() without benchmarking again. None if benchmark is False and the results are not cached
+    """
+    results = get_ranking(width, height, benchmark)
+    if results is None:
+        return None
+    for result in results:
+        if result['works']:
+            factory = Gst.ElementFactory.find(result['decoder'])
+            if factory is not None:
+                logger.info(f'auto h264 decoder at {width}x{height}: {result["decoder"]}')
+                return factory
+    factory = fallback_decoder()
+    logger.warning(f'no h264 decoder worked in the benchmark at {width}x{height}, '
+                   f'using {factory.get_name() if factory is not None else "none"}')
+    return factory
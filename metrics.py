@@ -0,0 +1,237 @@
+from gi.repository import GLib
+import socket
+import logging
+import bisect
+import collections
+
+logger = logging.getLogger('metrics')
+
+# seconds, for pipeline latency. a frame at 60 fps is 0.0167 s
+DEFAULT_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'  # prometheus text exposition format
+MAX_REQUEST_LEN = 4096  # a scrape request is a few hundred bytes, anything bigger is not a scraper
+REQUEST_TIMEOUT = 10000  # ms a connection gets to send its request and read the response
+MAX_CONNECTIONS = 16  # open at the same time. prometheus scrapes over one connection at a time
+
+
+class Histogram:
+    """
+    Cumulative histogram in the shape prometheus wants it
+
+    observe() is cheap enough for a pad probe: one bisect and two additions, no allocation.
+    The bucket counts are only added up when the histogram is scraped.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """(upper bound, number of observations <= upper bound) for every bucket, ending with +Inf"""
+        total = 0
+        result = []
+        for upper_bound, count in zip(self.buckets + (float('inf'),), list(self.counts)):
+            total += count
+            result.append((upper_bound, total))
+        return result
+
+
+class Metric:
+    """One metric family: a name, a type (counter, gauge or histogram) and its samples, by label values"""
+
+    def __init__(self, name, metric_type, help_text):
+        self.name = name
+        self.metric_type = metric_type
+        self.help_text = help_text
+        self.samples = []  # (labels dict, value or Histogram)
+
+    def add(self, value, **labels):
+        self.samples.append((labels, value))
+        return self
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels.keys(), escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_metrics(metrics):
+    """Prometheus text exposition format for a list of Metric"""
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.help_text}')
+        lines.append(f'# TYPE {metric.name} {metric.metric_type}')
+        for labels, value in metric.samples:
+            if isinstance(value, Histogram):
+                for upper_bound, count in value.cumulative_counts():
+                    lines.append(f'{metric.name}_bucket{format_labels({**labels, "le": format_value(upper_bound)})} {count}')
+                lines.append(f'{metric.name}_sum{format_labels(labels)} {format_value(value.sum)}')
+                lines.append(f'{metric.name}_count{format_labels(labels)} {value.count}')
+            else:
+                lines.append(f'{metric.name}{format_labels(labels)} {format_value(value)}')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+class MetricsConnection:
+    """
+    One http request from a scraper. Reads the request line, answers, and closes
+
+    Closed without an answer if the request is bigger than MAX_REQUEST_LEN, or if the whole exchange takes longer
+    than timeout ms, so a client that connects and sends nothing does not hold the socket forever
+    """
+
+    def __init__(self, sock, collect, timeout=REQUEST_TIMEOUT, on_close=None):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.collect = collect
+        self.on_close = on_close
+        self.request = b''
+        self.response = None
+        self.listener_id = GLib.io_add_watch(self.sock, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.in_listener)
+        self.timeout_id = GLib.timeout_add(timeout, self.timeout_handler)
+
+    def in_listener(self, sock, condition):
+        try:
+            data = sock.recv(MAX_REQUEST_LEN + 1 - len(self.request))
+        except BlockingIOError:
+            return GLib.SOURCE_CONTINUE
+        except IOError as e:
+            logger.warning(f'metrics connection: {e}')
+            return self.close()
+        if not data:
+            return self.close()
+        self.request += data
+        if len(self.request) > MAX_REQUEST_LEN:
+            logger.warning('metrics connection: request too big')
+            return self.close()
+        if b'\r\n\r\n' not in self.request and b'\n\n' not in self.request:
+            return GLib.SOURCE_CONTINUE
+
+        request_line = self.request.split(b'\n', 1)[0].decode('latin-1').split()
+        if len(request_line) < 2 or request_line[0] not in ('GET', 'HEAD'):
+            self.response = self.build_response('405 Method Not Allowed', b'')
+        elif request_line[1].split('?', 1)[0] != '/metrics':
+            self.response = self.build_response('404 Not Found', b'')
+        else:
+            body = format_metrics(self.collect()).encode()
+            self.response = self.build_response('200 OK', body if request_line[0] == 'GET' else b'', len(body))
+        self.response = memoryview(self.response)
+        self.listener_id = GLib.io_add_watch(self.sock, GLib.IO_OUT | GLib.IO_HUP | GLib.IO_ERR, self.out_listener)
+        return GLib.SOURCE_REMOVE
+
+    @staticmethod
+    def build_response(status, body, content_length=None):
+        headers = (f'HTTP/1.1 {status}\r\n'
+                   f'Content-Type: {CONTENT_TYPE}\r\n'
+                   f'Content-Length: {len(body) if content_length is None else content_length}\r\n'
+                   'Connection: close\r\n\r\n')
+        return headers.encode() + body
+
+    def out_listener(self, sock, condition):
+        # the response usually fits in the socket buffer, so this sends it all on the first try
+        try:
+            sent = sock.send(self.response)
+        except BlockingIOError:
+            return GLib.SOURCE_CONTINUE
+        except IOError as e:
+            logger.warning(f'metrics connection: {e}')
+            return self.close()
+        self.response = self.response[sent:]
+        if len(self.response) > 0:
+            return GLib.SOURCE_CONTINUE
+        return self.close()
+
+    def timeout_handler(self):
+        self.timeout_id = None
+        logger.warning('metrics connection: timed out')
+        GLib.source_remove(self.listener_id)
+        self.close()
+        return GLib.SOURCE_REMOVE
+
+    def close(self):
+        """Returns SOURCE_REMOVE, for the listener that calls it"""
+        if self.timeout_id is not None:
+            GLib.source_remove(self.timeout_id)
+            self.timeout_id = None
+        self.listener_id = None
+        self.sock.close()
+        if self.on_close:
+            self.on_close(self)
+        return GLib.SOURCE_REMOVE
+
+
+class MetricsServer:
+    """
+    Serves GET /metrics in the prometheus text format, on the GLib main loop
+
+    collect is called on the main loop for every scrape and returns a list of Metric. It should only read numbers the
+    streaming threads already keep up to date, so scraping never adds work to them.
+    """
+
+    def __init__(self, host, port, collect, request_timeout=REQUEST_TIMEOUT):
+        self.collect = collect
+        self.request_timeout = request_timeout
+        self.connections = set()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(5)
+        self.sock.setblocking(False)
+        logger.info(f'metrics on http://{host or "0.0.0.0"}:{port}/metrics')
+        self.listener_id = GLib.io_add_watch(self.sock, GLib.IO_IN, self.new_conn_listener)
+
+    def new_conn_listener(self, server_sock, *args):
+        try:
+            conn, addr = server_sock.accept()
+        except BlockingIOError:
+            return GLib.SOURCE_CONTINUE
+        if len(self.connections) >= MAX_CONNECTIONS:
+            logger.warning(f'metrics: {len(self.connections)} connections open already, closing new one from {addr[0]}')
+            conn.close()
+            return GLib.SOURCE_CONTINUE
+        self.connections.add(MetricsConnection(conn, self.collect, self.request_timeout, self.connections.discard))
+        return GLib.SOURCE_CONTINUE
+
+    def close(self):
+        GLib.source_remove(self.listener_id)
+        self.sock.close()
+        for connection in list(self.connections):
+            GLib.source_remove(connection.listener_id)
+            connection.close()
+
+
+def counter(name, help_text):
+    return Metric(name, 'counter', help_text)
+
+
+def gauge(name, help_text):
+    return Metric(name, 'gauge', help_text)
+
+
+def histogram(name, help_text):
+    return Metric(name, 'histogram', help_text)
+
+
+def counter_by_label(name, help_text, label, counts: collections.Counter):
+    metric = counter(name, help_text)
+    for label_value, count in sorted(counts.items()):
+        metric.add(count, **{label: label_value})
+    return metric
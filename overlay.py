@@ -1,23 +1,60 @@
+import os
+import sys
+import ast
+import json
+import time
 import cairo
 import pkgutil
+import logging
 import importlib
 import overlays
 import inspect
+from common import get_cache_dir
+
+logger = logging.getLogger('overlay')
+
+MANIFEST_FILE = 'overlays.json'
+SCAN_VERSION = 2  # part of each module's manifest key, so a change to scan_module scans every module again
 
 
 class Overlay:
     CTX_WIDTH = 640
     CTX_HEIGHT = 480
 
+    vision_result = None
+    # True if draw() draws something different every frame, even for the same vision result (an animation, a clock).
+    # Otherwise the gl overlay mode only calls draw() again once the vision result changes
+    animated = False
+
+    def set_vision_result(self, vision_result):
+        """
+        Called before each draw with the rpividctrl_lib.messaging.VisionResult from the server for the frame being
+        displayed, or the newest one from before it. None if there is none"""
+        self.vision_result = vision_result
+
+    def draw_static(self, ctx: cairo.Context):
+        """
+        Draws the parts of the overlay that do not change from frame to frame (guides, crosshairs, labels)
+
+        Called once, and again only when the window is resized or the video size changes. The result is cached and
+        painted under whatever draw() draws, so anything here costs nothing per frame. Same coordinates as draw()"""
+        pass
+
     def draw(self, ctx: cairo.Context):
         """
-        Called many times per second to draw the overlay
+        Called many times per second to draw the parts of the overlay that change, like vision results
 
         The top left corner of the video stream is (0, 0)
         and the bottom right corner is (Overlay.CTX_WIDTH, Overlay.CTX_HEIGHT)
 
         cairo.Context docs: https://pycairo.readthedocs.io/en/latest/reference/context.html"""
-        raise NotImplementedError
+        pass
+
+    def has_static_layer(self):
+        return type(self).draw_static is not Overlay.draw_static
+
+    def has_dynamic_layer(self):
+        return type(self).draw is not Overlay.draw
 
     @staticmethod
     def get_display_name() -> str:
@@ -25,14 +62,119 @@ class Overlay:
 
     @staticmethod
     def list_plugins():
-        """Lists all overlays found in the overlays directory"""
+        """
+        Lists all overlays found in the overlays directory, as OverlayPlugin, without importing them
+
+        Each module is read with ast instead of imported, so a heavy overlay (numpy, opencv) only costs startup time
+        once it is picked. A module is only imported here if one of its Overlay subclasses does not return a plain
+        string from get_display_name. Either way the result is cached on disk until the module changes.
+        """
         # https://packaging.python.org/guides/creating-and-discovering-plugins/
 
-        plugins = set()
+        start = time.perf_counter()
+        manifest = load_manifest()
+        new_manifest = {}
+        plugins = []
+        num_scanned = 0
         for finder, name, ispkg in pkgutil.iter_modules(overlays.__path__, overlays.__name__ + '.'):
-            module = importlib.import_module(name)
-            for cls_name, cls in module.__dict__.items():
-                if inspect.isclass(cls) and issubclass(cls, Overlay) and not cls == Overlay:
-                    plugins.add(cls)
+            path = os.path.join(finder.path, name.rsplit('.', 1)[1] + '.py')
+            try:
+                stat = os.stat(path)
+                key = [SCAN_VERSION, stat.st_mtime_ns, stat.st_size]
+            except OSError:
+                key = None  # a package or an extension module, always imported
+            entry = manifest.get(name)
+            if key is None or entry is None or entry['key'] != key:
+                entry = {'key': key, 'plugins': scan_module(path, name) if key is not None else None}
+                if entry['plugins'] is None:
+                    entry['plugins'] = import_module_plugins(name)
+                num_scanned += 1
+            new_manifest[name] = entry
+            plugins += [OverlayPlugin(display_name, name, class_name) for display_name, class_name in entry['plugins']]
+
+        if new_manifest != manifest:
+            save_manifest(new_manifest)
+        logger.info(f'found {len(plugins)} overlays in {(time.perf_counter() - start) * 1e3:.1f} ms '
+                    f'({num_scanned} of {len(new_manifest)} modules scanned, the rest cached)')
+        return sorted(plugins, key=lambda plugin: plugin.display_name)
+
+
+class OverlayPlugin:
+    """An overlay in the overlays directory. Its module is imported the first time load() is called"""
+
+    def __init__(self, display_name, module_name, class_name):
+        self.display_name = display_name
+        self.module_name = module_name
+        self.class_name = class_name
+
+    def load(self):
+        """The Overlay subclass"""
+        if self.module_name in sys.modules:
+            return getattr(sys.modules[self.module_name], self.class_name)
+        start = time.perf_counter()
+        module = importlib.import_module(self.module_name)
+        logger.info(f'imported {self.module_name} in {(time.perf_counter() - start) * 1e3:.1f} ms')
+        return getattr(module, self.class_name)
+
+
+def scan_module(path, module_name):
+    """
+    [display name, class name] for every class in the module that subclasses Overlay by name, read with ast.
+    None if the module has to be imported to know: a display name is not a plain string, or a class derives from
+    something other than Overlay (class Mine(TestLinesOverlay) is an overlay too, which ast cannot tell)
+    """
+    try:
+        with open(path, 'rb') as module_file:
+            tree = ast.parse(module_file.read(), path)
+    except (OSError, SyntaxError) as e:
+        logger.warning(f'could not read overlay module {module_name}: {e}')
+        return []
+
+    plugins = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        base_names = [base.id if isinstance(base, ast.Name) else getattr(base, 'attr', None) for base in node.bases]
+        if not base_names:
+            continue  # cannot be an overlay
+        if 'Overlay' not in base_names:
+            return None
+        display_name = None
+        for item in node.body:
+            if isinstance(item, ast.FunctionDef) and item.name == 'get_display_name' and len(item.body) > 0:
+                returned = item.body[-1]
+                if isinstance(returned, ast.Return) and isinstance(returned.value, ast.Constant) and \
+                        isinstance(returned.value.value, str):
+                    display_name = returned.value.value
+        if display_name is None:
+            return None
+        plugins.append([display_name, node.name])
+    return plugins
+
+
+def import_module_plugins(module_name):
+    """[display name, class name] for every Overlay subclass in the module, by importing it"""
+    module = importlib.import_module(module_name)
+    plugins = []
+    for cls_name, cls in module.__dict__.items():
+        if inspect.isclass(cls) and issubclass(cls, Overlay) and not cls == Overlay and cls.__module__ == module_name:
+            plugins.append([cls.get_display_name(), cls.__name__])
+    return plugins
+
+
+def load_manifest():
+    try:
+        with open(os.path.join(get_cache_dir(), MANIFEST_FILE)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
 
-        return plugins
+def save_manifest(manifest):
+    path = os.path.join(get_cache_dir(), MANIFEST_FILE)
+    try:
+        with open(path + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logger.warning(f'could not cache the overlay manifest: {e}')
@@ -4,7 +4,7 @@ import math
 
 
 class TestLinesOverlay(Overlay):
-    def draw(self, ctx: cairo.Context):
+    def draw_static(self, ctx: cairo.Context):
 
         ctx.set_source_rgb(0, 0, 1)
         ctx.arc(Overlay.CTX_WIDTH / 2, Overlay.CTX_HEIGHT / 2, 20, 0, 2 * math.pi)
@@ -30,8 +30,6 @@ class TestLinesOverlay(Overlay):
         ctx.curve_to(300, 300, 200, 100, 50, 200)
         ctx.stroke()
 
-        pass
-
     @staticmethod
     def get_display_name() -> str:
         return 'test lines'
@@ -0,0 +1,33 @@
+from overlay import Overlay
+import cairo
+import math
+
+
+class VisionTargetsOverlay(Overlay):
+    """Draws what the vision plugins on the server found, lined up with the frame they found it in"""
+
+    def draw(self, ctx: cairo.Context):
+        if self.vision_result is None:
+            return
+
+        ctx.set_line_width(2)
+        for detection in self.vision_result.detections:
+            ctx.set_source_rgba(0, 1, 0, max(detection.confidence, 0.3))
+            x = detection.x * Overlay.CTX_WIDTH
+            y = detection.y * Overlay.CTX_HEIGHT
+            width = detection.width * Overlay.CTX_WIDTH
+            height = detection.height * Overlay.CTX_HEIGHT
+            if width == 0 and height == 0:
+                # a point, draw a crosshair
+                ctx.arc(x, y, 10, 0, 2 * math.pi)
+                ctx.move_to(x - 15, y)
+                ctx.line_to(x + 15, y)
+                ctx.move_to(x, y - 15)
+                ctx.line_to(x, y + 15)
+            else:
+                ctx.rectangle(x, y, width, height)
+            ctx.stroke()
+
+    @staticmethod
+    def get_display_name() -> str:
+        return 'vision targets'
@@ -0,0 +1,176 @@
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+import os
+import html
+import json
+import time
+import logging
+import threading
+from stats import RollingStats
+
+logger = logging.getLogger('profiling')
+
+# latency: time from each source to each sink (pipeline), and time spent in each element (element)
+# rusage: cpu load of the process
+TRACERS = 'latency(flags=pipeline+element);rusage'
+PROFILE_SAMPLES = 1000  # percentiles are over the last n samples of each metric
+QUEUE_SAMPLE_INTERVAL = 100  # ms between reading the level of every queue
+
+# section -> (title, unit, multiplier from the stored value to the unit)
+REPORT_SECTIONS = {
+    'pipeline_latency': ('pipeline latency', 'ms', 1e3),
+    'element_processing_time': ('element processing time', 'ms', 1e3),
+    'queue_levels': ('queue levels', 'buffers', 1),
+    'cpu_load': ('cpu load', '%', 1)
+}
+
+
+def setup_environment(tracers=TRACERS):
+    """Turns the tracers on. Has to be called before Gst.init"""
+    os.environ['GST_TRACERS'] = tracers
+    # tracers log their records in the GST_TRACER category at TRACE level
+    gst_debug = os.environ.get('GST_DEBUG')
+    os.environ['GST_DEBUG'] = f'{gst_debug},GST_TRACER:7' if gst_debug else 'GST_TRACER:7'
+
+
+class Profiler:
+    """
+    Collects the records of the GStreamer tracers in this process, and the levels of the queues in a pipeline
+
+    Replaces the default GStreamer log function while it runs, so tracer records are aggregated here instead of
+    printed. Everything else is passed on to the default log function.
+    """
+
+    def __init__(self, name, pipeline=None):
+        self.name = name
+        self.pipeline = pipeline  # queues are sampled from this pipeline, if set
+        self.lock = threading.Lock()  # tracer records come in on the streaming threads
+        self.sections = {section: {} for section in REPORT_SECTIONS}  # section -> key -> RollingStats
+        self.start_time = None
+        self.start_wall_time = None
+        self.queue_timer_id = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.start_time = time.monotonic()
+        self.start_wall_time = time.time()
+        Gst.debug_remove_log_function(None)
+        Gst.debug_add_log_function(self.log_function, None)
+        self.queue_timer_id = GLib.timeout_add(QUEUE_SAMPLE_INTERVAL, self.sample_queues)
+        logger.info(f'profiling with tracers {os.environ.get("GST_TRACERS")}')
+
+    def stop(self):
+        """Stops collecting. The log function stays installed, but passes everything on to the default one"""
+        self.running = False
+        if self.queue_timer_id is not None:
+            GLib.source_remove(self.queue_timer_id)
+            self.queue_timer_id = None
+
+    def add(self, section, key, value):
+        with self.lock:
+            metrics = self.sections[section]
+            stats = metrics.get(key)
+            if stats is None:
+                stats = metrics[key] = RollingStats(PROFILE_SAMPLES)
+            stats.add(value)
+
+    def log_function(self, category, level, file, function, line, obj, message, *user_data):
+        if not self.running or category.get_name() != 'GST_TRACER':
+            Gst.debug_log_default(category, level, file, function, line, obj, message, None)
+            return
+        record = Gst.Structure.new_from_string(message.get())
+        if record is None:
+            return
+        record_name = record.get_name()
+        if record_name == 'latency':
+            self.add('pipeline_latency', f'{record.get_string("src-element")} -> {record.get_string("sink-element")}',
+                     record.get_value('time') / Gst.SECOND)
+        elif record_name == 'element-latency':
+            self.add('element_processing_time', record.get_string('element'), record.get_value('time') / Gst.SECOND)
+        elif record_name == 'proc-rusage':
+            self.add('cpu_load', 'process', record.get_value('current-cpuload') / 10)  # per mille
+
+    def sample_queues(self):
+        if self.pipeline is not None:
+            iterator = self.pipeline.iterate_recurse()
+            while True:
+                iterator_result, element = iterator.next()
+                if iterator_result != Gst.IteratorResult.OK:
+                    break
+                factory = element.get_factory()
+                if factory is not None and factory.get_name() in ('queue', 'queue2'):
+                    self.add('queue_levels', element.get_name(), element.get_property('current-level-buffers'))
+        return GLib.SOURCE_CONTINUE
+
+    def report(self):
+        """A summary of everything collected so far, only made of json types"""
+        with self.lock:
+            sections = {section: {key: {'samples': stats.count, **stats.summary()} for key, stats in metrics.items()}
+                        for section, metrics in self.sections.items()}
+        return {
+            'name': self.name,
+            'tracers': os.environ.get('GST_TRACERS'),
+            'start_time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start_wall_time)) if self.start_wall_time else None,
+            'duration': time.monotonic() - self.start_time if self.start_time is not None else 0,
+            **sections
+        }
+
+
+def report_to_html(report):
+    """A self-contained html page with a table for every section of the report"""
+    parts = [f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{html.escape(report["name"])} profile</title>',
+             '<style>body{font-family:sans-serif}table{border-collapse:collapse;margin-bottom:2em}'
+             'td,th{padding:2px 8px;text-align:right}td:first-child,th:first-child{text-align:left}'
+             '.bar{background:#4a90d9;height:10px}</style></head><body>',
+             f'<h1>{html.escape(report["name"])}</h1>',
+             f'<p>started {html.escape(str(report["start_time"]))}, {report["duration"]:.1f} s, '
+             f'tracers {html.escape(str(report["tracers"]))}</p>']
+    for section, (title, unit, multiplier) in REPORT_SECTIONS.items():
+        metrics = report.get(section) or {}
+        parts.append(f'<h2>{title} ({unit})</h2>')
+        if not metrics:
+            parts.append('<p>no samples</p>')
+            continue
+        largest = max(summary['p99'] for summary in metrics.values()) or 1
+        parts.append('<table><tr><th></th><th>mean</th><th>p50</th><th>p95</th><th>p99</th><th>max</th><th>samples</th><th></th></tr>')
+        for key, summary in sorted(metrics.items(), key=lambda item: item[1]['mean'], reverse=True):
+            values = ''.join(f'<td>{summary[field] * multiplier:.2f}</td>' for field in ('mean', 'p50', 'p95', 'p99', 'max'))
+            bar_width = min(summary['mean'] / largest, 1) * 200
+            parts.append(f'<tr><td>{html.escape(key)}</td>{values}<td>{summary["samples"]}</td>'
+                         f'<td><div class="bar" style="width:{bar_width:.0f}px"></div></td></tr>')
+        parts.append('</table>')
+    parts.append('</body></html>')
+    return '\n'.join(parts)
+
+
+def write_report(report, directory):
+    """Writes <name>_profile.json and <name>_profile.html to directory"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{report["name"]}_profile')
+    with open(path + '.json', 'w') as json_file:
+        json.dump(report, json_file, indent=2)
+    with open(path + '.html', 'w') as html_file:
+        html_file.write(report_to_html(report))
+    logger.info(f'wrote profile to {path}.json and {path}.html')
+
+
+class StartupProfile:
+    """Wall time of each step of startup, for --startup-profile. Each step is the time since the one before it"""
+
+    def __init__(self, start_time):
+        self.start_time = start_time  # time.perf_counter() when the process started importing
+        self.last_time = start_time
+        self.steps = []
+
+    def step(self, name):
+        now = time.perf_counter()
+        self.steps.append((name, now - self.last_time))
+        self.last_time = now
+
+    def report(self):
+        lines = [f'{name:<32} {duration * 1e3:8.1f} ms' for name, duration in self.steps]
+        lines.append(f'{"total":<32} {(self.last_time - self.start_time) * 1e3:8.1f} ms')
+        return '\n'.join(lines)
@@ -0,0 +1,468 @@
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+import os
+import time
+import logging
+import threading
+import collections
+from common import get_pad
+
+logger = logging.getLogger('recording')
+
+# file format -> (muxer, file extension)
+# matroska is the default, because a file cut short (power loss, full sd card) can still be played.
+# an mp4 file is only playable once the muxer has finished it
+FILE_FORMATS = {
+    'mkv': ('matroskamux', 'mkv'),
+    'mp4': ('mp4mux', 'mp4')
+}
+QUEUE_MAX_TIME = 2 * Gst.SECOND  # how far the file can fall behind before frames are dropped
+WRITER_MAX_BYTES = 8 * 1024 * 1024  # waiting in a FileWriter's appsrc before frames are dropped
+STOP_TIMEOUT = 5000  # ms to wait for the muxer to finish the last file, it never does if no frame got to it
+REPLAY_MAX_BYTES = 64 * 1024 * 1024  # older groups of pictures are dropped past this, even if they are within the time
+
+
+def rebase_timestamps(buffer, first_pts):
+    """
+    A copy of buffer with its timestamps moved so that first_pts is 0, so files start at 0. The buffers are shared with
+    the other branches of the tee, so they are copied to change their timestamps (the copy shares the memory)
+    """
+    buffer = buffer.copy()
+    buffer.pts -= first_pts
+    buffer.dts = Gst.CLOCK_TIME_NONE if buffer.dts == Gst.CLOCK_TIME_NONE else max(buffer.dts - first_pts, 0)
+    return buffer
+
+
+class FileWriter:
+    """
+    Writes h264 frames to files, in a pipeline of its own
+
+    appsrc -> h264parse -> splitmuxsink (muxer -> filesink)
+
+    Nothing in this pipeline can return an error into the pipeline the frames come from, so a failed write (a full sd
+    card) or a muxer refusing something only ends this pipeline. The muxers cannot change caps in the middle of a file,
+    so a FileWriter takes frames with one caps, and Recorder starts a new one when the caps change.
+
+    on_done is called on the main loop once the last file is finished (after finish()), with None, or with the error
+    if the pipeline failed. on_keyframe_request is called with splitmuxsink's force key unit events, which have to go
+    to the encoder in the other pipeline.
+    """
+
+    def __init__(self, caps, location, muxer_factory, segment_time, segment_size):
+        self.caps = caps
+        self.on_done = None
+        self.on_keyframe_request = None
+        self.first_pts = None
+        self.last_pts = None
+        self.skip_to_keyframe = False  # after dropping a frame, the ones depending on it cannot be decoded either
+
+        self.pipeline = Gst.parse_launch('appsrc name=src format=time ! h264parse ! splitmuxsink name=sink')
+        self.appsrc = self.pipeline.get_by_name('src')
+        self.appsrc.set_property('caps', caps)
+        self.appsrc.set_property('max-bytes', WRITER_MAX_BYTES)
+        sink = self.pipeline.get_by_name('sink')
+        sink.set_property('muxer-factory', muxer_factory)
+        sink.set_property('location', location)
+        sink.set_property('max-size-time', int(segment_time * Gst.SECOND))
+        sink.set_property('max-size-bytes', int(segment_size))
+        # ask the encoder for a keyframe when it is time to split, instead of waiting for the next one
+        sink.set_property('send-keyframe-requests', segment_time > 0 and segment_size == 0)
+        get_pad(self.appsrc.iterate_src_pads()).add_probe(Gst.PadProbeType.EVENT_UPSTREAM, self.upstream_event_probe)
+
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message::eos', self.on_eos)
+        bus.connect('message::error', self.on_error)
+        bus.connect('message::element', self.on_element_message)
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def push(self, buffer):
+        """Queues buffer to be written. Returns False if it was dropped, because the files are written too slowly"""
+        if self.first_pts is None:
+            self.first_pts = buffer.pts
+        self.last_pts = buffer.pts
+        keyframe = not buffer.has_flags(Gst.BufferFlags.DELTA_UNIT)
+        if self.appsrc.get_property('current-level-bytes') > WRITER_MAX_BYTES:
+            self.skip_to_keyframe = True
+            return False
+        if self.skip_to_keyframe:
+            if not keyframe:
+                return False
+            self.skip_to_keyframe = False
+        return self.appsrc.emit('push-buffer', rebase_timestamps(buffer, self.first_pts)) == Gst.FlowReturn.OK
+
+    def finish(self):
+        """No more frames. The muxer finishes the last file, then on_done is called"""
+        self.appsrc.emit('end-of-stream')
+
+    def close(self):
+        bus = self.pipeline.get_bus()
+        bus.remove_signal_watch()
+        self.pipeline.set_state(Gst.State.NULL)
+
+    def upstream_event_probe(self, pad, probe_info):
+        event = probe_info.get_event()
+        structure = event.get_structure()
+        if event.type == Gst.EventType.CUSTOM_UPSTREAM and structure is not None and \
+                structure.get_name() == 'GstForceKeyUnit':
+            if self.on_keyframe_request is not None:
+                self.on_keyframe_request(event)
+            return Gst.PadProbeReturn.DROP
+        return Gst.PadProbeReturn.OK
+
+    def on_element_message(self, bus, message):
+        structure = message.get_structure()
+        if structure is not None and structure.get_name() == 'splitmuxsink-fragment-closed':
+            logger.info(f'recorded {structure.get_string("location")}')
+
+    def on_eos(self, bus, message):
+        if self.on_done is not None:
+            self.on_done(self, None)
+
+    def on_error(self, bus, message):
+        if self.on_done is not None:
+            self.on_done(self, str(message.parse_error().gerror))
+
+
+class Recorder:
+    """
+    Records the h264 coming out of a tee to files, without re-encoding
+
+    tee -> queue (leaky) -> appsink  ~>  FileWriter: appsrc -> h264parse -> splitmuxsink (muxer -> filesink)
+
+    The files are written by pipelines of their own, so recording can never hold up or stop the other branches of the
+    tee: the appsink always returns OK, and the queue drops old frames instead of blocking when the files are written
+    too slowly (a slow sd card). A write error stops the recording, not the stream. A new resolution (or timestamps
+    starting over, after the pipeline was stopped) finishes the current file and continues in a new one, named _partN.
+    Files are split every segment_time seconds and/or segment_size bytes, at a keyframe. 0 turns either limit off.
+
+    The branch is only in the pipeline while recording. Stopping removes it and lets the muxer finish the last file.
+    on_stopped is called once it has, on the main loop.
+    """
+
+    def __init__(self, pipeline, tee, directory, prefix, file_format='mkv', segment_time=60, segment_size=0):
+        if file_format not in FILE_FORMATS:
+            raise ValueError(f'unknown recording format {file_format}')
+        self.pipeline = pipeline
+        self.tee = tee
+        self.directory = directory
+        self.prefix = prefix
+        self.muxer_factory, self.extension = FILE_FORMATS[file_format]
+        self.segment_time = segment_time
+        self.segment_size = segment_size
+        self.on_stopped = None
+
+        self.started = False
+        self.stopping = False
+        self.tee_pad = None
+        self.queue = None
+        self.appsink = None
+        self.stop_timeout_id = None
+        self.lock = threading.Lock()  # samples come in on the queue's thread
+        self.writer = None  # FileWriter the frames go to, created on the first keyframe
+        self.finishing_writers = []  # still finishing their last file
+        self.location_stamp = None
+        self.num_writers = 0
+        self.frames_in = 0  # counted on the tee's streaming thread
+        self.frames_out = 0  # counted on the queue's streaming thread
+        self.writer_frames_dropped = 0
+        self.frames_dropped_before = 0  # by earlier recordings
+
+    @property
+    def recording(self):
+        """True from start() until stop()"""
+        return self.started and not self.stopping
+
+    @property
+    def active(self):
+        """True from start() until the last file is finished"""
+        return self.started
+
+    @property
+    def frames_dropped(self):
+        dropped = self.frames_dropped_before + self.writer_frames_dropped
+        if self.queue is not None:
+            dropped += max(self.frames_in - self.frames_out - self.queue.get_property('current-level-buffers'), 0)
+        return dropped
+
+    def start(self):
+        if self.active:
+            logger.warning('already recording')
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        self.location_stamp = time.strftime("%Y%m%d_%H%M%S")
+        self.num_writers = 0
+        logger.info(f'start recording to {self.get_location()}')
+
+        self.queue = Gst.ElementFactory.make('queue')
+        self.queue.set_property('leaky', 2)  # 2==downstream, drop old buffers
+        self.queue.set_property('max-size-buffers', 0)
+        self.queue.set_property('max-size-bytes', 0)
+        self.queue.set_property('max-size-time', QUEUE_MAX_TIME)
+        self.appsink = Gst.ElementFactory.make('appsink')
+        self.appsink.set_property('sync', False)
+        self.appsink.set_property('async', False)  # the new branch does not change the state of the pipeline
+        self.appsink.set_property('emit-signals', True)
+        self.appsink.connect('new-sample', self.on_new_sample)
+
+        self.frames_in = 0
+        self.frames_out = 0
+        self.writer_frames_dropped = 0
+        self.started = True
+        self.stopping = False
+        for element in (self.queue, self.appsink):
+            self.pipeline.add(element)
+        self.queue.link(self.appsink)
+        get_pad(self.queue.iterate_sink_pads()).add_probe(Gst.PadProbeType.BUFFER, self.queue_in_probe)
+        get_pad(self.queue.iterate_src_pads()).add_probe(Gst.PadProbeType.BUFFER, self.queue_out_probe)
+        for element in (self.appsink, self.queue):
+            element.sync_state_with_parent()
+
+        self.tee_pad = self.tee.request_pad(self.tee.get_pad_template('src_%u'), None, None)
+        self.tee_pad.link(get_pad(self.queue.iterate_sink_pads()))
+        return True
+
+    def get_location(self):
+        part = f'_part{self.num_writers + 1}' if self.num_writers > 0 else ''
+        return os.path.join(self.directory, f'{self.prefix}_{self.location_stamp}{part}_%05d.{self.extension}')
+
+    def stop(self):
+        if not self.recording:
+            return False
+        logger.info('stop recording')
+        with self.lock:
+            self.stopping = True
+        # unlink once no buffer is going through the tee pad, then let the muxer finish the file
+        self.tee_pad.add_probe(Gst.PadProbeType.IDLE, self.unlink_probe)
+        self.stop_timeout_id = GLib.timeout_add(STOP_TIMEOUT, self.stop_timeout_handler)
+        return True
+
+    def stop_timeout_handler(self):
+        self.stop_timeout_id = None
+        logger.warning('muxer did not finish the last file in time')
+        self.remove_branch()
+        for writer in self.finishing_writers:
+            writer.close()
+        self.finishing_writers.clear()
+        self.check_stopped()
+        return GLib.SOURCE_REMOVE
+
+    def unlink_probe(self, pad, probe_info):
+        queue = self.queue
+        if queue is None:
+            return Gst.PadProbeReturn.REMOVE  # removed by stop_timeout_handler already
+        pad.unlink(get_pad(queue.iterate_sink_pads()))
+        GLib.idle_add(self.remove_branch)
+        return Gst.PadProbeReturn.REMOVE
+
+    def remove_branch(self):
+        if self.tee_pad is None:
+            return GLib.SOURCE_REMOVE  # already removed
+        queue_pad = get_pad(self.queue.iterate_sink_pads())
+        if self.tee_pad.is_linked():
+            self.tee_pad.unlink(queue_pad)
+        self.tee.release_request_pad(self.tee_pad)
+        self.tee_pad = None
+        self.frames_dropped_before = self.frames_dropped
+        self.writer_frames_dropped = 0
+        for element in (self.queue, self.appsink):
+            element.set_state(Gst.State.NULL)
+            self.pipeline.remove(element)
+        self.queue = None
+        self.appsink = None
+        with self.lock:
+            if self.writer is not None:
+                self.finish_writer()
+        self.check_stopped()
+        return GLib.SOURCE_REMOVE
+
+    def check_stopped(self):
+        if not self.stopping or self.tee_pad is not None or self.finishing_writers:
+            return
+        if self.stop_timeout_id is not None:
+            GLib.source_remove(self.stop_timeout_id)
+            self.stop_timeout_id = None
+        self.started = False
+        self.stopping = False
+        logger.info('recording stopped')
+        if self.on_stopped is not None:
+            self.on_stopped()
+
+    def queue_in_probe(self, pad, probe_info):
+        self.frames_in += 1
+        return Gst.PadProbeReturn.OK
+
+    def queue_out_probe(self, pad, probe_info):
+        self.frames_out += 1
+        return Gst.PadProbeReturn.OK
+
+    def on_new_sample(self, appsink):
+        sample = appsink.emit('pull-sample')
+        buffer = sample.get_buffer()
+        if buffer.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.FlowReturn.OK
+        with self.lock:
+            if self.stopping:
+                return Gst.FlowReturn.OK
+            caps = sample.get_caps()
+            if self.writer is not None and (not caps.is_equal(self.writer.caps) or buffer.pts < self.writer.last_pts):
+                # a new resolution, or the pipeline started its timestamps over: the muxer cannot continue the file
+                self.finish_writer()
+            if self.writer is None:
+                if buffer.has_flags(Gst.BufferFlags.DELTA_UNIT):
+                    return Gst.FlowReturn.OK  # a file has to start with a keyframe
+                self.writer = FileWriter(caps, self.get_location(), self.muxer_factory, self.segment_time, self.segment_size)
+                self.writer.on_done = self.on_writer_done
+                self.writer.on_keyframe_request = self.on_keyframe_request
+                self.num_writers += 1
+            if not self.writer.push(buffer):
+                self.writer_frames_dropped += 1
+        return Gst.FlowReturn.OK  # whatever happens to the files, the stream goes on
+
+    def finish_file(self):
+        """Finishes the current file with eos, the recording goes on in a new part
+
+        Call before the pipeline's timestamps start over, for example before setting it to NULL.
+        """
+        with self.lock:
+            if self.writer is not None:
+                self.finish_writer()
+
+    def finish_writer(self):
+        """Call with self.lock held"""
+        self.finishing_writers.append(self.writer)
+        self.writer.finish()
+        self.writer = None
+
+    def on_keyframe_request(self, event):
+        queue = self.queue
+        if queue is not None:
+            # upstream from the queue, through the tee, to the encoder
+            get_pad(queue.iterate_sink_pads()).push_event(event)
+
+    def on_writer_done(self, writer, error):
+        if error is not None:
+            logger.error(f'recording failed, the stream goes on without it: {error}')
+            self.stop()  # before letting go of the writer, so that the next frame does not start a new one
+        writer.close()
+        with self.lock:
+            if writer is self.writer:
+                self.writer = None
+            elif writer in self.finishing_writers:
+                self.finishing_writers.remove(writer)
+        self.check_stopped()
+
+
+class ReplayBuffer:
+    """
+    Keeps the last few seconds of the h264 coming out of a tee in memory, so they can be saved after something happened
+
+    tee -> queue (leaky) -> appsink
+
+    Frames are kept in groups of pictures, each starting with a keyframe, so a saved replay can always be decoded from
+    its first frame. Whole groups are dropped once the next one is older than seconds, so a replay is between seconds
+    and seconds + one keyframe interval long. Everything is dropped when the caps change (a new resolution).
+
+    The frames are collected on the appsink's own thread, behind a queue, so the other branches of the tee only pay for
+    handing a buffer to the queue.
+    """
+
+    def __init__(self, pipeline, tee, seconds, directory, prefix, file_format='mkv'):
+        if file_format not in FILE_FORMATS:
+            raise ValueError(f'unknown recording format {file_format}')
+        self.seconds = seconds
+        self.directory = directory
+        self.prefix = prefix
+        self.muxer_factory, self.extension = FILE_FORMATS[file_format]
+        self.lock = threading.Lock()  # samples come in on the appsink's thread
+        self.gops = collections.deque()  # lists of samples, each starting with a keyframe
+        self.bytes = 0
+        self.caps = None
+        self.save_pipelines = []  # pipelines still writing a replay to a file
+
+        self.queue = Gst.ElementFactory.make('queue')
+        self.queue.set_property('leaky', 2)  # 2==downstream, drop old buffers
+        self.appsink = Gst.ElementFactory.make('appsink')
+        self.appsink.set_property('sync', False)
+        self.appsink.set_property('async', False)  # do not hold up the pipeline going to playing
+        self.appsink.set_property('emit-signals', True)
+        self.appsink.connect('new-sample', self.on_new_sample)
+        pipeline.add(self.queue)
+        pipeline.add(self.appsink)
+        self.queue.link(self.appsink)
+        tee.link(self.queue)
+
+    @property
+    def duration(self):
+        """Seconds of video held right now"""
+        with self.lock:
+            if not self.gops:
+                return 0.0
+            return (self.gops[-1][-1].get_buffer().pts - self.gops[0][0].get_buffer().pts) / Gst.SECOND
+
+    def on_new_sample(self, appsink):
+        sample = appsink.emit('pull-sample')
+        buffer = sample.get_buffer()
+        if buffer.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.FlowReturn.OK
+        keyframe = not buffer.has_flags(Gst.BufferFlags.DELTA_UNIT)
+        with self.lock:
+            caps = sample.get_caps()
+            if self.caps is None or not caps.is_equal(self.caps) or (self.gops and buffer.pts < self.gops[-1][-1].get_buffer().pts):
+                # a new resolution, or the pipeline started its timestamps over: one file cannot hold both
+                self.caps = caps
+                self.gops.clear()
+                self.bytes = 0
+            if keyframe:
+                self.gops.append([sample])
+            elif self.gops:
+                self.gops[-1].append(sample)
+            else:
+                # cannot be decoded without the keyframe before it
+                return Gst.FlowReturn.OK
+            self.bytes += buffer.get_size()
+
+            oldest_pts = buffer.pts - int(self.seconds * Gst.SECOND)
+            while len(self.gops) > 1 and (self.gops[1][0].get_buffer().pts <= oldest_pts or self.bytes > REPLAY_MAX_BYTES):
+                self.bytes -= sum(old_sample.get_buffer().get_size() for old_sample in self.gops.popleft())
+        return Gst.FlowReturn.OK
+
+    def save(self):
+        """Writes what is held right now to a new file, in the background. Returns the file name, or None if empty"""
+        with self.lock:
+            samples = [sample for gop in self.gops for sample in gop]
+        if not samples:
+            logger.warning('nothing to save in the replay buffer')
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        location = os.path.join(self.directory, f'{self.prefix}_replay_{time.strftime("%Y%m%d_%H%M%S")}.{self.extension}')
+        logger.info(f'save {len(samples)} frames of replay to {location}')
+
+        pipeline = Gst.parse_launch(f'appsrc name=src format=time ! h264parse ! {self.muxer_factory} ! filesink name=sink')
+        pipeline.get_by_name('sink').set_property('location', location)
+        appsrc = pipeline.get_by_name('src')
+        appsrc.set_property('caps', samples[0].get_caps())
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message::eos', self.on_save_done, pipeline, location)
+        bus.connect('message::error', self.on_save_done, pipeline, location)
+        self.save_pipelines.append(pipeline)
+        pipeline.set_state(Gst.State.PLAYING)
+
+        first_pts = samples[0].get_buffer().pts
+        for sample in samples:
+            appsrc.emit('push-buffer', rebase_timestamps(sample.get_buffer(), first_pts))
+        appsrc.emit('end-of-stream')
+        return location
+
+    def on_save_done(self, bus, message, pipeline, location):
+        if message.type == Gst.MessageType.ERROR:
+            logger.error(f'could not save replay to {location}: {message.parse_error().gerror}')
+        else:
+            logger.info(f'saved replay to {location}')
+        bus.remove_signal_watch()
+        pipeline.set_state(Gst.State.NULL)
+        self.save_pipelines.remove(pipeline)
+
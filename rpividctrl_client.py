@@ -1,17 +1,32 @@
+import time
+STARTUP_TIME = time.perf_counter()  # for --startup-profile, before any of the imports
 import gi
 gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gst, Gtk, GLib
+from gi.repository import Gst, GstVideo, Gtk, GLib
 import signal
 import logging
-from rpividctrl_lib.messaging import REMOTE_CONTROL_PORT, RTP_PORT, MessageBuilder, SocketManager, MessageType, AnnotationMode, DRCLevel
-import time
+from rpividctrl_lib.messaging import REMOTE_CONTROL_PORT, RTP_PORT, ULPFEC_PAYLOAD_TYPE, RED_PAYLOAD_TYPE, MessageBuilder, SocketManager, MessageType, AnnotationMode, DRCLevel
+from rpividctrl_lib.abr import AimdBitrateController
+from rpividctrl_lib.clock_sync import ClockOffsetEstimator
+import collections
+import struct
 import cairo
 import json
+import threading
 from argparse import ArgumentParser
 from overlay import Overlay
-from common import get_pad, STATS_BUFFER_LEN
-import collections
+from common import get_pad, RESOLUTIONS, FRAMERATES, TARGET_BITRATES, FEC_PERCENTAGES
+from stats import RollingStats
+import profiling
+from recording import Recorder, ReplayBuffer
+import h264_decoders
+import gl_overlay
+
+VISION_RESULTS_LEN = 64  # vision results to keep around for matching to frames
+RTP_TIMESTAMP_STRUCT = struct.Struct('>I')  # at byte 4 of the rtp header
+FRAME_TIMES_LEN = 64  # capture and display times to keep around for matching to each other
 
 logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s %(name)s] %(message)s')
 logger = logging.getLogger('rpividctrl_client')
@@ -20,13 +35,23 @@ logger = logging.getLogger('rpividctrl_client')
 class VideoWidget(Gtk.Overlay):
     """The GUI element in the middle of the window with the video stream and any overlays"""
 
-    def __init__(self, vid_width, vid_height, h264dec_factory=None, **kwargs):
+    def __init__(self, vid_width, vid_height, h264dec_factory=None, live_renegotiation=True, fec_latency=40,
+                 latency_sample_interval=4, record_settings=None, overlay_cache=True, overlay_mode='gtk', **kwargs):
         super().__init__(**kwargs)
 
-        self.stats_buffer = collections.deque(maxlen=STATS_BUFFER_LEN)
+        # pipeline latency is measured for every nth frame, from its first packet arriving to gtkglsink
+        self.latency_stats = RollingStats()
+        self.latency_sample_interval = max(latency_sample_interval, 1)
+        self.udpsrc_frames = 0
+        self.last_udpsrc_rtp_timestamp = None
+        self.arrival_times = collections.OrderedDict()  # rtp timestamp -> time.monotonic() of the first packet, oldest first
 
+        self.rtpreddec = None
+        self.rtpstorage = None
         self.rtpjitterbuffer = None
+        self.rtpulpfecdec = None
         self.rtph264depay = None
+        self.depay_tee = None
         self.h264_caps_filter = None
         self.h264dec = None
         self.post_h264dec = None
@@ -39,13 +64,74 @@ class VideoWidget(Gtk.Overlay):
         self.vid_height = vid_height
         self.h264dec_factory = h264dec_factory
 
-        self.overlay = None
+        # swap decoder elements while the rest of the pipeline keeps running, instead of stopping the whole pipeline
+        self.live_renegotiation = live_renegotiation
+        self.decoder_swap_probe_id = None
+        self.decoder_swap_timeout_id = None
+        self.decoder_eos_probe_id = None
+        self.decoder_draining = False
+        self.last_frame_time = None
+        self.decoder_switch_pending = False  # waiting for the first frame from new decoder elements
+        self.decoder_switch_gap = 0.0  # time between the last frame before the switch and the first frame after
+
+        # while fec is on, the jitterbuffer waits this long (ms) for fec packets before it gives up on a lost packet
+        self.fec_latency = fec_latency
+        self.fec_enabled = False
 
+        self.on_keyframe_request = None  # called with a reason when the decoder needs a keyframe to recover
+        self.keyframe_request_pending = False
+
+        self.overlay = None
+        self.drawing_area = None
+        # the video size comes from the caps event at gtkglsink, so draw() does not have to parse caps every time
+        self.video_size = None
+        self.displayed_pts = None  # of the frame gtkglsink is showing
+        # where the video is inside the drawing area, and the overlay's static layer drawn there. both are thrown
+        # away when the drawing area is resized, the video size changes or the overlay changes
+        self.overlay_cache = overlay_cache
+        # gtk: draw the overlay on a Gtk.DrawingArea on top of the video, on gtk's schedule
+        # gl: draw it into every frame in the pipeline, and blend it on the gpu (see gl_overlay.OverlayCompositor)
+        self.overlay_mode = overlay_mode
+        self.overlay_compositor = None
+        self.overlay_geometry = None
+        self.overlay_static_surface = None
+        self.overlay_draw_stats = RollingStats()
+        self.vision_results = collections.OrderedDict()  # rtp timestamp -> VisionResult, oldest first
+        self.pts_to_rtp_timestamp = collections.OrderedDict()  # so a displayed frame can be matched to its vision result and latency samples
+        self.last_depay_pts = None
+
+        # glass-to-glass latency: when the server's camera captured each frame, and when it got to gtkglsink here,
+        # both in client clock time and keyed by rtp timestamp. either one can come in first
+        self.measure_glass_to_glass = False
+        self.clock = Gst.SystemClock.obtain()
+        self.capture_times = collections.OrderedDict()
+        self.display_times = collections.OrderedDict()
+        self.glass_to_glass_stats = RollingStats()
+
+        self.profiler = None  # profiling.Profiler, samples the queues of the pipeline once it exists
+        self.startup_profile = None  # profiling.StartupProfile, for --startup-profile
+
+        # recording and instant replay of the received h264, without re-encoding
+        # keys: directory, format (mkv or mp4), segment_time (s), segment_size (bytes), replay_seconds (0 for no replay)
+        self.record_settings = record_settings or {}
+        self.recorder = None
+        self.replay_buffer = None
+
+        self.pipeline = None
         self.connect('realize', self.on_realize)
         self.set_size_request(160, 120)
 
     def on_realize(self, widget):
+        # the pipeline takes a while to build (plugins are loaded as their elements are made), so the window is drawn
+        # first. idle sources run after gtk's redraws
+        GLib.idle_add(self.create_pipeline)
+
+    def create_pipeline(self):
+        if self.startup_profile is not None:
+            self.startup_profile.step('window shown')
         self.pipeline = Gst.Pipeline.new()
+        if self.profiler is not None:
+            self.profiler.pipeline = self.pipeline
 
         udpsrc = Gst.ElementFactory.make('udpsrc')
         udpsrc.set_property('port', RTP_PORT)
@@ -58,16 +144,64 @@ class VideoWidget(Gtk.Overlay):
         self.pipeline.add(udpsrc_caps_filter)
         udpsrc.link(udpsrc_caps_filter)
 
+        # forward error correction, the same order as webrtcbin:
+        # rtpreddec -> rtpstorage -> rtpjitterbuffer -> rtpulpfecdec
+        # rtpstorage keeps the packets that come in, and when the jitterbuffer reports a lost packet, rtpulpfecdec tries
+        # to rebuild it from them. while fec is off, the server sends plain h264 packets, which all of these pass through
+
+        self.rtpreddec = Gst.ElementFactory.make('rtpreddec')
+        self.rtpreddec.set_property('pt', RED_PAYLOAD_TYPE)
+        self.pipeline.add(self.rtpreddec)
+        udpsrc_caps_filter.link(self.rtpreddec)
+
+        self.rtpstorage = Gst.ElementFactory.make('rtpstorage')
+        self.rtpstorage.set_property('size-time', 250 * Gst.MSECOND)
+        self.pipeline.add(self.rtpstorage)
+        self.rtpreddec.link(self.rtpstorage)
+
         self.rtpjitterbuffer = Gst.ElementFactory.make('rtpjitterbuffer')
-        self.rtpjitterbuffer.set_property('latency', 0)
+        self.rtpjitterbuffer.set_property('latency', self.fec_latency if self.fec_enabled else 0)
         self.pipeline.add(self.rtpjitterbuffer)
-        udpsrc_caps_filter.link(self.rtpjitterbuffer)
+        self.rtpstorage.link(self.rtpjitterbuffer)
+
+        self.rtpulpfecdec = Gst.ElementFactory.make('rtpulpfecdec')
+        self.rtpulpfecdec.set_property('pt', ULPFEC_PAYLOAD_TYPE)
+        self.rtpulpfecdec.set_property('storage', self.rtpstorage.get_property('internal-storage'))
+        self.pipeline.add(self.rtpulpfecdec)
+        self.rtpjitterbuffer.link(self.rtpulpfecdec)
+
+        self.rtpjitterbuffer.set_property('do-lost', True)  # packet lost events tell us when to request a keyframe
 
         self.rtph264depay = Gst.ElementFactory.make('rtph264depay')
+        if self.rtph264depay.find_property('request-keyframe') is not None:
+            self.rtph264depay.set_property('request-keyframe', True)
+        depay_pad = get_pad(self.rtph264depay.iterate_sink_pads())
+        depay_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM | Gst.PadProbeType.EVENT_UPSTREAM, self.depay_event_probe)
+        depay_pad.add_probe(Gst.PadProbeType.BUFFER, self.depay_buffer_probe)
         self.pipeline.add(self.rtph264depay)
-        self.rtpjitterbuffer.link(self.rtph264depay)
+        self.rtpulpfecdec.link(self.rtph264depay)
+
+        # rtph264depay -> depay_tee -> decoder elements -> ...
+        #                           |-> (while recording) queue -> appsink, written to files by a pipeline of its own
+        #                           \-> (if replay is on) queue -> appsink
+        # the recording and replay branches start with a queue, so the decoder branch only pays for handing them a buffer
+        self.depay_tee = Gst.ElementFactory.make('tee', 'depay_tee')
+        self.depay_tee.set_property('allow-not-linked', True)
+        self.pipeline.add(self.depay_tee)
+        self.rtph264depay.link(self.depay_tee)
+        record_directory = self.record_settings.get('directory') or 'recordings'
+        record_format = self.record_settings.get('format') or 'mkv'
+        self.recorder = Recorder(self.pipeline, self.depay_tee, directory=record_directory, prefix='rpividctrl_client',
+                                 file_format=record_format, segment_time=self.record_settings.get('segment_time', 60),
+                                 segment_size=self.record_settings.get('segment_size', 0))
+        replay_seconds = self.record_settings.get('replay_seconds', 0)
+        if replay_seconds > 0:
+            self.replay_buffer = ReplayBuffer(self.pipeline, self.depay_tee, replay_seconds, directory=record_directory,
+                                              prefix='rpividctrl_client', file_format=record_format)
 
         self.glupload = Gst.ElementFactory.make('glupload')
+        glupload_pad = get_pad(self.glupload.iterate_sink_pads())
+        glupload_pad.add_probe(Gst.PadProbeType.BUFFER, self.decoded_frame_probe)
         self.pipeline.add(self.glupload)
 
         self.create_decoder_elements()
@@ -79,14 +213,24 @@ class VideoWidget(Gtk.Overlay):
         self.imagesink = Gst.ElementFactory.make('gtkglsink')
         self.imagesink.set_property('sync', False)
         buffer_processed_pad = get_pad(self.imagesink.iterate_sink_pads())
-        buffer_processed_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.buffer_processed_probe)
+        buffer_processed_pad.add_probe(Gst.PadProbeType.BUFFER, self.buffer_processed_probe)
+        buffer_processed_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.imagesink_event_probe)
         self.pipeline.add(self.imagesink)
-        self.glcolorconvert.link(self.imagesink)
+        if self.overlay_mode == 'gl' and not gl_overlay.is_available():
+            logger.warning(f'overlay mode gl needs {" and ".join(gl_overlay.ELEMENTS)}, drawing the overlay with gtk')
+            self.overlay_mode = 'gtk'
+        if self.overlay_mode == 'gl':
+            self.overlay_compositor = gl_overlay.OverlayCompositor(get_vision_result=self.get_vision_result,
+                                                                   draw_stats=self.overlay_draw_stats)
+            self.overlay_compositor.set_overlay(self.overlay)
+            self.overlay_compositor.add_to(self.pipeline, self.glcolorconvert, self.imagesink)
+        else:
+            self.glcolorconvert.link(self.imagesink)
 
         # self.imagesink = Gst.ElementFactory.make('gtksink')
         # self.imagesink.set_property('sync', False)
         # buffer_processed_pad = get_pad(self.imagesink.iterate_sink_pads())
-        # buffer_processed_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.buffer_processed_probe)
+        # buffer_processed_pad.add_probe(Gst.PadProbeType.BUFFER, self.buffer_processed_probe)
         # self.pipeline.add(self.imagesink)
         # self.videoconvert.link(self.imagesink)
 
@@ -94,10 +238,12 @@ class VideoWidget(Gtk.Overlay):
         self.add(self.imagesink_widget)
         self.imagesink_widget.show()
 
-        drawing_area = Gtk.DrawingArea()
-        drawing_area.connect('draw', self.draw)
-        self.add_overlay(drawing_area)
-        drawing_area.show()
+        if self.overlay_compositor is None:
+            self.drawing_area = Gtk.DrawingArea()
+            self.drawing_area.connect('draw', self.draw)
+            self.drawing_area.connect('size-allocate', lambda *args: self.invalidate_overlay_cache())
+            self.add_overlay(self.drawing_area)
+            self.drawing_area.show()
 
         self.pipeline.set_state(Gst.State.PLAYING)
 
@@ -106,6 +252,11 @@ class VideoWidget(Gtk.Overlay):
         bus.connect('message::eos', self.on_eos)
         bus.connect('message::error', self.on_error)
 
+        if self.startup_profile is not None:
+            self.startup_profile.step('pipeline built')
+            logger.info(f'startup profile:\n{self.startup_profile.report()}')
+        return GLib.SOURCE_REMOVE
+
     def on_eos(self, bus, message):
         logger.error('gstreamer eos')
 
@@ -114,40 +265,60 @@ class VideoWidget(Gtk.Overlay):
         logger.error(f'gstreamer error: {parsed_error.gerror}\nAdditional debug info:\n{parsed_error.debug}')
 
     def udpsrc_probe(self, pad, probe_info):
-        event_structure = Gst.Structure.new_empty('udpsrc_time')
-        event_structure.set_value('time', time.monotonic())
-        pad.get_peer().send_event(Gst.Event.new_custom(Gst.EventType.CUSTOM_DOWNSTREAM, event_structure))
+        # every packet of a frame has the same rtp timestamp (and so do red and fec packets), a new one means a new frame
+        rtp_timestamp = RTP_TIMESTAMP_STRUCT.unpack(probe_info.get_buffer().extract_dup(4, RTP_TIMESTAMP_STRUCT.size))[0]
+        if rtp_timestamp != self.last_udpsrc_rtp_timestamp:
+            self.last_udpsrc_rtp_timestamp = rtp_timestamp
+            self.udpsrc_frames += 1
+            if self.udpsrc_frames % self.latency_sample_interval == 0:
+                self.arrival_times[rtp_timestamp] = time.monotonic()
+                if len(self.arrival_times) > FRAME_TIMES_LEN:
+                    self.arrival_times.popitem(last=False)
         return Gst.PadProbeReturn.OK
 
     def buffer_processed_probe(self, pad, probe_info):
+        self.displayed_pts = probe_info.get_buffer().pts
+        rtp_timestamp = self.pts_to_rtp_timestamp.get(self.displayed_pts)
+        if rtp_timestamp is None:
+            return Gst.PadProbeReturn.OK
+        arrival_time = self.arrival_times.pop(rtp_timestamp, None)
+        if arrival_time is not None:
+            self.measure_stats(time.monotonic() - arrival_time)
+        if self.measure_glass_to_glass:
+            # gtkglsink does not sync, so the frame is drawn right away
+            GLib.idle_add(self.add_display_time, rtp_timestamp, self.clock.get_time())
+        return Gst.PadProbeReturn.OK
+
+    def imagesink_event_probe(self, pad, probe_info):
         event = probe_info.get_event()
-        if event.type == Gst.EventType.CUSTOM_DOWNSTREAM:
-            structure = event.get_structure()
-            if structure.has_name('udpsrc_time'):
-                camsrc_time = event.get_structure().get_value('time')
-                now = time.monotonic()
-                time_diff = now - camsrc_time
-                self.measure_stats(time_diff)
+        if event.type == Gst.EventType.CAPS:
+            structure = event.parse_caps().get_structure(0)
+            has_width, width = structure.get_int('width')
+            has_height, height = structure.get_int('height')
+            if has_width and has_height:
+                GLib.idle_add(self.on_video_size_changed, width, height)
         return Gst.PadProbeReturn.OK
 
+    def on_video_size_changed(self, width, height):
+        if (width, height) != self.video_size:
+            self.video_size = (width, height)
+            self.invalidate_overlay_cache()
+            if self.drawing_area is not None and self.overlay is not None:
+                self.drawing_area.queue_draw()
+        return GLib.SOURCE_REMOVE
+
     def measure_stats(self, last_pipeline_latency):
-        self.stats_buffer.append((last_pipeline_latency, ))
+        self.latency_stats.add(last_pipeline_latency)
 
     def create_h264_caps_filter(self):
         capsfilter = Gst.ElementFactory.make('capsfilter')
-        capsfilter.set_property('caps', Gst.Caps.from_string(f'video/x-h264,width={self.vid_width},height={self.vid_height}'))
+        # no width and height: only the owner picks the resolution, other viewers get whatever it picked.
+        # the decoder reads the size from the stream's SPS
+        capsfilter.set_property('caps', Gst.Caps.from_string('video/x-h264'))
         return capsfilter
 
     def create_h264_decoder(self):
-        decoder = self.h264dec_factory.create()
-        if decoder.get_factory().get_name() == 'vaapih264dec':
-            # vaapi hardware-accelerated h264 decoding
-            # https://en.wikipedia.org/wiki/Video_Acceleration_API
-            try:
-                decoder.set_property('low-latency', True)
-            except TypeError:
-                logger.warning('vaapih264dec property low-latency does not exist, using an old version of libgstvaapi or version compiled without low-latency feature')
-        return decoder
+        return h264_decoders.tune_decoder(self.h264dec_factory.create())
 
     def change_vid_dimensions(self, width, height):
         self.vid_width = width
@@ -160,10 +331,192 @@ class VideoWidget(Gtk.Overlay):
 
         self.recreate_decoder_elements()
 
+    def set_fec_enabled(self, enabled):
+        self.fec_enabled = enabled
+        if self.rtpjitterbuffer is not None:
+            self.rtpjitterbuffer.set_property('latency', self.fec_latency if enabled else 0)
+
+    def get_fec_stats(self):
+        """Returns packets recovered and not recovered by fec"""
+        if self.rtpulpfecdec is None:
+            return 0, 0
+        return self.rtpulpfecdec.get_property('recovered'), self.rtpulpfecdec.get_property('unrecovered')
+
+    def depay_event_probe(self, pad, probe_info):
+        event = probe_info.get_event()
+        if event.type == Gst.EventType.CUSTOM_DOWNSTREAM and event.has_name('GstRTPPacketLost'):
+            self.schedule_keyframe_request('packet lost')
+        elif GstVideo.video_event_is_force_key_unit(event):
+            # the depayloader asks upstream for a keyframe when the stream is broken. there is no rtcp session to
+            # turn it into a PLI, so it goes to the server over the control connection instead
+            self.schedule_keyframe_request('depayloader')
+            return Gst.PadProbeReturn.DROP
+        return Gst.PadProbeReturn.OK
+
+    def depay_buffer_probe(self, pad, probe_info):
+        # the decoder keeps the pts, so the pts of a displayed frame leads back to its rtp timestamp
+        buffer = probe_info.get_buffer()
+        if buffer.pts != self.last_depay_pts:
+            self.last_depay_pts = buffer.pts
+            self.pts_to_rtp_timestamp[buffer.pts] = RTP_TIMESTAMP_STRUCT.unpack(buffer.extract_dup(4, RTP_TIMESTAMP_STRUCT.size))[0]
+            if len(self.pts_to_rtp_timestamp) > VISION_RESULTS_LEN:
+                self.pts_to_rtp_timestamp.popitem(last=False)
+        return Gst.PadProbeReturn.OK
+
+    def add_vision_result(self, vision_result):
+        self.vision_results[vision_result.rtp_timestamp] = vision_result
+        if len(self.vision_results) > VISION_RESULTS_LEN:
+            self.vision_results.popitem(last=False)
+        if self.drawing_area is not None and self.overlay is not None:
+            self.drawing_area.queue_draw()
+
+    def get_vision_result(self, pts):
+        """The vision result for the frame with pts, or the newest one from before it. Also called on the streaming thread in overlay mode gl"""
+        rtp_timestamp = self.pts_to_rtp_timestamp.get(pts)
+        if rtp_timestamp is None:
+            return None
+        vision_result = self.vision_results.get(rtp_timestamp)
+        if vision_result is not None:
+            return vision_result
+        for vision_result in reversed(list(self.vision_results.values())):  # a copy, the main thread might add one
+            if (rtp_timestamp - vision_result.rtp_timestamp) & 0xffffffff < 0x80000000:  # rtp timestamps wrap around
+                return vision_result
+        return None
+
+    def add_display_time(self, rtp_timestamp, display_time):
+        capture_time = self.capture_times.pop(rtp_timestamp, None)
+        if capture_time is not None:
+            self.glass_to_glass_stats.add((display_time - capture_time) / Gst.SECOND)
+        else:
+            self.display_times[rtp_timestamp] = display_time
+            if len(self.display_times) > FRAME_TIMES_LEN:
+                self.display_times.popitem(last=False)
+        return GLib.SOURCE_REMOVE
+
+    def add_capture_time(self, rtp_timestamp, capture_time):
+        """capture_time is in client clock time"""
+        display_time = self.display_times.pop(rtp_timestamp, None)
+        if display_time is not None:
+            self.glass_to_glass_stats.add((display_time - capture_time) / Gst.SECOND)
+        else:
+            self.capture_times[rtp_timestamp] = capture_time
+            if len(self.capture_times) > FRAME_TIMES_LEN:
+                self.capture_times.popitem(last=False)
+
+    def schedule_keyframe_request(self, reason):
+        """Called from the streaming thread, only one request is scheduled at a time"""
+        if not self.keyframe_request_pending:
+            self.keyframe_request_pending = True
+            GLib.idle_add(self.request_keyframe, reason)
+
+    def request_keyframe(self, reason):
+        self.keyframe_request_pending = False
+        if self.on_keyframe_request is not None:
+            self.on_keyframe_request(reason)
+        return GLib.SOURCE_REMOVE
+
+    def set_recording(self, recording):
+        """Starts or stops recording the received h264 to files"""
+        if self.recorder is None:
+            logger.warning('cannot record before the pipeline is built')
+            return
+        if recording:
+            if self.recorder.start():
+                self.request_keyframe('recording started')  # so the file starts with a picture
+        else:
+            self.recorder.stop()
+
+    def save_replay(self):
+        """Writes the last replay_seconds to a file. Returns the file name, or None if there is nothing to save"""
+        if self.replay_buffer is None:
+            return None
+        return self.replay_buffer.save()
+
+    def decoded_frame_probe(self, pad, probe_info):
+        now = time.monotonic()
+        if self.decoder_switch_pending:
+            self.decoder_switch_pending = False
+            if self.last_frame_time is not None:
+                self.decoder_switch_gap = now - self.last_frame_time
+                logger.info(f'decoder switch gap {self.decoder_switch_gap * 1e3:.1f} ms')
+        self.last_frame_time = now
+        return Gst.PadProbeReturn.OK
+
     def recreate_decoder_elements(self):
-        self.pipeline.set_state(Gst.State.NULL)
+        if self.pipeline is None:
+            return  # create_pipeline() will use the new settings
+        if not self.live_renegotiation:
+            # the timestamps start over after NULL, finish the file first so it ends with eos
+            self.recorder.finish_file()
+            self.pipeline.set_state(Gst.State.NULL)
+            self.remove_decoder_elements()
+            self.create_decoder_elements()
+            self.decoder_switch_pending = True
+            self.pipeline.set_state(Gst.State.PLAYING)
+            self.request_keyframe('decoder rebuilt')
+            return
+
+        if self.decoder_swap_probe_id is not None:
+            # already swapping, the new elements will be created with the latest settings
+            return
 
-        self.rtph264depay.unlink(self.h264_caps_filter)
+        # 1. block the depayloader's src pad, so no new data goes into the decoder elements (or the recording and replay)
+        # 2. push eos through the decoder elements, so they finish what they are doing
+        # 3. once the eos comes out, swap the decoder elements and unblock
+        # the timeout is in case the eos never makes it through (for example, if the decoder errored)
+        depay_src_pad = get_pad(self.rtph264depay.iterate_src_pads())
+        self.decoder_swap_timeout_id = GLib.timeout_add(500, self.decoder_swap_timeout_handler)
+        self.decoder_swap_probe_id = depay_src_pad.add_probe(Gst.PadProbeType.IDLE, self.decoder_block_probe)
+
+    def decoder_block_probe(self, pad, probe_info):
+        if not self.decoder_draining:
+            self.decoder_draining = True
+            glupload_pad = get_pad(self.glupload.iterate_sink_pads())
+            self.decoder_eos_probe_id = glupload_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.decoder_eos_probe)
+            get_pad(self.h264_caps_filter.iterate_sink_pads()).send_event(Gst.Event.new_eos())
+        return Gst.PadProbeReturn.OK  # stay blocked until swap_decoder_elements() removes this probe
+
+    def decoder_eos_probe(self, pad, probe_info):
+        if probe_info.get_event().type == Gst.EventType.EOS:
+            GLib.idle_add(self.swap_decoder_elements)
+            return Gst.PadProbeReturn.DROP  # the rest of the pipeline keeps running, so it should not see eos
+        return Gst.PadProbeReturn.OK
+
+    def decoder_swap_timeout_handler(self):
+        self.decoder_swap_timeout_id = None
+        logger.warning('decoder elements did not drain in time, swap anyway')
+        self.swap_decoder_elements()
+        return GLib.SOURCE_REMOVE
+
+    def swap_decoder_elements(self):
+        if self.decoder_swap_probe_id is None:
+            # already swapped
+            return GLib.SOURCE_REMOVE
+        if self.decoder_swap_timeout_id is not None:
+            GLib.source_remove(self.decoder_swap_timeout_id)
+            self.decoder_swap_timeout_id = None
+        if self.decoder_eos_probe_id is not None:
+            get_pad(self.glupload.iterate_sink_pads()).remove_probe(self.decoder_eos_probe_id)
+            self.decoder_eos_probe_id = None
+
+        for element in (self.h264_caps_filter, self.h264dec, self.post_h264dec):
+            if element is not None:
+                element.set_state(Gst.State.NULL)
+        self.remove_decoder_elements()
+        self.create_decoder_elements()
+        for element in (self.h264_caps_filter, self.h264dec, self.post_h264dec):
+            if element is not None:
+                element.sync_state_with_parent()
+
+        self.decoder_switch_pending = True
+        get_pad(self.rtph264depay.iterate_src_pads()).remove_probe(self.decoder_swap_probe_id)
+        self.decoder_swap_probe_id = None
+        self.decoder_draining = False
+        self.request_keyframe('decoder rebuilt')
+        return GLib.SOURCE_REMOVE
+
+    def remove_decoder_elements(self):
+        self.depay_tee.unlink(self.h264_caps_filter)
         self.h264_caps_filter.unlink(self.h264dec)
         if self.post_h264dec:
             self.h264dec.unlink(self.post_h264dec)
@@ -174,14 +527,10 @@ class VideoWidget(Gtk.Overlay):
         self.pipeline.remove(self.h264_caps_filter)
         self.pipeline.remove(self.h264dec)
 
-        self.create_decoder_elements()
-
-        self.pipeline.set_state(Gst.State.PLAYING)
-
     def create_decoder_elements(self):
         self.h264_caps_filter = self.create_h264_caps_filter()
         self.pipeline.add(self.h264_caps_filter)
-        self.rtph264depay.link(self.h264_caps_filter)
+        self.depay_tee.link(self.h264_caps_filter)
 
         self.h264dec = self.create_h264_decoder()
         self.pipeline.add(self.h264dec)
@@ -212,47 +561,25 @@ class VideoWidget(Gtk.Overlay):
             self.overlay = None
         else:
             self.overlay = overlay_cls()
-
-    def draw(self, drawing_area, ctx: cairo.Context):
-        # draws the overlay
-
-        # gtksink draws the video frame in the center its allocated space,
-        # adding black bars to the sides if the aspect ratio does not match up
-        # we need to find the dimensions of the video and the dimensions of the available
-        # space so that we can calculate where we should draw the overlay so it goes over
-        # the video frame
-
-        if self.overlay is None:
-            return
-
-        # first, get last video frame
-        last_sample = self.imagesink.get_property('last_sample')
-        if last_sample is None:
-            # have not received any video yet
-            return
-        # extract width and height of video stream from last_sample
-        caps = last_sample.get_caps()
-        vid_orig_width = None
-        vid_orig_height = None
-
-        for i in range(caps.get_size()):
-            structure = caps.get_structure(i)
-            width_tuple = structure.get_int('width')
-            if width_tuple[0]:
-                vid_orig_width = width_tuple[1]
-            height_tuple = structure.get_int('height')
-            if height_tuple[0]:
-                vid_orig_height = height_tuple[1]
-            if vid_orig_width is not None and vid_orig_height is not None:
-                break
-
-        if vid_orig_width is None or vid_orig_height is None:
-            raise ValueError('found last sample, but could not determine width or height of sample')
-
-        # get size of available space
-        allocated_width = drawing_area.get_allocated_width()
-        allocated_height = drawing_area.get_allocated_height()
-
+        if self.overlay_compositor is not None:
+            self.overlay_compositor.set_overlay(self.overlay)
+        self.invalidate_overlay_cache()
+        self.overlay_draw_stats.clear()
+        if self.drawing_area is not None:
+            self.drawing_area.queue_draw()
+
+    def invalidate_overlay_cache(self):
+        self.overlay_geometry = None
+        self.overlay_static_surface = None
+
+    def get_overlay_geometry(self, allocated_width, allocated_height):
+        """
+        (x, y, x scale, y scale) that map Overlay coordinates onto the video inside the drawing area
+
+        gtkglsink draws the video frame in the center of its allocated space,
+        adding black bars to the sides if the aspect ratio does not match up
+        """
+        vid_orig_width, vid_orig_height = self.video_size
         vid_size_multiplier = min(allocated_width / vid_orig_width, allocated_height / vid_orig_height)
         vid_width = vid_orig_width * vid_size_multiplier
         vid_height = vid_orig_height * vid_size_multiplier
@@ -266,14 +593,49 @@ class VideoWidget(Gtk.Overlay):
             vid_x = 0
             vid_y = (allocated_height - vid_height) / 2
 
-        # we transform ctx so that we can use
+        return vid_x, vid_y, vid_width / Overlay.CTX_WIDTH, vid_height / Overlay.CTX_HEIGHT
+
+    def transform_to_video(self, ctx: cairo.Context):
         # (0, 0) -> top left of video stream, and
         # (Overlay.CTX_WIDTH, Overlay.CTX_HEIGHT) -> bottom right of video stream
+        vid_x, vid_y, scale_x, scale_y = self.overlay_geometry
         ctx.translate(vid_x, vid_y)
-        ctx.scale(vid_width / Overlay.CTX_WIDTH, vid_height / Overlay.CTX_HEIGHT)
+        ctx.scale(scale_x, scale_y)
 
-        # now we can use ctx
+    def draw(self, drawing_area, ctx: cairo.Context):
+        # draws the overlay: the cached static layer, then the dynamic layer on top
+
+        if self.overlay is None or self.video_size is None:
+            # no overlay, or have not received any video yet
+            return
+        start = time.perf_counter()
+
+        allocated_width = drawing_area.get_allocated_width()
+        allocated_height = drawing_area.get_allocated_height()
+        if self.overlay_geometry is None:
+            self.overlay_geometry = self.get_overlay_geometry(allocated_width, allocated_height)
+
+        if self.overlay.has_static_layer():
+            if not self.overlay_cache:
+                ctx.save()
+                self.transform_to_video(ctx)
+                self.overlay.draw_static(ctx)
+                ctx.restore()
+            else:
+                if self.overlay_static_surface is None:
+                    # similar to the window's surface, so it is in the right format and scale for hidpi screens
+                    self.overlay_static_surface = drawing_area.get_window().create_similar_surface(
+                        cairo.CONTENT_COLOR_ALPHA, allocated_width, allocated_height)
+                    static_ctx = cairo.Context(self.overlay_static_surface)
+                    self.transform_to_video(static_ctx)
+                    self.overlay.draw_static(static_ctx)
+                ctx.set_source_surface(self.overlay_static_surface, 0, 0)
+                ctx.paint()
+
+        self.transform_to_video(ctx)
+        self.overlay.set_vision_result(self.get_vision_result(self.displayed_pts))
         self.overlay.draw(ctx)
+        self.overlay_draw_stats.add(time.perf_counter() - start)
 
 
 class RemoteControl:
@@ -285,10 +647,16 @@ class RemoteControl:
     STATUS_CONNECTING = 1
     STATUS_CONNECTED = 2
 
+    KEYFRAME_REQUEST_INTERVAL = 0.5  # seconds, a keyframe takes about one round trip to arrive
+
     def __init__(self, on_status_change, on_stats_update):
         self.sock_manager = None
         self.on_status_change = on_status_change
         self.on_stats_update = on_stats_update
+        self.on_vision_result = None  # called with a VisionResult whenever the server sends one
+        # called with the rtp timestamp and capture time (client clock) of each frame, while frame_timestamps is on
+        self.on_frame_timestamp = None
+        self.on_profile_report = None  # called with the report dict from the server, after request_profile_report()
         self.status = RemoteControl.STATUS_DISCONNECTED
         self.reason = None
         self.reconnect_timeout_id = None
@@ -302,6 +670,12 @@ class RemoteControl:
         self.annotation_mode = None
         self.drc_level = None
         self.target_bitrate = 0
+        self.fec_percentage = 0
+        self.abr = None  # AimdBitrateController when adaptive bitrate is on
+        self.last_keyframe_request_time = None
+        self.frame_timestamps = False  # ask the server when each frame was captured, for glass-to-glass latency
+        self.clock = Gst.SystemClock.obtain()
+        self.clock_offset = ClockOffsetEstimator()
 
     def set_status(self, status, reason=None):
         """used within the class to propogate a status changed event"""
@@ -316,6 +690,7 @@ class RemoteControl:
         self.sock_manager.on_destroy = self.on_sock_destroy
         self.sock_manager.on_connected = self.on_sock_connected
         self.sock_manager.on_read_message = self.on_sock_read_message
+        self.sock_manager.on_high_water_mark = self.on_sock_high_water_mark
         self.sock_manager.connect(self.ip_address, REMOTE_CONTROL_PORT)
 
     def on_sock_destroy(self, reason=None):
@@ -329,11 +704,18 @@ class RemoteControl:
         # self.send_annotation_mode()
         # self.send_drc_level()
         self.send_target_bitrate()
+        if self.fec_percentage > 0:
+            self.send_fec_percentage()
+        if self.frame_timestamps:
+            self.send_frame_timestamps()
         self.send_resolution_framerate()
         self.resume()
         self.sock_manager.uncork()
         self.stats_timer_id = GLib.timeout_add(500, self.send_stats)
 
+    def on_sock_high_water_mark(self, bytes_queued):
+        logger.warning(f'control socket is backed up, {bytes_queued} bytes queued')
+
     def on_sock_read_message(self, message):
         message_type = message['message_type']
         if message_type == MessageType.STATS_RESPONSE:
@@ -342,8 +724,20 @@ class RemoteControl:
             else:
                 stats_res_time = time.monotonic()
                 rtt = stats_res_time - self.stats_request_time
-                self.on_stats_update(rtt, message['stats_tuple'])
+                self.on_stats_update(rtt, message['stats'])
                 self.stats_request_time = None
+        elif message_type == MessageType.VISION_RESULT:
+            if self.on_vision_result is not None:
+                self.on_vision_result(message['vision_result'])
+        elif message_type == MessageType.PROFILE_REPORT:
+            if self.on_profile_report is not None:
+                self.on_profile_report(message['profile_report'])
+        elif message_type == MessageType.TIME_SYNC_RESPONSE:
+            self.clock_offset.add_sample(message['client_time'], message['server_receive_time'], message['server_send_time'],
+                                         self.clock.get_time())
+        elif message_type == MessageType.FRAME_TIMESTAMP:
+            if self.on_frame_timestamp is not None and self.clock_offset.ready:
+                self.on_frame_timestamp(message['rtp_timestamp'], self.clock_offset.to_client_time(message['capture_time']))
 
     def reconnect(self, disconnect_reason=None, reconnect_delay=1500):
         logger.info(f'disconnect with reason {disconnect_reason}, reconnect in {reconnect_delay} ms')
@@ -352,6 +746,7 @@ class RemoteControl:
             GLib.source_remove(self.stats_timer_id)
             self.stats_timer_id = None
             self.stats_request_time = None
+        self.clock_offset = ClockOffsetEstimator()  # might be a different server after reconnecting
 
         if self.sock_manager:
             self.sock_manager.on_destroy = None
@@ -373,9 +768,13 @@ class RemoteControl:
         return False
 
     def send_stats(self):
-        if self.stats_request_time is None:
+        if self.sock_manager is not None and self.sock_manager.above_high_water_mark:
+            logger.warning('control socket is backed up, skip stats request')
+        elif self.stats_request_time is None:
             self.stats_request_time = time.monotonic()
             self.send_if_connected(MessageBuilder.STATS_REQUEST)
+            if self.frame_timestamps:
+                self.send_if_connected(MessageBuilder.time_sync_request(self.clock.get_time()))
         else:
             logger.warning('time to send another stats request, but have not received last stats request response')
         return GLib.SOURCE_CONTINUE
@@ -424,32 +823,109 @@ class RemoteControl:
         self.drc_level = drc_level
         self.send_drc_level()
 
+    def request_keyframe(self, reason):
+        now = time.monotonic()
+        if self.last_keyframe_request_time is not None and now - self.last_keyframe_request_time < RemoteControl.KEYFRAME_REQUEST_INTERVAL:
+            return
+        if self.send_if_connected(MessageBuilder.FORCE_KEYFRAME):
+            logger.debug(f'request keyframe, reason {reason}')
+            self.last_keyframe_request_time = now
+
     def send_target_bitrate(self):
         self.send_if_connected(MessageBuilder.set_target_bitrate(self.target_bitrate))
 
     def target_bitrate_changed(self, bps):
         self.target_bitrate = bps
+        if self.abr is not None:
+            self.abr.reset(bps)
         self.send_target_bitrate()
 
+    def send_fec_percentage(self):
+        self.send_if_connected(MessageBuilder.set_fec_percentage(self.fec_percentage))
+
+    def fec_percentage_changed(self, percentage):
+        self.fec_percentage = percentage
+        self.send_fec_percentage()
+
+    def set_recording(self, recording):
+        """Starts or stops recording to a file on the server"""
+        return self.send_if_connected(MessageBuilder.set_recording(recording))
+
+    def request_profile_report(self):
+        return self.send_if_connected(MessageBuilder.PROFILE_REQUEST)
+
+    def send_frame_timestamps(self):
+        self.send_if_connected(MessageBuilder.set_frame_timestamps(self.frame_timestamps))
+
+    def enable_abr(self, floor, ceiling):
+        """Turns on adaptive bitrate, which changes the target bitrate on every stats update"""
+        logger.info(f'adaptive bitrate on, {floor} to {ceiling} bps')
+        self.abr = AimdBitrateController(floor, ceiling, initial=self.target_bitrate or None)
+        self.target_bitrate = self.abr.bitrate
+
+    def abr_update(self, rtt, new_success_pkts, new_failure_pkts, stats):
+        """Feeds what happened since the last stats update into adaptive bitrate"""
+        if self.abr is None or not stats.get('owner', 1):
+            # only the owner can change the bitrate
+            return
+        total_pkts = new_success_pkts + new_failure_pkts
+        loss_rate = new_failure_pkts / total_pkts if total_pkts > 0 else 0
+        bitrate = self.abr.update(loss_rate, rtt, stats['actual_bitrate'])
+        if bitrate != self.target_bitrate:
+            logger.debug(f'adaptive bitrate {self.target_bitrate} -> {bitrate} bps, loss {loss_rate:.3f}, rtt {rtt * 1e3:.1f} ms')
+            self.target_bitrate = bitrate
+            self.send_target_bitrate()
+
 
 class VideoAppWindow(Gtk.ApplicationWindow):
-    def __init__(self, settings):
+    def __init__(self, settings, profile_dir=None, startup_profile=None):
         super().__init__(title='rpividctrl_client')
 
         ip_address = settings.get('ip_address') or '127.0.0.1'
         width = settings.get('width') or 320
         height = settings.get('height') or 240
         framerate = settings.get('framerate') or 30
-        selected_h264_decoder_name = settings.get('h264_decoder') or 'avdec_h264'  # avdec_h264 is software h264 decoder
-        selected_h264_decoder = Gst.ElementFactory.find(selected_h264_decoder_name)
+        selected_h264_decoder_name = settings.get('h264_decoder') or 'auto'
+        # auto: the fastest decoder on this machine, benchmarked once per resolution and cached
+        self.auto_h264_decoder = selected_h264_decoder_name == 'auto'
+        self.h264_benchmark_running = False
+        if self.auto_h264_decoder:
+            selected_h264_decoder = h264_decoders.select_decoder(width, height, benchmark=False)
+            if selected_h264_decoder is None:
+                # not benchmarked at this resolution yet. start with the software decoder, and switch once the
+                # benchmark is done, instead of keeping the window from showing up for seconds
+                selected_h264_decoder = h264_decoders.fallback_decoder()
+                self.start_h264_benchmark(width, height)
+        else:
+            selected_h264_decoder = Gst.ElementFactory.find(selected_h264_decoder_name)
         if selected_h264_decoder is None:
             raise ValueError(f'could not find selected h264 encoder "{selected_h264_decoder_name}"')
+        if startup_profile is not None:
+            startup_profile.step('h264 decoder registry scan')
         annotation_mode_str = settings.get('annotation_mode') or 'none'
         drc_level_str = settings.get('drc_level') or 'off'
         target_birtate_str = settings.get('target_bitrate') or '1M'
         chosen_overlay_display_name = settings.get('overlay')
+        abr = settings.get('abr') or False  # adaptive bitrate
+        abr_min_bitrate = settings.get('abr_min_bitrate') or 150000
+        abr_max_bitrate = settings.get('abr_max_bitrate') or 2000000
+        live_renegotiation = settings.get('live_renegotiation', True)  # false: restart the pipeline to swap decoders
+        fec_percentage_str = settings.get('fec_percentage') or 'off'  # forward error correction
+        fec_latency = settings.get('fec_latency') or 40  # ms to wait for fec packets
+        glass_to_glass = settings.get('glass_to_glass') or False  # measure camera -> display latency
+        latency_sample_interval = settings.get('latency_sample_interval') or 4  # measure pipeline latency every nth frame
+        overlay_cache = settings.get('overlay_cache', True)  # false: redraw the overlay's static layer on every draw
+        overlay_mode = settings.get('overlay_mode') or 'gtk'  # gtk or gl (drawn into every frame, blended on the gpu)
+        record_settings = {
+            'directory': settings.get('record_dir') or 'recordings',
+            'format': settings.get('record_format') or 'mkv',  # mkv or mp4
+            'segment_time': settings.get('record_segment_time', 60),  # seconds per file, 0 for no limit
+            'segment_size': int(settings.get('record_segment_size', 0) * 1e6),  # MB per file, 0 for no limit
+            'replay_seconds': settings.get('replay_seconds', 30)  # seconds kept in memory for instant replay, 0 for off
+        }
 
         self.remote_control = RemoteControl(self.remote_control_status_change, self.remote_control_stats_update)
+        self.remote_control.frame_timestamps = glass_to_glass
 
         self.prev_success_pkts = 0
         self.prev_failure_pkts = 0
@@ -480,9 +956,8 @@ class VideoAppWindow(Gtk.ApplicationWindow):
         # resolution
 
         resolution_store = Gtk.ListStore(int, int, str)
-        resolution_store.append([640, 480, '640x480'])
-        resolution_store.append([320, 240, '320x240'])
-        resolution_store.append([160, 120, '160x120'])
+        for resolution_width, resolution_height in RESOLUTIONS:
+            resolution_store.append([resolution_width, resolution_height, f'{resolution_width}x{resolution_height}'])
         resolution_combobox = Gtk.ComboBox.new_with_model(resolution_store)
         for i, resolution in enumerate(resolution_store):
             if resolution[0] == width and resolution[1] == height:
@@ -498,11 +973,8 @@ class VideoAppWindow(Gtk.ApplicationWindow):
         # framerate
 
         framerate_store = Gtk.ListStore(int, str)
-        framerate_store.append([90, '90fps'])
-        framerate_store.append([60, '60fps'])
-        framerate_store.append([45, '45fps'])
-        framerate_store.append([30, '30fps'])
-        framerate_store.append([15, '15fps'])
+        for framerate_option in FRAMERATES:
+            framerate_store.append([framerate_option, f'{framerate_option}fps'])
         framerate_combobox = Gtk.ComboBox.new_with_model(framerate_store)
         for i, framerate_info in enumerate(framerate_store):
             if framerate_info[0] == framerate:
@@ -578,11 +1050,8 @@ class VideoAppWindow(Gtk.ApplicationWindow):
         remote_bar.add(bitrate_label)
 
         bitrate_store = Gtk.ListStore(str, int)
-        bitrate_store.append(['50K', 50000])
-        bitrate_store.append(['150K', 150000])
-        bitrate_store.append(['500K', 500000])
-        bitrate_store.append(['1M', 1000000])
-        bitrate_store.append(['2M', 2000000])
+        for bitrate_info in TARGET_BITRATES:
+            bitrate_store.append(list(bitrate_info))
         bitrate_combobox = Gtk.ComboBox.new_with_model(bitrate_store)
         for i, bitrate_info in enumerate(bitrate_store):
             display_str, bps = bitrate_info
@@ -595,6 +1064,37 @@ class VideoAppWindow(Gtk.ApplicationWindow):
         bitrate_combobox.pack_start(bitrate_renderer, True)
         bitrate_combobox.add_attribute(bitrate_renderer, 'text', 0)
         remote_bar.add(bitrate_combobox)
+        if abr:
+            # the combobox picks the starting bitrate, then adaptive bitrate takes over
+            self.remote_control.enable_abr(abr_min_bitrate, abr_max_bitrate)
+
+        # forward error correction
+
+        fec_label = Gtk.Label()
+        fec_label.set_text('fec:')
+        remote_bar.add(fec_label)
+
+        fec_store = Gtk.ListStore(str, int)
+        for fec_info in FEC_PERCENTAGES:
+            fec_store.append(list(fec_info))
+        fec_combobox = Gtk.ComboBox.new_with_model(fec_store)
+        for i, fec_info in enumerate(fec_store):
+            display_str, percentage = fec_info
+            if display_str == fec_percentage_str:
+                fec_combobox.set_active(i)
+                self.remote_control.fec_percentage_changed(percentage)
+                break
+        fec_combobox.connect('changed', self.on_fec_percentage_changed)
+        fec_renderer = Gtk.CellRendererText()
+        fec_combobox.pack_start(fec_renderer, True)
+        fec_combobox.add_attribute(fec_renderer, 'text', 0)
+        remote_bar.add(fec_combobox)
+
+        record_button = Gtk.ToggleButton.new_with_label('record')
+        record_button.set_tooltip_text('record to a file on the server')
+        record_button.connect('toggled', self.on_record_toggled)
+        remote_bar.add(record_button)
+        self.record_button = record_button
 
         # status labels
 
@@ -608,7 +1108,25 @@ class VideoAppWindow(Gtk.ApplicationWindow):
 
         # video
 
-        self.video = VideoWidget(width, height, h264dec_factory=selected_h264_decoder, expand=True)
+        self.video = VideoWidget(width, height, h264dec_factory=selected_h264_decoder, live_renegotiation=live_renegotiation,
+                                 fec_latency=fec_latency, latency_sample_interval=latency_sample_interval,
+                                 record_settings=record_settings, overlay_cache=overlay_cache,
+                                 overlay_mode=overlay_mode, expand=True)
+        self.video.set_fec_enabled(self.remote_control.fec_percentage > 0)
+        self.video.on_keyframe_request = self.remote_control.request_keyframe
+        self.remote_control.on_vision_result = self.video.add_vision_result
+        self.video.measure_glass_to_glass = glass_to_glass
+        self.remote_control.on_frame_timestamp = self.video.add_capture_time
+
+        # --profile
+        self.profile_dir = profile_dir
+        self.profiler = None
+        if profile_dir is not None:
+            self.profiler = profiling.Profiler('rpividctrl_client')
+            self.profiler.start()
+            self.video.profiler = self.profiler
+            self.remote_control.on_profile_report = self.on_server_profile_report
+        self.video.startup_profile = startup_profile  # --startup-profile
         self.grid.attach_next_to(self.video, remote_bar, Gtk.PositionType.BOTTOM, 1, 1)
 
         # local bar (controls local video processing)
@@ -619,45 +1137,22 @@ class VideoAppWindow(Gtk.ApplicationWindow):
         h264_decoder_label.set_text('h264 decoder:')
         local_bar.add(h264_decoder_label)
 
-        h264_decoders = []
-        # find element where only h264 can go in (sinked), and video/x-raw can come out (srced)
-        # these are h264 decoders
-        h264_caps = Gst.Caps.from_string('video/x-h264')
-        for element_factory in Gst.Registry.get().get_feature_list(Gst.ElementFactory):
-            h264_sink = False
-            raw_src_arr = [False]
-            for pad_template in element_factory.get_static_pad_templates():
-                if pad_template.direction == Gst.PadDirection.SINK and pad_template.get_caps().is_always_compatible(h264_caps):
-                    h264_sink = True
-                if pad_template.direction == Gst.PadDirection.SRC:
-                    def caps_struct_handle(userdata, struct):
-                        if struct.get_name() == 'video/x-raw':
-                            # python scope rules...
-                            raw_src_arr[0] = True
-                    pad_template.get_caps().foreach(caps_struct_handle)
-            if h264_sink and raw_src_arr[0]:
-                h264_decoders.append(element_factory)
-        h264_decoders.sort(key=Gst.ElementFactory.get_name)
-
         h264_decoders_store = Gtk.ListStore(str, object)
-        for h264_decoder in h264_decoders:
+        for h264_decoder in h264_decoders.list_h264_decoders():
             h264_decoders_store.append([h264_decoder.get_name(), h264_decoder])
-        h264_decoder_combobox = Gtk.ComboBox.new_with_model(h264_decoders_store)
-        for i, h264_decoder_info in enumerate(h264_decoders_store):
-            if h264_decoder_info[1] == selected_h264_decoder:
-                h264_decoder_combobox.set_active(i)
-                break
+        self.h264_decoder_combobox = Gtk.ComboBox.new_with_model(h264_decoders_store)
+        self.select_h264_decoder(selected_h264_decoder)
         h264_decoder_renderer = Gtk.CellRendererText()
-        h264_decoder_combobox.pack_start(h264_decoder_renderer, True)
-        h264_decoder_combobox.add_attribute(h264_decoder_renderer, 'text', 0)
-        h264_decoder_combobox.connect('changed', self.on_h264_decoder_changed)
-        local_bar.add(h264_decoder_combobox)
+        self.h264_decoder_combobox.pack_start(h264_decoder_renderer, True)
+        self.h264_decoder_combobox.add_attribute(h264_decoder_renderer, 'text', 0)
+        self.h264_decoder_combobox.connect('changed', self.on_h264_decoder_changed)
+        local_bar.add(self.h264_decoder_combobox)
 
         # overlays
         overlays_store = Gtk.ListStore(str, object)
         overlays_store.append(['none', None])
-        for overlay_cls in Overlay.list_plugins():
-            overlays_store.append([overlay_cls.get_display_name(), overlay_cls])
+        for overlay_plugin in Overlay.list_plugins():  # not imported until picked
+            overlays_store.append([overlay_plugin.display_name, overlay_plugin])
         overlay_combobox = Gtk.ComboBox.new_with_model(overlays_store)
         if chosen_overlay_display_name is None:
             overlay_combobox.set_active(0)
@@ -665,7 +1160,7 @@ class VideoAppWindow(Gtk.ApplicationWindow):
             for i, overlay_info in enumerate(overlays_store):
                 if overlay_info[0] == chosen_overlay_display_name:
                     overlay_combobox.set_active(i)
-                    self.video.set_overlay_class(overlay_info[1])
+                    self.video.set_overlay_class(overlay_info[1].load() if overlay_info[1] is not None else None)
                     break
         overlay_renderer = Gtk.CellRendererText()
         overlay_combobox.pack_start(overlay_renderer, True)
@@ -673,6 +1168,22 @@ class VideoAppWindow(Gtk.ApplicationWindow):
         overlay_combobox.connect('changed', self.on_overlay_changed)
         local_bar.add(overlay_combobox)
 
+        local_record_button = Gtk.ToggleButton.new_with_label('record')
+        local_record_button.set_tooltip_text('record the received video to a file, without re-encoding')
+        local_record_button.connect('toggled', self.on_local_record_toggled)
+        local_bar.add(local_record_button)
+
+        if record_settings['replay_seconds'] > 0:
+            save_replay_button = Gtk.Button.new_with_label('save replay')
+            save_replay_button.set_tooltip_text(f'save the last {record_settings["replay_seconds"]} seconds to a file')
+            save_replay_button.connect('clicked', self.on_save_replay_clicked)
+            local_bar.add(save_replay_button)
+
+        if self.profiler is not None:
+            save_profile_button = Gtk.Button.new_with_label('save profile')
+            save_profile_button.connect('clicked', self.on_save_profile_clicked)
+            local_bar.add(save_profile_button)
+
         # stats label
         self.local_stats_label = Gtk.Label()
         local_bar.add(self.local_stats_label)
@@ -694,33 +1205,91 @@ class VideoAppWindow(Gtk.ApplicationWindow):
         elif status == RemoteControl.STATUS_CONNECTED:
             self.connection_status_label.set_label('connected')
 
-    def remote_control_stats_update(self, rtt, stats_tuple):
+    def remote_control_stats_update(self, rtt, stats):
         # event triggered when stats are updated
 
         # remote stats
         rtt_ms = rtt * 1e3
 
-        packet_stats = self.video.rtpjitterbuffer.get_property('stats')
-        success_pkts = packet_stats.get_uint64('num-pushed')[1]
-        failure_pkts = packet_stats.get_uint64('num-lost')[1] + packet_stats.get_uint64('num-late')[1]
-        new_success_pkts = success_pkts - self.prev_success_pkts
-        new_failure_pkts = failure_pkts - self.prev_failure_pkts
-
-        remote_pipeline_latency_ms = stats_tuple[0] * 1e3
-        remote_pipeline_queues = (stats_tuple[1] + stats_tuple[2]) / 2
-
-        self.remote_stats_label.set_label(f'{rtt_ms:.1f} ms rtt, {remote_pipeline_latency_ms:.1f} ms pipeline, {remote_pipeline_queues:.3f} queue lvl, {new_failure_pkts} pkt fail, {new_success_pkts} pkt success')
+        if self.video.rtpjitterbuffer is not None:
+            packet_stats = self.video.rtpjitterbuffer.get_property('stats')
+            success_pkts = packet_stats.get_uint64('num-pushed')[1]
+            failure_pkts = packet_stats.get_uint64('num-lost')[1] + packet_stats.get_uint64('num-late')[1]
+            new_success_pkts = success_pkts - self.prev_success_pkts
+            new_failure_pkts = failure_pkts - self.prev_failure_pkts
+            packets_str = f'{new_failure_pkts} pkt fail, {new_success_pkts} pkt success, '
+        else:
+            # the pipeline is built once the window is showing, there are no packet stats before that
+            success_pkts, failure_pkts = self.prev_success_pkts, self.prev_failure_pkts
+            new_success_pkts = new_failure_pkts = 0
+            packets_str = ''
+
+        remote_pipeline_latency_ms = stats['pipeline_latency'] * 1e3
+        remote_pipeline_latency_p95_ms = stats['pipeline_latency_p95'] * 1e3
+        remote_stages_ms = '/'.join(f'{stats[stage] * 1e3:.1f}' for stage in ('encoder_latency', 'payloader_latency', 'udpsink_latency'))
+        remote_pipeline_queues = (stats['rtp_queue_level'] + stats['appsink_queue_level'] + stats['h264enc_queue_level']) / 3
+        if stats.get('vision_frames_processed'):
+            vision_str = f', {stats["vision_processing_time"] * 1e3:.1f} ms vision, {stats["vision_frames_dropped"]} vision frames dropped'
+        else:
+            vision_str = ''
+        if stats.get('recording'):
+            recording_str = f', recording ({stats["recording_frames_dropped"]} frames dropped)'
+        else:
+            recording_str = ''
+        # another viewer might have started or stopped the recording
+        self.record_button.handler_block_by_func(self.on_record_toggled)
+        self.record_button.set_active(bool(stats.get('recording')))
+        self.record_button.handler_unblock_by_func(self.on_record_toggled)
+
+        self.remote_stats_label.set_label(f'{rtt_ms:.1f} ms rtt, {remote_pipeline_latency_ms:.1f} ms pipeline ({remote_pipeline_latency_p95_ms:.1f} p95, '
+                                          f'{remote_stages_ms} enc/pay/udp), {remote_pipeline_queues:.3f} queue lvl, '
+                                          f'{stats["actual_bitrate"] / 1e3:.0f}/{stats["target_bitrate"] / 1e3:.0f} kbps, {stats["frames_dropped"]} frames dropped, '
+                                          f'{stats.get("resolution_switch_gap", 0) * 1e3:.0f} ms last res switch, '
+                                          f'{packets_str}{stats.get("viewers", 1)} viewers{"" if stats.get("owner", 1) else " (not owner)"}' + vision_str + recording_str)
 
         self.prev_success_pkts = success_pkts
         self.prev_failure_pkts = failure_pkts
 
+        self.remote_control.abr_update(rtt, new_success_pkts, new_failure_pkts, stats)
+
         # local stats
-        local_stats_buffer_len = len(self.video.stats_buffer)
-        local_pipeline_latency_sum = 0
-        for latency, in self.video.stats_buffer:
-            local_pipeline_latency_sum += latency
-        local_pipeline_latency_ms = local_pipeline_latency_sum / local_stats_buffer_len * 1e3 if local_stats_buffer_len > 0 else 0
-        self.local_stats_label.set_label(f'{local_pipeline_latency_ms:.1f} ms pipeline')
+        local_latency = self.video.latency_stats.summary()
+        fec_recovered, fec_unrecovered = self.video.get_fec_stats()
+        if self.video.glass_to_glass_stats.count > 0 and self.remote_control.clock_offset.ready:
+            glass_to_glass = self.video.glass_to_glass_stats.summary()
+            # the clock offset is only accurate to half the round trip of the time sync it came from
+            glass_to_glass_str = (f', {glass_to_glass["mean"] * 1e3:.1f} ms glass-to-glass ({glass_to_glass["p50"] * 1e3:.1f}/'
+                                  f'{glass_to_glass["p95"] * 1e3:.1f}/{glass_to_glass["p99"] * 1e3:.1f} p50/p95/p99, '
+                                  f'±{self.remote_control.clock_offset.round_trip_time / 2e6:.1f} ms clock sync)')
+        else:
+            glass_to_glass_str = ''
+        if self.video.recorder is not None and self.video.recorder.recording:
+            recording_str = f', recording ({self.video.recorder.frames_dropped} frames dropped)'
+        else:
+            recording_str = ''
+        if self.video.overlay_draw_stats.count > 0:
+            overlay_draw = self.video.overlay_draw_stats.summary()
+            overlay_str = f', {overlay_draw["mean"] * 1e3:.2f} ms overlay draw ({overlay_draw["p95"] * 1e3:.2f} p95)'
+        else:
+            overlay_str = ''
+        self.local_stats_label.set_label(f'{local_latency["mean"] * 1e3:.1f} ms pipeline, {local_latency["p95"] * 1e3:.1f} ms p95, {local_latency["jitter"] * 1e3:.1f} ms jitter, '
+                                         f'{self.video.decoder_switch_gap * 1e3:.0f} ms last decoder switch, '
+                                         f'{fec_recovered}/{fec_recovered + fec_unrecovered} lost pkts recovered by fec' + glass_to_glass_str + recording_str + overlay_str)
+
+    def save_profile(self):
+        """Writes the client's profile, and asks the server for its profile"""
+        profiling.write_report(self.profiler.report(), self.profile_dir)
+        if not self.remote_control.request_profile_report():
+            logger.warning('not connected, cannot get the server profile')
+
+    def on_server_profile_report(self, report):
+        if 'error' in report:
+            logger.warning(f'no server profile: {report["error"]}')
+        else:
+            profiling.write_report(report, self.profile_dir)
+
+    def on_save_profile_clicked(self, button):
+        self.save_profile()
 
     def on_ip_address_changed(self, entry):
         # when the user types in the ip address textbox
@@ -732,8 +1301,38 @@ class VideoAppWindow(Gtk.ApplicationWindow):
         width, height, display_str = combobox.get_model()[combobox.get_active_iter()]
         logger.info(f'resolution changed width {width} height {height}')
         self.remote_control.resolution_changed(width, height)
+        if self.auto_h264_decoder:
+            h264_decoder = h264_decoders.select_decoder(width, height, benchmark=False)
+            if h264_decoder is None:
+                self.start_h264_benchmark(width, height)  # keeps the current decoder until it is done
+            elif h264_decoder != self.video.h264dec_factory:
+                self.video.h264dec_factory = h264_decoder  # change_vid_dimensions recreates the decoder
+                self.select_h264_decoder(h264_decoder, notify=False)
         self.video.change_vid_dimensions(width, height)
 
+    def start_h264_benchmark(self, width, height):
+        """Benchmarks the h264 decoders on another thread, and switches to the fastest one (see h264_decoders)"""
+        if self.h264_benchmark_running:
+            return  # the benchmarks share a cache file. the next resolution change tries again
+        self.h264_benchmark_running = True
+
+        def benchmark():
+            # the benchmark competes with the live stream for the cpu, so it is a little pessimistic for every decoder
+            h264_decoder = h264_decoders.select_decoder(width, height)
+            GLib.idle_add(self.on_h264_benchmark_done, width, height, h264_decoder)
+
+        threading.Thread(target=benchmark, name='h264_benchmark', daemon=True).start()
+
+    def on_h264_benchmark_done(self, width, height, h264_decoder):
+        self.h264_benchmark_running = False
+        if h264_decoder is None:
+            logger.warning(f'no h264 decoder at all for {width}x{height}')
+        elif self.auto_h264_decoder and (width, height) == (self.video.vid_width, self.video.vid_height) and \
+                h264_decoder != self.video.h264dec_factory:
+            self.select_h264_decoder(h264_decoder, notify=False)
+            self.video.change_h264_decoder(h264_decoder)
+        return GLib.SOURCE_REMOVE
+
     def on_framerate_changed(self, combobox):
         framerate, display_str = combobox.get_model()[combobox.get_active_iter()]
         logger.info(f'framerate changed to {framerate}')
@@ -756,15 +1355,47 @@ class VideoAppWindow(Gtk.ApplicationWindow):
         logger.info(f'target bitrate changed to {display_str}')
         self.remote_control.target_bitrate_changed(bps)
 
+    def on_fec_percentage_changed(self, combobox):
+        display_str, percentage = combobox.get_model()[combobox.get_active_iter()]
+        logger.info(f'fec changed to {display_str}')
+        self.remote_control.fec_percentage_changed(percentage)
+        self.video.set_fec_enabled(percentage > 0)
+
+    def select_h264_decoder(self, element_factory, notify=True):
+        """Shows element_factory in the h264 decoder combobox. notify=False does not call on_h264_decoder_changed"""
+        if not notify:
+            self.h264_decoder_combobox.handler_block_by_func(self.on_h264_decoder_changed)
+        for i, h264_decoder_info in enumerate(self.h264_decoder_combobox.get_model()):
+            if h264_decoder_info[1] == element_factory:
+                self.h264_decoder_combobox.set_active(i)
+                break
+        if not notify:
+            self.h264_decoder_combobox.handler_unblock_by_func(self.on_h264_decoder_changed)
+
     def on_h264_decoder_changed(self, combobox):
         h264_decoder_name, element_factory = combobox.get_model()[combobox.get_active_iter()]
         logger.info(f'h264 decoder changed to {h264_decoder_name}')
+        self.auto_h264_decoder = False  # picked by hand
         self.video.change_h264_decoder(element_factory)
 
     def on_overlay_changed(self, combobox):
-        overlay_display_name, overlay_cls = combobox.get_model()[combobox.get_active_iter()]
+        overlay_display_name, overlay_plugin = combobox.get_model()[combobox.get_active_iter()]
         logger.info(f'overlay changed to {overlay_display_name}')
-        self.video.set_overlay_class(overlay_cls)
+        self.video.set_overlay_class(overlay_plugin.load() if overlay_plugin is not None else None)
+
+    def on_record_toggled(self, button):
+        recording = button.get_active()
+        logger.info(f'{"start" if recording else "stop"} recording on the server')
+        if not self.remote_control.set_recording(recording):
+            logger.warning('not connected, cannot record')
+
+    def on_local_record_toggled(self, button):
+        recording = button.get_active()
+        logger.info(f'{"start" if recording else "stop"} recording locally')
+        self.video.set_recording(recording)
+
+    def on_save_replay_clicked(self, button):
+        self.video.save_replay()
 
     def on_play_clicked(self, button):
         logger.info('play clicked')
@@ -778,7 +1409,16 @@ class VideoAppWindow(Gtk.ApplicationWindow):
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-c', '--config', help='path to json config file')
+    parser.add_argument('--profile', nargs='?', const='.', metavar='DIR',
+                        help='collect gstreamer tracer stats, and write a report to DIR (default: current directory) on exit. '
+                             'the save profile button also gets the server\'s report, if it runs with --profile')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='log how long each step of startup took, once the pipeline is built')
     args = parser.parse_args()
+    startup_profile = None
+    if args.startup_profile:
+        startup_profile = profiling.StartupProfile(STARTUP_TIME)
+        startup_profile.step('imports')
 
     if args.config is None:
         logger.info('using default settings')
@@ -789,12 +1429,19 @@ if __name__ == '__main__':
         with open(args.config) as config_file_handle:
             settings = json.load(config_file_handle)
 
+    if args.profile is not None:
+        profiling.setup_environment()
+
     logger.info('init gstreamer')
     Gst.init(None)
+    if startup_profile is not None:
+        startup_profile.step('Gst.init')
 
     logger.info('create app window')
-    app = VideoAppWindow(settings)
+    app = VideoAppWindow(settings, profile_dir=args.profile, startup_profile=startup_profile)
     app.set_default_size(640, 480)
+    if startup_profile is not None:
+        startup_profile.step('window built')
 
     app.connect('destroy', Gtk.main_quit)
     GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, Gtk.main_quit)
@@ -802,3 +1449,7 @@ if __name__ == '__main__':
     app.show_all()
 
     Gtk.main()
+
+    if app.profiler is not None:
+        app.profiler.stop()
+        profiling.write_report(app.profiler.report(), args.profile)
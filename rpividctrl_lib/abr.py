@@ -0,0 +1,96 @@
+import time
+import collections
+
+
+class AimdBitrateController:
+    """
+    Adaptive bitrate: picks a target bitrate from packet loss and round trip time
+
+    Additive increase, multiplicative decrease, with the loss thresholds from Google Congestion Control:
+    - more than HIGH_LOSS of packets lost, or the round trip time growing (packets are queueing up somewhere):
+      decrease by a factor
+    - less than LOW_LOSS lost: increase by a fixed step, but only if the encoder is actually producing
+      close to the target bitrate (otherwise raising the target does not change anything)
+    - in between: hold
+
+    Does not depend on GLib, so it can be driven by a simulated channel (see bench/abr_simulation.py)
+    """
+
+    LOW_LOSS = 0.02
+    HIGH_LOSS = 0.10
+
+    def __init__(self, floor, ceiling, initial=None, increase_step=50000, decrease_factor=0.85,
+                 rtt_increase_threshold=0.05, min_rtt_window=10, hold_updates=4, encoder_utilization=0.7):
+        """
+        :param floor: lowest bitrate, bits per second
+        :param ceiling: highest bitrate, bits per second
+        :param initial: starting bitrate, defaults to floor
+        :param increase_step: bits per second added per update when there is no congestion
+        :param decrease_factor: multiplier on congestion without loss (with loss, decreases by loss_rate / 2 instead, if that is more)
+        :param rtt_increase_threshold: seconds above the lowest recent round trip time that counts as congestion
+        :param min_rtt_window: seconds of round trip times the lowest is taken from, so that the baseline follows
+            lasting changes (a route change, a lower wi-fi rate) instead of counting them as congestion forever
+        :param hold_updates: number of updates to wait after a decrease before increasing again
+        :param encoder_utilization: only increase if the encoder output is at least this fraction of the target
+        """
+        if floor > ceiling:
+            raise ValueError('abr floor is above ceiling')
+        self.floor = floor
+        self.ceiling = ceiling
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.rtt_increase_threshold = rtt_increase_threshold
+        self.hold_updates = hold_updates
+        self.encoder_utilization = encoder_utilization
+
+        self.bitrate = self.clamp(initial if initial is not None else floor)
+        self.min_rtt_window = min_rtt_window
+        self.rtt_samples = collections.deque()  # (time, rtt), rtts increasing, so the first one is the minimum
+        self.updates_since_decrease = hold_updates
+
+    def clamp(self, bitrate):
+        return int(min(max(bitrate, self.floor), self.ceiling))
+
+    def reset(self, bitrate):
+        """Starts from bitrate, for example after the user picks one"""
+        self.bitrate = self.clamp(bitrate)
+        self.updates_since_decrease = self.hold_updates
+
+    @property
+    def min_rtt(self):
+        """Lowest round trip time in the last min_rtt_window seconds, None before the first one"""
+        return self.rtt_samples[0][1] if self.rtt_samples else None
+
+    def update(self, loss_rate, rtt=None, actual_bitrate=None, now=None):
+        """
+        Called periodically (every stats update) with what happened since the last update
+
+        :param loss_rate: fraction of rtp packets lost or late, 0 to 1
+        :param rtt: control channel round trip time in seconds, or None if unknown
+        :param actual_bitrate: bitrate the encoder produced, or None if unknown
+        :param now: time in seconds, defaults to time.monotonic() (simulations pass their own)
+        :return: the new target bitrate
+        """
+        rtt_congested = False
+        if rtt is not None:
+            if now is None:
+                now = time.monotonic()
+            rtt_samples = self.rtt_samples
+            # a sample that is higher than a newer one can never be the minimum again
+            while rtt_samples and rtt_samples[-1][1] >= rtt:
+                rtt_samples.pop()
+            rtt_samples.append((now, rtt))
+            while rtt_samples[0][0] < now - self.min_rtt_window:
+                rtt_samples.popleft()
+            rtt_congested = rtt > self.min_rtt + self.rtt_increase_threshold
+
+        self.updates_since_decrease += 1
+
+        if loss_rate > AimdBitrateController.HIGH_LOSS or rtt_congested:
+            self.bitrate = self.clamp(self.bitrate * min(self.decrease_factor, 1 - 0.5 * loss_rate))
+            self.updates_since_decrease = 0
+        elif loss_rate < AimdBitrateController.LOW_LOSS and self.updates_since_decrease > self.hold_updates:
+            if actual_bitrate is None or actual_bitrate >= self.bitrate * self.encoder_utilization:
+                self.bitrate = self.clamp(self.bitrate + self.increase_step)
+
+        return self.bitrate
@@ -0,0 +1,291 @@
+"""
+The control protocol on asyncio, for scripts, tests and robot code that do not run a GLib main loop
+
+    client = await AsyncControlClient.connect('10.0.0.253')
+    await client.set_target_bitrate(1000000)
+    async for stats in client.stats(interval=0.5):
+        print(stats['pipeline_latency'])
+
+Same framing and encoding as the GLib SocketManager (both use rpividctrl_lib.protocol), so it talks to either server.
+"""
+import time
+import socket
+import asyncio
+import collections
+from rpividctrl_lib.protocol import REMOTE_CONTROL_PORT, MessageType, MessageReader, MessageBuilder
+
+
+class ControlProtocol(asyncio.BufferedProtocol):
+    """
+    Splits the bytes of a control connection into messages
+
+    A BufferedProtocol, so the event loop receives straight into MessageReader's buffer, like recv_into in
+    SocketManager. Calls on_message with every parsed message, and on_connection_lost with the exception (or None)
+    """
+
+    def __init__(self, on_message, on_connection_lost):
+        self.message_reader = MessageReader()
+        self.on_message = on_message
+        self.on_connection_lost = on_connection_lost
+        self.transport = None
+        self.write_paused = False
+        self.drain_waiters = collections.deque()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def get_buffer(self, sizehint):
+        return self.message_reader.get_write_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.message_reader.commit(nbytes)
+        try:
+            while True:
+                message = self.message_reader.read_message()
+                if message is None:
+                    break
+                self.on_message(message)
+        except (IOError, ValueError) as e:  # ValueError: unknown message type
+            self.transport.close()
+            self.on_connection_lost(e)
+
+    def connection_lost(self, exc):
+        self.wake_drain_waiters(exc or ConnectionResetError('connection closed'))
+        self.on_connection_lost(exc)
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        self.wake_drain_waiters(None)
+
+    def wake_drain_waiters(self, exc):
+        while self.drain_waiters:
+            waiter = self.drain_waiters.popleft()
+            if not waiter.done():
+                if exc is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(exc)
+
+    async def drain(self):
+        """Waits until the transport's write buffer is below its high water mark"""
+        if self.transport.is_closing():
+            raise ConnectionResetError('connection closed')
+        if not self.write_paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.drain_waiters.append(waiter)
+        await waiter
+
+
+class ReplyWaiters:
+    """
+    Futures for the replies to one type of request, which the server sends in order without saying which request
+    they answer
+
+    A request that stops waiting (timed out or cancelled) keeps its place, since its reply can still come late: that
+    reply is dropped, instead of going to the next request and shifting every later reply by one. Consecutive
+    abandoned requests are kept as a count, so a server that never answers does not make the queue grow.
+    """
+
+    def __init__(self):
+        self.queue = collections.deque()  # futures, and counts of replies to drop
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self):
+        waiter = asyncio.get_running_loop().create_future()
+        self.queue.append(waiter)
+        return waiter
+
+    def abandon(self, waiter):
+        """Drops the reply the waiter was waiting for. Nothing happens if the reply already came"""
+        try:
+            index = self.queue.index(waiter)
+        except ValueError:
+            return
+        count = 1
+        del self.queue[index]
+        if index < len(self.queue) and isinstance(self.queue[index], int):
+            count += self.queue[index]
+            del self.queue[index]
+        if index > 0 and isinstance(self.queue[index - 1], int):
+            count += self.queue[index - 1]
+            index -= 1
+            del self.queue[index]
+        self.queue.insert(index, count)
+
+    def pop(self):
+        """The waiter for the next reply, or None if it is to be dropped"""
+        head = self.queue[0]
+        if not isinstance(head, int):
+            return self.queue.popleft()
+        if head == 1:
+            self.queue.popleft()
+        else:
+            self.queue[0] = head - 1
+        return None
+
+    def fail(self, error):
+        for waiter in self.queue:
+            if not isinstance(waiter, int) and not waiter.done():
+                waiter.set_exception(error)
+        self.queue.clear()
+
+
+class AsyncControlClient:
+    """
+    A viewer's control connection to the server
+
+    Commands are sent right away, and awaiting them waits for the kernel to take the bytes (the server does not
+    acknowledge them). Replies (stats, time sync) are matched to their requests, in order. Every other message the
+    server sends (VISION_RESULT, FRAME_TIMESTAMP, ...) goes to on_message.
+    """
+
+    def __init__(self):
+        self.protocol = None
+        self.on_message = None  # called with the info dict of unsolicited messages
+        self.stats_waiters = ReplyWaiters()
+        self.profile_waiters = ReplyWaiters()
+        self.time_sync_waiters = {}  # client time -> future
+        self.closed = None  # future, done once the connection is lost
+
+    @classmethod
+    async def connect(cls, host, port=REMOTE_CONTROL_PORT, timeout=10):
+        client = cls()
+        loop = asyncio.get_running_loop()
+        client.closed = loop.create_future()
+        transport, client.protocol = await asyncio.wait_for(
+            loop.create_connection(lambda: ControlProtocol(client.handle_message, client.handle_connection_lost),
+                                   host, port),
+            timeout)
+        return client
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.protocol is None:
+            return
+        if not self.protocol.transport.is_closing():
+            self.protocol.transport.close()
+        await asyncio.shield(self.closed)
+
+    def handle_message(self, message):
+        message_type = message['message_type']
+        if message_type == MessageType.STATS_RESPONSE and self.stats_waiters:
+            self.resolve(self.stats_waiters.pop(), message['stats'])
+        elif message_type == MessageType.PROFILE_REPORT and self.profile_waiters:
+            self.resolve(self.profile_waiters.pop(), message['profile_report'])
+        elif message_type == MessageType.TIME_SYNC_RESPONSE and message['client_time'] in self.time_sync_waiters:
+            self.resolve(self.time_sync_waiters.pop(message['client_time']), (message, time.monotonic_ns()))
+        elif self.on_message is not None:
+            self.on_message(message)
+
+    @staticmethod
+    def resolve(waiter, result):
+        if waiter is not None and not waiter.done():  # None: a late reply to a request that timed out
+            waiter.set_result(result)
+
+    def handle_connection_lost(self, exc):
+        error = exc or ConnectionResetError('connection closed')
+        self.stats_waiters.fail(error)
+        self.profile_waiters.fail(error)
+        for waiter in self.time_sync_waiters.values():
+            if not waiter.done():
+                waiter.set_exception(error)
+        self.time_sync_waiters.clear()
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    async def send(self, message_bytes):
+        self.protocol.transport.write(message_bytes)
+        await self.protocol.drain()
+
+    async def request(self, message_bytes, waiters, timeout):
+        waiter = waiters.add()
+        try:
+            await self.send(message_bytes)
+            return await asyncio.wait_for(waiter, timeout)
+        finally:
+            # timed out or cancelled: the reply might still come, and has to be dropped
+            waiters.abandon(waiter)
+
+    async def set_resolution_framerate(self, width, height, framerate):
+        await self.send(MessageBuilder.set_resolution_framerate(width, height, framerate))
+
+    async def set_target_bitrate(self, bps):
+        await self.send(MessageBuilder.set_target_bitrate(bps))
+
+    async def set_annotation_mode(self, annotation_mode):
+        await self.send(MessageBuilder.set_annotation_mode(annotation_mode))
+
+    async def set_drc_level(self, drc_level):
+        await self.send(MessageBuilder.set_drc_level(drc_level))
+
+    async def set_fec_percentage(self, percentage):
+        await self.send(MessageBuilder.set_fec_percentage(percentage))
+
+    async def set_frame_timestamps(self, enabled):
+        await self.send(MessageBuilder.set_frame_timestamps(enabled))
+
+    async def set_recording(self, recording):
+        await self.send(MessageBuilder.set_recording(recording))
+
+    async def resume(self):
+        await self.send(MessageBuilder.RESUME)
+
+    async def pause(self):
+        await self.send(MessageBuilder.PAUSE)
+
+    async def force_keyframe(self):
+        await self.send(MessageBuilder.FORCE_KEYFRAME)
+
+    async def request_stats(self, timeout=5):
+        """The server's stats, a dict with the fields of STATS_RESPONSE_SECTIONS it knows about"""
+        return await self.request(MessageBuilder.STATS_REQUEST, self.stats_waiters, timeout)
+
+    async def request_profile_report(self, timeout=10):
+        """
+        The python server's profile report (an error if it was not started with --profile). The C++ server never
+        answers a PROFILE_REQUEST, so with it this raises asyncio.TimeoutError after timeout seconds
+        """
+        return await self.request(MessageBuilder.PROFILE_REQUEST, self.profile_waiters, timeout)
+
+    async def stats(self, interval=0.5, timeout=5):
+        """Requests the stats every interval seconds, forever"""
+        while True:
+            start = time.monotonic()
+            yield await self.request_stats(timeout)
+            await asyncio.sleep(max(interval - (time.monotonic() - start), 0))
+
+    async def time_sync(self, timeout=5):
+        """
+        One TIME_SYNC exchange. Returns (t0, t1, t2, t3) in nanoseconds, for ClockOffsetEstimator.add_sample.
+        t0 and t3 are time.monotonic_ns(), which is the same clock as the client's Gst.SystemClock
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        client_time = time.monotonic_ns()
+        while client_time in self.time_sync_waiters:
+            client_time += 1
+        self.time_sync_waiters[client_time] = waiter
+        try:
+            await self.send(MessageBuilder.time_sync_request(client_time))
+            message, receive_time = await asyncio.wait_for(waiter, timeout)
+        finally:
+            self.time_sync_waiters.pop(client_time, None)
+        return client_time, message['server_receive_time'], message['server_send_time'], receive_time
+
+    async def ping(self, timeout=5):
+        """Round trip time of a command, in seconds, without the time the server took to answer"""
+        t0, t1, t2, t3 = await self.time_sync(timeout)
+        return ((t3 - t0) - (t2 - t1)) / 1e9
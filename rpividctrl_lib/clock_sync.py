@@ -0,0 +1,46 @@
+import collections
+
+
+class ClockOffsetEstimator:
+    """
+    Estimates the offset between the server's clock and the client's clock, NTP-style
+
+    Each exchange gives four times, in nanoseconds:
+    t0: client sends TIME_SYNC_REQUEST (client clock)
+    t1: server receives it (server clock)
+    t2: server sends TIME_SYNC_RESPONSE (server clock)
+    t3: client receives it (client clock)
+
+    offset = ((t1 - t0) + (t2 - t3)) / 2 is exact if the trip there took as long as the trip back, and off by at most
+    half the round trip time otherwise. So out of the last few exchanges, the one with the shortest round trip is used.
+
+    Does not depend on GLib
+    """
+
+    def __init__(self, window=16):
+        self.samples = collections.deque(maxlen=window)  # (round trip time, offset)
+
+    def add_sample(self, t0, t1, t2, t3):
+        round_trip_time = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) // 2
+        self.samples.append((round_trip_time, offset))
+
+    @property
+    def ready(self):
+        return len(self.samples) > 0
+
+    def best_sample(self):
+        return min(self.samples)
+
+    @property
+    def offset(self):
+        """Server clock minus client clock, in ns"""
+        return self.best_sample()[1]
+
+    @property
+    def round_trip_time(self):
+        """Round trip time of the exchange the offset is from, in ns. The offset is accurate to half of it"""
+        return self.best_sample()[0]
+
+    def to_client_time(self, server_time):
+        return server_time - self.offset
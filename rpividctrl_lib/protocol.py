@@ -0,0 +1,405 @@
+"""
+The control protocol: message types, framing (MessageReader) and encoding (MessageBuilder)
+
+Only the standard library, so anything can speak the protocol: the GLib SocketManager in messaging, the asyncio
+client in aio, scripts and tests
+"""
+import struct
+from enum import IntEnum, IntFlag
+import collections
+import json
+import zlib
+
+
+REMOTE_CONTROL_PORT = 1875
+RTP_PORT = 1874
+ULPFEC_PAYLOAD_TYPE = 122  # forward error correction packets
+RED_PAYLOAD_TYPE = 123  # redundant encoding, wraps the h264 and fec packets while fec is on
+
+
+# To list all options for the camera, execute `gst-inspect-1.0 rpicamsrc` on the raspberry pi
+# For the h264 encoder, see `gst-inspect-1.0 omxh264enc` on the rpi
+
+class MessageType(IntEnum):
+    SET_RESOLUTION_FRAMERATE = 0  # resolution and framerate are set together because changing either requires creating a new CapsFilter
+    PAUSE = 1
+    RESUME = 2
+    STATS_REQUEST = 3
+    STATS_RESPONSE = 4
+    SET_ANNOTATION_MODE = 5
+    SET_DRC_LEVEL = 6
+    SET_TARGET_BITRATE = 7
+    FORCE_KEYFRAME = 8  # after packet loss or a decoder change, so the decoder does not have to wait for the next IDR
+    SET_FEC_PERCENTAGE = 9  # 0 turns forward error correction off
+    VISION_RESULT = 10  # server to client, what the vision plugins found in one frame
+    TIME_SYNC_REQUEST = 11  # client to server, for estimating the offset between their clocks
+    TIME_SYNC_RESPONSE = 12
+    SET_FRAME_TIMESTAMPS = 13  # 1 turns FRAME_TIMESTAMP messages on, 0 off
+    FRAME_TIMESTAMP = 14  # server to client, when the camera captured the frame with an rtp timestamp
+    PROFILE_REQUEST = 15  # client to server, asks for the report of a server running with --profile
+    PROFILE_REPORT = 16  # zlib compressed json
+    SET_RECORDING = 17  # 1 starts recording to a file on the server, 0 stops
+
+
+class AnnotationMode(IntFlag):
+    """
+    GstRpiCamSrcAnnotationMode
+
+    raspberry pi camera debug overlays
+
+    These are flags, so multiple can be applied at once (i.e. BLACK_BACKGROUND | FRAME_NUMBER)
+    """
+    NONE = 0x00000000
+    CUSTOM_TEXT = 0x00000001
+    TEXT = 0x00000002
+    DATE = 0x00000004
+    TIME = 0x00000008
+    SHUTTER_SETTINGS = 0x00000010
+    CAF_SETTINGS = 0x00000020  # caf == continuous auto focus?
+    GAIN_SETTINGS = 0x00000040
+    LENS_SETTINGS = 0x00000080
+    MOTIONS_SETTINGS = 0x00000100
+    FRAME_NUMBER = 0x00000200
+    BLACK_BACKGROUND = 0x00000400
+
+
+class DRCLevel(IntEnum):
+    """GstRpiCamSrcDRCLevel
+
+    dynamic range compression
+
+    When turned on, this settings makes dark areas of the image brighter
+    """
+    OFF = 0
+    LOW = 1
+    MEDIUM = 2
+    HIGH = 3
+
+
+MESSAGE_LEN_STRUCT = struct.Struct('>H')
+RESOLUTION_FRAMERATE_STRUCT = struct.Struct('>3H')
+ANNOTATION_MODE_STRUCT = struct.Struct('>H')
+DRC_LEVEL_STRUCT = struct.Struct('B')
+TARGET_BITRATE_STRUCT = struct.Struct('>I')
+FEC_PERCENTAGE_STRUCT = struct.Struct('B')
+STATS_RESPONSE_VERSION_STRUCT = struct.Struct('B')
+VISION_RESULT_STRUCT = struct.Struct('>IIH')  # frame number, rtp timestamp, number of detections
+TIME_SYNC_REQUEST_STRUCT = struct.Struct('>Q')  # client time
+TIME_SYNC_RESPONSE_STRUCT = struct.Struct('>3Q')  # client time from the request, server receive time, server send time
+FRAME_TIMESTAMPS_STRUCT = struct.Struct('B')
+FRAME_TIMESTAMP_STRUCT = struct.Struct('>IQ')  # rtp timestamp, capture time
+RECORDING_STRUCT = struct.Struct('B')
+DETECTION_STRUCT = struct.Struct('>B4HB')  # label, x, y, width, height, confidence
+DETECTION_MAX = 0xffff  # x, y, width and height are sent as fractions of the frame size, confidence as a fraction of 0xff
+
+# the rtp timestamp is the one of the frame the vision plugins looked at, so the client can match results to the
+# frame it is displaying
+VisionResult = collections.namedtuple('VisionResult', ('frame_number', 'rtp_timestamp', 'detections'))
+# x, y (top left corner), width and height are fractions of the frame size, from 0 to 1. label is up to the vision plugin
+Detection = collections.namedtuple('Detection', ('label', 'x', 'y', 'width', 'height', 'confidence'))
+
+# times in TIME_SYNC_* and FRAME_TIMESTAMP messages are nanoseconds of the sender's monotonic clock
+# (Gst.SystemClock, which is CLOCK_MONOTONIC)
+
+# STATS_RESPONSE starts with a 1-byte version, followed by the fields of every section up to and including that version.
+# Newer versions only append sections, so a reader can use the fields it knows about from a newer sender.
+# Latencies are in seconds, queue levels in buffers, bitrates in bits per second.
+STATS_RESPONSE_VERSION = 5
+STATS_RESPONSE_SECTIONS = [
+    (1, struct.Struct('>5f3f3f2IQ2I'), (
+        'pipeline_latency', 'pipeline_latency_p50', 'pipeline_latency_p95', 'pipeline_latency_p99', 'pipeline_latency_jitter',
+        'encoder_latency', 'payloader_latency', 'udpsink_latency',  # camsrc->encoder, encoder->payloader, payloader->udpsink
+        'rtp_queue_level', 'appsink_queue_level', 'h264enc_queue_level',
+        'frames_encoded', 'frames_dropped',
+        'bytes_sent',
+        'actual_bitrate', 'target_bitrate'
+    )),
+    (2, struct.Struct('>f'), (
+        'resolution_switch_gap',  # last frame before a resolution change to the first frame after
+    )),
+    (3, struct.Struct('>BB'), (
+        'viewers',  # clients connected to the server
+        'owner'  # 1 if the client receiving the stats can change resolution/framerate/bitrate, otherwise 0
+    )),
+    (4, struct.Struct('>f2I'), (
+        'vision_processing_time',  # per frame, all vision plugins together
+        'vision_frames_processed', 'vision_frames_dropped'  # dropped because the vision plugins were still busy
+    )),
+    (5, struct.Struct('>BI'), (
+        'recording',  # 1 if the server is recording to a file
+        'recording_frames_dropped'  # dropped because the file could not be written fast enough
+    )),
+]
+
+
+class MessageReader:
+    """
+    Organizes incoming bytes into messages.
+
+    Each messages starts with a 2-byte length, then a 1-byte message type, and then 0 or more bytes
+    specific to that type of message. The length includes the 1-byte message type.
+
+    Incoming bytes are stored in a preallocated buffer. Use get_write_buffer() and commit() to receive directly
+    into it (with socket.recv_into), so that bytes are never copied between the socket and the parser.
+    Unread bytes are only moved to the start of the buffer when the free space at the end runs out.
+    """
+    MAX_BYTES_AVAILABLE = 50000
+
+    def __init__(self):
+        self.buf = bytearray(MessageReader.MAX_BYTES_AVAILABLE)
+        self.view = memoryview(self.buf)
+        self.read_pos = 0
+        self.write_pos = 0
+
+    @property
+    def bytes_available(self):
+        return self.write_pos - self.read_pos
+
+    def compact(self):
+        """Moves unread bytes to the start of the buffer"""
+        bytes_available = self.write_pos - self.read_pos
+        if self.read_pos > 0:
+            self.buf[0:bytes_available] = self.view[self.read_pos:self.write_pos]
+            self.read_pos = 0
+            self.write_pos = bytes_available
+
+    def get_write_buffer(self):
+        """Returns a memoryview of the free space at the end of the buffer
+
+        After writing n bytes into it, call commit(n)"""
+        if self.write_pos == len(self.buf):
+            self.compact()
+            if self.write_pos == len(self.buf):
+                raise IOError('bytes stored exceeds maximum')
+        return self.view[self.write_pos:]
+
+    def commit(self, num_bytes):
+        """Marks num_bytes written into get_write_buffer() as received"""
+        self.write_pos += num_bytes
+
+    def append(self, buf):
+        """Copies buf into the buffer. Prefer get_write_buffer() and commit() when receiving from a socket"""
+        buf_len = len(buf)
+        if self.write_pos + buf_len > len(self.buf):
+            self.compact()
+            if self.write_pos + buf_len > len(self.buf):
+                raise IOError('bytes stored exceeds maximum')
+        self.buf[self.write_pos:self.write_pos + buf_len] = buf
+        self.write_pos += buf_len
+
+    def read_message(self):
+        bytes_available = self.write_pos - self.read_pos
+        if bytes_available < 2:
+            return None
+
+        # big endian uint16_t for next message length
+        message_len = MESSAGE_LEN_STRUCT.unpack_from(self.buf, self.read_pos)[0]
+        if message_len == 0:
+            raise IOError('received empty message')
+        if bytes_available < 2 + message_len:
+            if 2 + message_len > len(self.buf):
+                raise IOError('message length exceeds maximum')
+            return None
+
+        message_offset = self.read_pos + 2
+        self.read_pos = message_offset + message_len
+        info = self.parse_message(self.buf, message_offset, message_len)
+        if self.read_pos == self.write_pos:
+            # everything has been read, so the buffer can be reused from the start without moving anything
+            self.read_pos = 0
+            self.write_pos = 0
+        return info
+
+    @staticmethod
+    def unpack_content(content_struct, buf, offset, message_len):
+        """Unpacks the bytes following the message type"""
+        if message_len - 1 != content_struct.size:
+            raise IOError(f'improper message len {message_len}')
+        return content_struct.unpack_from(buf, offset + 1)
+
+    @staticmethod
+    def unpack_stats(buf, offset, message_len):
+        """Unpacks a STATS_RESPONSE into (version, dict of fields)"""
+        end = offset + message_len
+        version = STATS_RESPONSE_VERSION_STRUCT.unpack_from(buf, offset + 1)[0]
+        if version < 1:
+            raise IOError(f'unknown stats response version {version}')
+        section_offset = offset + 1 + STATS_RESPONSE_VERSION_STRUCT.size
+        stats = {}
+        for section_version, section_struct, field_names in STATS_RESPONSE_SECTIONS:
+            if section_version > version:
+                break
+            if section_offset + section_struct.size > end:
+                raise IOError(f'stats response version {version} too short')
+            stats.update(zip(field_names, section_struct.unpack_from(buf, section_offset)))
+            section_offset += section_struct.size
+        return version, stats
+
+    @staticmethod
+    def unpack_vision_result(buf, offset, message_len):
+        if message_len < 1 + VISION_RESULT_STRUCT.size:
+            raise IOError('vision result too short')
+        frame_number, rtp_timestamp, num_detections = VISION_RESULT_STRUCT.unpack_from(buf, offset + 1)
+        if message_len != 1 + VISION_RESULT_STRUCT.size + num_detections * DETECTION_STRUCT.size:
+            raise IOError(f'vision result with {num_detections} detections has wrong length {message_len}')
+        detections = []
+        detection_offset = offset + 1 + VISION_RESULT_STRUCT.size
+        for i in range(num_detections):
+            label, x, y, width, height, confidence = DETECTION_STRUCT.unpack_from(buf, detection_offset)
+            detections.append(Detection(label, x / DETECTION_MAX, y / DETECTION_MAX, width / DETECTION_MAX, height / DETECTION_MAX,
+                                        confidence / 0xff))
+            detection_offset += DETECTION_STRUCT.size
+        return VisionResult(frame_number, rtp_timestamp, detections)
+
+    def parse_message(self, buf, offset=0, message_len=None):
+        """Parses a message (without the 2-byte length prefix) starting at buf[offset]"""
+        if message_len is None:
+            message_len = len(buf) - offset
+        message_type = buf[offset]
+
+        info = {
+            'message_type': MessageType(message_type)
+        }
+
+        if message_type == MessageType.SET_RESOLUTION_FRAMERATE:
+            info['width'], info['height'], info['framerate'] = MessageReader.unpack_content(RESOLUTION_FRAMERATE_STRUCT, buf, offset, message_len)
+        elif message_type == MessageType.SET_ANNOTATION_MODE:
+            info['annotation_mode'] = AnnotationMode(MessageReader.unpack_content(ANNOTATION_MODE_STRUCT, buf, offset, message_len)[0])
+        elif message_type == MessageType.SET_DRC_LEVEL:
+            info['drc_level'] = DRCLevel(MessageReader.unpack_content(DRC_LEVEL_STRUCT, buf, offset, message_len)[0])
+        elif message_type == MessageType.SET_TARGET_BITRATE:
+            info['target_bitrate'] = MessageReader.unpack_content(TARGET_BITRATE_STRUCT, buf, offset, message_len)[0]
+        elif message_type == MessageType.SET_FEC_PERCENTAGE:
+            info['fec_percentage'] = MessageReader.unpack_content(FEC_PERCENTAGE_STRUCT, buf, offset, message_len)[0]
+        elif message_type == MessageType.TIME_SYNC_REQUEST:
+            info['client_time'] = MessageReader.unpack_content(TIME_SYNC_REQUEST_STRUCT, buf, offset, message_len)[0]
+        elif message_type == MessageType.TIME_SYNC_RESPONSE:
+            info['client_time'], info['server_receive_time'], info['server_send_time'] = \
+                MessageReader.unpack_content(TIME_SYNC_RESPONSE_STRUCT, buf, offset, message_len)
+        elif message_type == MessageType.SET_FRAME_TIMESTAMPS:
+            info['frame_timestamps'] = bool(MessageReader.unpack_content(FRAME_TIMESTAMPS_STRUCT, buf, offset, message_len)[0])
+        elif message_type == MessageType.SET_RECORDING:
+            info['recording'] = bool(MessageReader.unpack_content(RECORDING_STRUCT, buf, offset, message_len)[0])
+        elif message_type == MessageType.FRAME_TIMESTAMP:
+            info['rtp_timestamp'], info['capture_time'] = MessageReader.unpack_content(FRAME_TIMESTAMP_STRUCT, buf, offset, message_len)
+        elif message_type == MessageType.PROFILE_REPORT:
+            try:
+                info['profile_report'] = json.loads(zlib.decompress(buf[offset + 1:offset + message_len]))
+            except (zlib.error, ValueError) as e:
+                raise IOError(f'bad profile report: {e}')
+        elif message_type == MessageType.STATS_RESPONSE:
+            info['stats_version'], info['stats'] = MessageReader.unpack_stats(buf, offset, message_len)
+        elif message_type == MessageType.VISION_RESULT:
+            info['vision_result'] = MessageReader.unpack_vision_result(buf, offset, message_len)
+
+        return info
+
+
+class MessageBuilder:
+
+    # these 5 declared here for pycharm autocomplete
+    RESUME = None
+    PAUSE = None
+    STATS_REQUEST = None
+    FORCE_KEYFRAME = None
+    PROFILE_REQUEST = None
+
+    @staticmethod
+    def len_to_bytes(message_len):
+        return MESSAGE_LEN_STRUCT.pack(message_len)
+
+    @staticmethod
+    def single_byte_command(message_type: MessageType):
+        return MessageBuilder.MESSAGE_LEN_1 + bytes([message_type])
+
+    @staticmethod
+    def set_resolution_framerate(width, height, framerate):
+        return MessageBuilder.SET_RESOLUTION_FRAMERATE_HEADER + RESOLUTION_FRAMERATE_STRUCT.pack(width, height, framerate)
+
+    @staticmethod
+    def set_annotation_mode(annotation_mode):
+        return MessageBuilder.SET_ANNOTATION_MODE_HEADER + ANNOTATION_MODE_STRUCT.pack(int(annotation_mode))
+
+    @staticmethod
+    def set_drc_level(drc_level):
+        return MessageBuilder.SET_DRC_LEVEL_HEADER + DRC_LEVEL_STRUCT.pack(int(drc_level))
+
+    @staticmethod
+    def set_target_bitrate(bps):
+        return MessageBuilder.SET_TARGET_BITRATE_HEADER + TARGET_BITRATE_STRUCT.pack(bps)
+
+    @staticmethod
+    def set_fec_percentage(percentage):
+        return MessageBuilder.SET_FEC_PERCENTAGE_HEADER + FEC_PERCENTAGE_STRUCT.pack(percentage)
+
+    @staticmethod
+    def time_sync_request(client_time):
+        return MessageBuilder.TIME_SYNC_REQUEST_HEADER + TIME_SYNC_REQUEST_STRUCT.pack(client_time)
+
+    @staticmethod
+    def time_sync_response(client_time, server_receive_time, server_send_time):
+        return MessageBuilder.TIME_SYNC_RESPONSE_HEADER + TIME_SYNC_RESPONSE_STRUCT.pack(client_time, server_receive_time, server_send_time)
+
+    @staticmethod
+    def set_frame_timestamps(enabled):
+        return MessageBuilder.SET_FRAME_TIMESTAMPS_HEADER + FRAME_TIMESTAMPS_STRUCT.pack(int(enabled))
+
+    @staticmethod
+    def set_recording(enabled):
+        return MessageBuilder.SET_RECORDING_HEADER + RECORDING_STRUCT.pack(int(enabled))
+
+    @staticmethod
+    def frame_timestamp(rtp_timestamp, capture_time):
+        return MessageBuilder.FRAME_TIMESTAMP_HEADER + FRAME_TIMESTAMP_STRUCT.pack(rtp_timestamp & 0xffffffff, capture_time)
+
+    @staticmethod
+    def profile_report(report):
+        """report is a dict of json types. Raises ValueError if it does not fit in a message"""
+        data = zlib.compress(json.dumps(report, separators=(',', ':')).encode())
+        if 1 + len(data) > min(0xffff, MessageReader.MAX_BYTES_AVAILABLE - 2):
+            raise ValueError(f'profile report is too big, {len(data)} bytes compressed')
+        return MessageBuilder.len_to_bytes(1 + len(data)) + bytes([MessageType.PROFILE_REPORT]) + data
+
+    @staticmethod
+    def vision_result(frame_number, rtp_timestamp, detections):
+        """detections is a list of Detection"""
+        # the message length has to fit in 2 bytes, and the whole message in the reader's buffer
+        detections = detections[:(min(0xffff, MessageReader.MAX_BYTES_AVAILABLE - 2) - 1 - VISION_RESULT_STRUCT.size) // DETECTION_STRUCT.size]
+
+        def to_fraction(value, maximum):
+            return round(min(max(value, 0.0), 1.0) * maximum)
+
+        return MessageBuilder.len_to_bytes(1 + VISION_RESULT_STRUCT.size + len(detections) * DETECTION_STRUCT.size) \
+            + bytes([MessageType.VISION_RESULT]) \
+            + VISION_RESULT_STRUCT.pack(frame_number & 0xffffffff, rtp_timestamp & 0xffffffff, len(detections)) \
+            + b''.join(DETECTION_STRUCT.pack(detection.label, to_fraction(detection.x, DETECTION_MAX), to_fraction(detection.y, DETECTION_MAX),
+                                             to_fraction(detection.width, DETECTION_MAX), to_fraction(detection.height, DETECTION_MAX),
+                                             to_fraction(detection.confidence, 0xff))
+                       for detection in detections)
+
+    @staticmethod
+    def stats_response(stats):
+        """stats is a dict with every field in STATS_RESPONSE_SECTIONS"""
+        return MessageBuilder.STATS_RESPONSE_HEADER + b''.join(
+            section_struct.pack(*(stats[field_name] for field_name in field_names))
+            for section_version, section_struct, field_names in STATS_RESPONSE_SECTIONS)
+
+
+MessageBuilder.MESSAGE_LEN_1 = MessageBuilder.len_to_bytes(1)
+MessageBuilder.SET_RESOLUTION_FRAMERATE_HEADER = MessageBuilder.len_to_bytes(1 + RESOLUTION_FRAMERATE_STRUCT.size) + bytes([MessageType.SET_RESOLUTION_FRAMERATE])
+MessageBuilder.SET_ANNOTATION_MODE_HEADER = MessageBuilder.len_to_bytes(1 + ANNOTATION_MODE_STRUCT.size) + bytes([MessageType.SET_ANNOTATION_MODE])
+MessageBuilder.SET_DRC_LEVEL_HEADER = MessageBuilder.len_to_bytes(1 + DRC_LEVEL_STRUCT.size) + bytes([MessageType.SET_DRC_LEVEL])
+MessageBuilder.SET_TARGET_BITRATE_HEADER = MessageBuilder.len_to_bytes(1 + TARGET_BITRATE_STRUCT.size) + bytes([MessageType.SET_TARGET_BITRATE])
+MessageBuilder.SET_FEC_PERCENTAGE_HEADER = MessageBuilder.len_to_bytes(1 + FEC_PERCENTAGE_STRUCT.size) + bytes([MessageType.SET_FEC_PERCENTAGE])
+MessageBuilder.TIME_SYNC_REQUEST_HEADER = MessageBuilder.len_to_bytes(1 + TIME_SYNC_REQUEST_STRUCT.size) + bytes([MessageType.TIME_SYNC_REQUEST])
+MessageBuilder.TIME_SYNC_RESPONSE_HEADER = MessageBuilder.len_to_bytes(1 + TIME_SYNC_RESPONSE_STRUCT.size) + bytes([MessageType.TIME_SYNC_RESPONSE])
+MessageBuilder.SET_FRAME_TIMESTAMPS_HEADER = MessageBuilder.len_to_bytes(1 + FRAME_TIMESTAMPS_STRUCT.size) + bytes([MessageType.SET_FRAME_TIMESTAMPS])
+MessageBuilder.SET_RECORDING_HEADER = MessageBuilder.len_to_bytes(1 + RECORDING_STRUCT.size) + bytes([MessageType.SET_RECORDING])
+MessageBuilder.FRAME_TIMESTAMP_HEADER = MessageBuilder.len_to_bytes(1 + FRAME_TIMESTAMP_STRUCT.size) + bytes([MessageType.FRAME_TIMESTAMP])
+MessageBuilder.STATS_RESPONSE_HEADER = MessageBuilder.len_to_bytes(1 + STATS_RESPONSE_VERSION_STRUCT.size + sum(section_struct.size for section_version, section_struct, field_names in STATS_RESPONSE_SECTIONS)) \
+                                      + bytes([MessageType.STATS_RESPONSE]) + STATS_RESPONSE_VERSION_STRUCT.pack(STATS_RESPONSE_VERSION)
+MessageBuilder.PAUSE = MessageBuilder.single_byte_command(MessageType.PAUSE)
+MessageBuilder.RESUME = MessageBuilder.single_byte_command(MessageType.RESUME)
+MessageBuilder.STATS_REQUEST = MessageBuilder.single_byte_command(MessageType.STATS_REQUEST)
+MessageBuilder.FORCE_KEYFRAME = MessageBuilder.single_byte_command(MessageType.FORCE_KEYFRAME)
+MessageBuilder.PROFILE_REQUEST = MessageBuilder.single_byte_command(MessageType.PROFILE_REQUEST)
@@ -1,25 +1,84 @@
 import gi
 
 gi.require_version('Gst', '1.0')
-from gi.repository import Gst, GLib
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstVideo, GLib
 import socket
 import logging
-from rpividctrl_lib.messaging import REMOTE_CONTROL_PORT, RTP_PORT, MessageType, SocketManager, MessageBuilder
+from rpividctrl_lib.messaging import REMOTE_CONTROL_PORT, RTP_PORT, ULPFEC_PAYLOAD_TYPE, RED_PAYLOAD_TYPE, MessageType, SocketManager, MessageBuilder
 import time
+import struct
 import collections
-from common import get_pad, dict_to_struct, STATS_BUFFER_LEN
+from common import get_pad, dict_to_struct
+from stats import RollingStats
+from vision import VisionPlugin, VisionWorker
+import profiling
+import metrics
+from recording import Recorder
 import os
+import signal
+from argparse import ArgumentParser
 
 logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s %(name)s] %(message)s')
 logger = logging.getLogger('rpividctrl_server')
 
 IPV4_UDP_OVERHEAD = 20 + 8  # 20 byte IPv4 header + 8 byte UDP header
+# a fec packet is as big as the biggest packet it protects, plus a 1 byte RED header, 10 byte ULPFEC header and
+# 6 byte ULPFEC level header (with the long mask)
+FEC_OVERHEAD = 1 + 10 + 6
+RTP_CLOCK_RATE = 90000  # rtp timestamps for video are in 1/90000 s
+RTP_TIMESTAMP_OFFSET = 4  # in the rtp header
+RTP_TIMESTAMP_STRUCT = struct.Struct('>I')
+RTP_MARKER_OFFSET = 1  # in the rtp header, the marker bit is set on the last packet of a frame
+CAMSRC_TIMES_LEN = 32  # sampled frames to keep track of on their way through the pipeline
+KEYFRAME_MIN_INTERVAL = 0.2  # seconds, ignore keyframe requests that come in faster than this
+# only the owner (the viewer that has been connected the longest) can change these, because they change the stream for everyone
+OWNER_MESSAGE_TYPES = (MessageType.SET_RESOLUTION_FRAMERATE, MessageType.SET_ANNOTATION_MODE, MessageType.SET_DRC_LEVEL,
+                       MessageType.SET_TARGET_BITRATE, MessageType.SET_FEC_PERCENTAGE, MessageType.SET_RECORDING)
+
+
+class Viewer:
+    """A connected client. It receives the rtp stream from multiudpsink while it is playing"""
+
+    def __init__(self, sock_manager, host):
+        self.sock_manager = sock_manager
+        self.host = host
+        self.playing = False
+        self.bytes_sent = 0  # before the last pause, multiudpsink forgets about a client when it is removed
+        self.last_stats_time = time.monotonic()
+        self.last_stats_bytes_sent = 0
+        self.frame_timestamps = False  # send FRAME_TIMESTAMP for every frame, for measuring glass-to-glass latency
 
 
 class Main:
     def __init__(self, settings):
         host = settings.get('host') or ''  # empty string=listen on all interfaces
         mtu = int(settings.get('mtu') or 1500)
+        # change resolution by blocking the camera while the caps are swapped, instead of pausing the whole pipeline
+        self.live_renegotiation = (settings.get('live_renegotiation') or '1') != '0'
+        # let several clients watch the same stream, instead of a new connection replacing the old one
+        self.multi_viewer = (settings.get('multi_viewer') or '0') != '0'
+        # v4l2src for the camera, videotestsrc to test without a camera, or filesrc to play back a recorded video
+        self.source = settings.get('source') or 'v4l2src'
+        if self.source not in ('v4l2src', 'videotestsrc', 'filesrc'):
+            raise ValueError(f'unknown source {self.source}')
+        self.source_file = settings.get('source_file')  # for filesrc
+        if self.source == 'filesrc' and not self.source_file:
+            raise ValueError('filesrc needs a source_file')
+        # keep the camera element after the client disconnects, so reconnecting does not have to power up the camera and
+        # negotiate again. value is how long to keep it for, in ms. 0 to destroy it immediately
+        self.warm_standby = int(settings.get('warm_standby') or 0)
+        self.standby_timeout_id = None
+        # raw frames from the camera go to vision plugins, and are encoded to h264 separately
+        self.image_processing = (settings.get('image_processing') or '0') != '0'
+        # display names of the vision plugins to run, comma separated. all of them if not set
+        vision_plugin_names = settings.get('vision_plugins')
+        # measure latency for every nth frame from the camera
+        self.latency_sample_interval = max(int(settings.get('latency_sample_interval') or 4), 1)
+        # serve prometheus metrics over http on this port. off if not set
+        metrics_port = int(settings.get('metrics_port') or 0)
+        # start recording as soon as the server starts, without waiting for a client
+        self.record_on_start = (settings.get('record') or '0') != '0'
 
         self.mainloop = GLib.MainLoop()
 
@@ -31,12 +90,11 @@ class Main:
         self.pipeline.get_bus().connect('message::error', self.on_error)
 
         self.camsrc = None
+        self.camsrc_encoder = None  # x264enc, if the source is videotestsrc and the camera would have encoded h264 itself
         # we will create camsrc when client connects, so that the camera stays powered off when not used
         # (as soon as we create the camsrc element, the camera is powered on)
         # but this way, when we are not using the camera, another program could start using it and then we wouldn't be able to access it
 
-        self.image_processing = False
-
         self.width = 640
         self.height = 480
         self.framerate = 60
@@ -45,9 +103,10 @@ class Main:
         self.pipeline.add(self.camsrc_caps_filter)
 
         # if image_processing is on
-        #                                                                  /-> queue -> v4l2convert -> queue -> h264enc -> h264enc_caps_filter -> ...
+        #                                                                  /-> queue -> v4l2convert -> h264enc -> h264enc_caps_filter -> ...
         # camsrc -> camsrc_caps_filter video/x-raw,format=BGR/other -> tee |
-        #                                                                  \-> queue -> appsink
+        #                                                                  \-> queue -> appsink -> (vision thread)
+        # (videoconvert and x264enc instead of v4l2convert and v4l2h264enc when the source is videotestsrc)
         #
         # if image_processing is off
         # camsrc -> camsrc_caps_filter video/x-h264 -> h264parse -> ...
@@ -64,12 +123,28 @@ class Main:
 
             # appsink branch of tee
 
+            # neither the queue nor the appsink hold more than one frame, and both drop old frames instead of blocking,
+            # so the vision branch can never stall the tee (and the h264 branch)
             self.appsink_queue = Gst.ElementFactory.make('queue', 'appsink_queue')
+            self.appsink_queue.set_property('max-size-buffers', 1)
+            self.appsink_queue.set_property('max-size-bytes', 0)
+            self.appsink_queue.set_property('max-size-time', 0)
+            self.appsink_queue.set_property('leaky', 2)  # 2==downstream, drop old buffers
             self.pipeline.add(self.appsink_queue)
             self.tee.link(self.appsink_queue)
 
+            vision_plugins = sorted(VisionPlugin.list_plugins(), key=lambda cls: cls.get_display_name())
+            if vision_plugin_names is not None:
+                selected_names = set(name.strip() for name in vision_plugin_names.split(','))
+                vision_plugins = [cls for cls in vision_plugins if cls.get_display_name() in selected_names]
+            logger.info(f'vision plugins: {[cls.get_display_name() for cls in vision_plugins]}')
+            self.vision_worker = VisionWorker([cls() for cls in vision_plugins])
+            self.vision_worker.on_results = self.on_vision_results
+
             self.appsink = Gst.ElementFactory.make('appsink')
             self.appsink.set_property('sync', False)
+            self.appsink.set_property('max-buffers', 1)
+            self.appsink.set_property('drop', True)
             self.appsink.set_property('emit-signals', True)
             self.appsink.connect('new-sample', self.appsink_new_sample, self.appsink)
             self.pipeline.add(self.appsink)
@@ -81,38 +156,111 @@ class Main:
             self.pipeline.add(self.h264enc_queue)
             self.tee.link(self.h264enc_queue)
 
-            self.h264enc = Gst.ElementFactory.make('v4l2h264enc')
-            self.h264enc.set_property('extra_controls', dict_to_struct(self.generate_h264enc_controls()))
+            if self.source == 'v4l2src':
+                self.h264enc_convert = Gst.ElementFactory.make('v4l2convert')
+                self.h264enc = Gst.ElementFactory.make('v4l2h264enc')
+            else:
+                self.h264enc_convert = Gst.ElementFactory.make('videoconvert')
+                self.h264enc = Gst.ElementFactory.make('x264enc')
+                self.h264enc.set_property('tune', 'zerolatency')
+                self.h264enc.set_property('speed-preset', 'ultrafast')
+                self.h264enc.set_property('key-int-max', 60)
+            self.set_h264enc_controls()
+            self.pipeline.add(self.h264enc_convert)
+            self.h264enc_queue.link(self.h264enc_convert)
             self.pipeline.add(self.h264enc)
-            self.h264enc_queue.link(self.h264enc)
+            self.h264enc_convert.link(self.h264enc)
 
             self.h264enc_caps_filter = Gst.ElementFactory.make('capsfilter', 'h264enc_caps_filter')
             self.h264enc_caps_filter.set_property('caps', Gst.Caps.from_string('video/x-h264,profile=high'))
             self.pipeline.add(self.h264enc_caps_filter)
             self.h264enc.link(self.h264enc_caps_filter)
-            self.h264enc_caps_filter.link(self.rtp_queue)
+            self.encoder_output = self.h264enc_caps_filter
         else:
             self.h264parse = Gst.ElementFactory.make('h264parse')
             self.pipeline.add(self.h264parse)
             self.camsrc_caps_filter.link(self.h264parse)
-            self.h264parse.link(self.rtp_queue)
-
-        # ... -> queue -> rtph264pay -> udpsink
+            self.encoder_output = self.h264parse  # the camera encodes h264 itself
+
+        # ... -> record_tee -> rtp_queue -> ...
+        #                   \-> (while recording) queue -> appsink, written to files by a pipeline of its own
+        self.record_tee = Gst.ElementFactory.make('tee', 'record_tee')
+        self.record_tee.set_property('allow-not-linked', True)
+        self.pipeline.add(self.record_tee)
+        self.encoder_output.link(self.record_tee)
+        self.record_tee.link(self.rtp_queue)
+        self.recorder = Recorder(self.pipeline, self.record_tee,
+                                 directory=settings.get('record_dir') or 'recordings',
+                                 prefix='rpividctrl_server',
+                                 file_format=settings.get('record_format') or 'mkv',
+                                 segment_time=float(settings.get('record_segment_time') or 60),
+                                 segment_size=int(float(settings.get('record_segment_size') or 0) * 1e6))
+        self.recorder.on_stopped = self.on_recording_stopped
+
+        # ... -> rtp_queue -> rtph264pay -> rtpulpfecenc -> rtpredenc -> udpsink
 
         self.rtph264pay = Gst.ElementFactory.make('rtph264pay')
         self.rtph264pay.set_property('mtu',
-                                     mtu - IPV4_UDP_OVERHEAD)  # this property is not the MTU of the link, but rather the maximum udp data size
+                                     mtu - IPV4_UDP_OVERHEAD - FEC_OVERHEAD)  # this property is not the MTU of the link, but rather the maximum udp data size
         self.pipeline.add(self.rtph264pay)
         self.rtp_queue.link(self.rtph264pay)
 
-        self.udpsink = Gst.ElementFactory.make('udpsink')
-        self.udpsink.set_property('port', RTP_PORT)
+        # forward error correction, off until the client sets a percentage
+        self.fec_percentage = 0
+        self.rtpulpfecenc = Gst.ElementFactory.make('rtpulpfecenc')
+        self.rtpulpfecenc.set_property('pt', ULPFEC_PAYLOAD_TYPE)
+        self.rtpulpfecenc.set_property('percentage', 0)
+        self.pipeline.add(self.rtpulpfecenc)
+        self.rtph264pay.link(self.rtpulpfecenc)
+
+        self.rtpredenc = Gst.ElementFactory.make('rtpredenc')
+        self.rtpredenc.set_property('pt', RED_PAYLOAD_TYPE)
+        self.pipeline.add(self.rtpredenc)
+        self.rtpulpfecenc.link(self.rtpredenc)
+
+        # stats
+        # latency is measured by noting when some of the buffers leave the camera, by pts, and looking at how long
+        # it takes buffers with the same pts to get to each stage of the pipeline
+        self.camsrc_times = collections.OrderedDict()  # pts -> time.monotonic() the buffer left the camera, oldest first
+        self.camsrc_buffers = 0
+        self.latency_stats = RollingStats()
+        self.encoder_latency_stats = RollingStats()
+        self.payloader_latency_stats = RollingStats()
+        self.rtp_queue_stats = RollingStats()
+        self.appsink_queue_stats = RollingStats()
+        self.h264enc_queue_stats = RollingStats()
+        self.frames_encoded = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0  # total for all viewers is bytes_sent * number of viewers playing
+        self.packets_sent = 0  # rtp packets, including fec, counted the same way as bytes_sent
+        self.latency_histogram = metrics.Histogram()  # same samples as latency_stats, but never forgets them
+        self.control_messages = collections.Counter()  # message type name -> messages received
+        self.last_camsrc_offset = None
+        self.last_frame_time = None
+        self.resolution_switch_pending = False  # waiting for caps with the new resolution
+        self.resolution_switch_caps_seen = False  # waiting for the first frame with the new resolution
+        self.resolution_switch_gap = 0.0  # time between the last frame before the switch and the first frame after
+        self.connect_time = None  # when the client connected, until the first rtp packet is sent
+        self.connect_warm = False  # whether the camera element was already there when the client connected
+        self.last_keyframe_time = None
+        self.profiler = None  # profiling.Profiler when running with --profile
+        self.quitting = False  # waiting for the recording to stop before quitting
+        self.last_frame_timestamp_rtp_timestamp = None
+
+        encoder_output_pad = get_pad(self.encoder_output.iterate_src_pads())
+        encoder_output_pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.EVENT_DOWNSTREAM, self.encoder_output_probe)
+        payloader_pad = get_pad(self.rtph264pay.iterate_sink_pads())
+        payloader_pad.add_probe(Gst.PadProbeType.BUFFER, self.payloader_probe)
+        payloader_src_pad = get_pad(self.rtph264pay.iterate_src_pads())
+        payloader_src_pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST, self.frame_timestamp_probe)
+
+        # every viewer that is playing is added to multiudpsink, so they all share the same encoder
+        self.udpsink = Gst.ElementFactory.make('multiudpsink')
         self.udpsink.set_property('sync', False)
-        self.stats_buffer = collections.deque(maxlen=STATS_BUFFER_LEN)
         buffer_processed_pad = get_pad(self.udpsink.iterate_sink_pads())
-        buffer_processed_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.buffer_processed_probe)
+        buffer_processed_pad.add_probe(Gst.PadProbeType.BUFFER, self.buffer_processed_probe)
         self.pipeline.add(self.udpsink)
-        self.rtph264pay.link(self.udpsink)
+        self.rtpredenc.link(self.udpsink)
 
         logger.info('init server')
         sock = socket.socket()
@@ -120,9 +268,11 @@ class Main:
         sock.bind((host, REMOTE_CONTROL_PORT))
         sock.listen(5)
         logger.info(f'server listening on {sock.getsockname()}')
-        self.sock_manager = None
+        self.viewers = []  # in the order they connected, the first one is the owner
         GLib.io_add_watch(sock, GLib.IO_IN, self.new_conn_listener)
 
+        self.metrics_server = metrics.MetricsServer(host, metrics_port, self.collect_metrics) if metrics_port else None
+
     def on_eos(self, bus, message):
         logger.error('gstreamer eos')
 
@@ -131,94 +281,399 @@ class Main:
         logger.error(f'gstreamer error: {parsed_error.gerror}\nAdditional debug info:\n{parsed_error.debug}')
 
     def appsink_new_sample(self, *args):
-        sample = self.appsink.emit('pull-sample')
-        logger.info(f'appsink sample {sample} {sample.get_caps().to_string()}')
+        self.vision_worker.submit(self.appsink.emit('pull-sample'))
         return Gst.FlowReturn.OK
 
+    def on_vision_results(self, frame_number, running_time, results):
+        # called on the vision thread, the sockets belong to the main loop
+        detections = [detection for result in results if result for detection in result]
+        GLib.idle_add(self.send_vision_result, frame_number, running_time, detections)
+
+    def send_vision_result(self, frame_number, running_time, detections):
+        # the payloader's stats have the running time and rtp timestamp of the last frame it sent. the frame the vision
+        # plugins looked at is the same distance away from it in both
+        payloader_stats = self.rtph264pay.get_property('stats')
+        has_running_time, last_running_time = payloader_stats.get_uint64('running-time')
+        has_timestamp, last_timestamp = payloader_stats.get_uint('timestamp')
+        if not has_running_time or not has_timestamp or last_running_time == Gst.CLOCK_TIME_NONE or running_time == Gst.CLOCK_TIME_NONE:
+            return GLib.SOURCE_REMOVE
+        rtp_timestamp = last_timestamp + (running_time - last_running_time) * RTP_CLOCK_RATE // Gst.SECOND
+
+        message = MessageBuilder.vision_result(frame_number, rtp_timestamp, detections)
+        for viewer in self.viewers:
+            # results are only useful while they are fresh, so do not queue them up behind a slow connection
+            if viewer.playing and not viewer.sock_manager.above_high_water_mark:
+                viewer.sock_manager.sendall(message)
+        return GLib.SOURCE_REMOVE
+
     def new_conn_listener(self, server_sock, *args):
         # new connection
         conn, addr = server_sock.accept()
         logger.info(f'client connected from {addr}')
-        if self.sock_manager is not None:
-            logger.info(f'destroy old connection to {self.sock_manager.getpeername()}')
-            self.sock_manager.on_destroy = None
-            self.sock_manager.destroy()
-            self.sock_manager = None
-        self.set_dest_host(addr[0])
-        self.sock_manager = SocketManager(conn)
-        self.sock_manager.on_destroy = self.on_sock_destroy
-        self.sock_manager.on_read_message = self.handle_message
-
-        self.pipeline.set_state(Gst.State.NULL)
-        self.create_camera_element()
+        if not self.multi_viewer:
+            for old_viewer in list(self.viewers):
+                logger.info(f'destroy old connection to {old_viewer.host}')
+                old_viewer.sock_manager.on_destroy = None
+                old_viewer.sock_manager.destroy()
+                self.remove_viewer(old_viewer)
+        sock_manager = SocketManager(conn)
+        viewer = Viewer(sock_manager, addr[0])
+        sock_manager.on_destroy = lambda reason: self.on_sock_destroy(viewer, reason)
+        sock_manager.on_read_message = lambda message_info: self.handle_message(viewer, message_info)
+        sock_manager.on_high_water_mark = self.on_sock_high_water_mark
+        sock_manager.on_drained = self.on_sock_drained
+        self.viewers.append(viewer)
+        logger.info(f'{len(self.viewers)} viewers, owner is {self.viewers[0].host}')
+
+        if len(self.viewers) > 1:
+            # the other viewers are already using the camera
+            return True
+
+        self.connect_time = time.monotonic()
+        if self.standby_timeout_id is not None:
+            GLib.source_remove(self.standby_timeout_id)
+            self.standby_timeout_id = None
+        if self.camsrc is not None:
+            # warm standby, or the old connection was replaced. the camera is already negotiated and only needs to be resumed
+            logger.info('reuse camera element')
+            self.connect_warm = True
+            self.update_pipeline_state()  # keeps playing if it is recording
+        else:
+            self.connect_warm = False
+            self.pipeline.set_state(Gst.State.NULL)
+            self.create_camera_element()
 
         return True
 
-    def on_sock_destroy(self, reason):
-        logger.info(f'sock destroyed, reason {reason}')
-        self.sock_manager = None
+    def on_sock_destroy(self, viewer, reason):
+        logger.info(f'sock to {viewer.host} destroyed, reason {reason}')
+        was_owner = viewer is self.viewers[0]
+        self.remove_viewer(viewer)
+        if self.viewers:
+            if was_owner:
+                logger.info(f'{self.viewers[0].host} is the owner now')
+            return
+
+        self.connect_time = None
+        if self.recorder.active:
+            logger.info('keep the camera for recording')
+            return
+        self.release_camera()
+
+    def release_camera(self):
+        """Once nothing uses the camera anymore"""
         self.pause()
+        if self.warm_standby > 0:
+            logger.info(f'keep camera element for {self.warm_standby} ms')
+            self.standby_timeout_id = GLib.timeout_add(self.warm_standby, self.standby_timeout_handler)
+        else:
+            self.destroy_camera_element()
+
+    def standby_timeout_handler(self):
+        self.standby_timeout_id = None
+        logger.info('warm standby expired')
         self.destroy_camera_element()
+        return GLib.SOURCE_REMOVE
+
+    def on_sock_high_water_mark(self, bytes_queued):
+        logger.warning(f'control socket is backed up, {bytes_queued} bytes queued')
+
+    def on_sock_drained(self):
+        logger.info('control socket send queue drained')
+
+    def remove_viewer(self, viewer):
+        self.set_viewer_playing(viewer, False)
+        self.viewers.remove(viewer)
 
-    def handle_message(self, message_info):
+    def set_viewer_playing(self, viewer, playing):
+        """Starts or stops sending the stream to one viewer. The pipeline plays while any viewer is playing"""
+        if playing == viewer.playing:
+            return
+        if playing:
+            logger.info(f'start sending to {viewer.host}')
+            self.udpsink.emit('add', viewer.host, RTP_PORT)
+        else:
+            logger.info(f'stop sending to {viewer.host}')
+            viewer.bytes_sent = self.get_viewer_bytes_sent(viewer)
+            self.udpsink.emit('remove', viewer.host, RTP_PORT)
+        viewer.playing = playing
+        self.update_pipeline_state()
+
+    def update_pipeline_state(self):
+        """The pipeline plays while any viewer is playing, or while recording"""
+        if self.recorder.active or any(viewer.playing for viewer in self.viewers):
+            self.resume()
+        else:
+            self.pause()
+
+    def set_recording(self, recording):
+        if recording == self.recorder.recording:
+            return
+        if not recording:
+            # the camera is released once the last file is finished, in on_recording_stopped
+            self.recorder.stop()
+            return
+        if self.standby_timeout_id is not None:
+            GLib.source_remove(self.standby_timeout_id)
+            self.standby_timeout_id = None
+        if self.camsrc is None:
+            # headless, no viewer has started the camera
+            self.pipeline.set_state(Gst.State.NULL)
+            self.create_camera_element()
+        self.recorder.start()
+        self.update_pipeline_state()
+        self.force_keyframe()  # so the file starts with a picture
+
+    def on_recording_stopped(self):
+        if self.quitting:
+            self.mainloop.quit()
+        elif not self.viewers:
+            self.release_camera()
+        else:
+            self.update_pipeline_state()
+
+    def get_viewer_bytes_sent(self, viewer):
+        bytes_sent = viewer.bytes_sent
+        if viewer.playing:
+            bytes_sent += self.udpsink.emit('get-stats', viewer.host, RTP_PORT).get_uint64('bytes-sent')[1]
+        return bytes_sent
+
+    def handle_message(self, viewer, message_info):
         message_type = message_info['message_type']
+        self.control_messages[message_type.name] += 1
+
+        if message_type in OWNER_MESSAGE_TYPES and viewer is not self.viewers[0]:
+            logger.warning(f'{viewer.host} is not the owner, ignore {message_type.name}')
+            return
 
         if message_type == MessageType.SET_RESOLUTION_FRAMERATE:
             self.set_resolution_framerate(message_info['width'], message_info['height'], message_info['framerate'])
         elif message_type == MessageType.PAUSE:
-            self.pause()
+            self.set_viewer_playing(viewer, False)
         elif message_type == MessageType.RESUME:
-            self.resume()
+            self.set_viewer_playing(viewer, True)
         elif message_type == MessageType.STATS_REQUEST:
-            self.sock_manager.sendall(MessageBuilder.stats_response(self.get_average_stats()))
+            viewer.sock_manager.sendall(MessageBuilder.stats_response(self.get_stats(viewer)))
         elif message_type == MessageType.SET_TARGET_BITRATE:
             self.set_target_bitrate(message_info['target_bitrate'])
+        elif message_type == MessageType.FORCE_KEYFRAME:
+            self.force_keyframe()
+        elif message_type == MessageType.SET_FEC_PERCENTAGE:
+            self.set_fec_percentage(message_info['fec_percentage'])
+        elif message_type == MessageType.PROFILE_REQUEST:
+            self.send_profile_report(viewer)
+        elif message_type == MessageType.TIME_SYNC_REQUEST:
+            receive_time = self.get_clock_time()
+            viewer.sock_manager.sendall(MessageBuilder.time_sync_response(message_info['client_time'], receive_time, self.get_clock_time()))
+        elif message_type == MessageType.SET_RECORDING:
+            self.set_recording(message_info['recording'])
+        elif message_type == MessageType.SET_FRAME_TIMESTAMPS:
+            logger.info(f'{"send" if message_info["frame_timestamps"] else "stop sending"} frame timestamps to {viewer.host}')
+            viewer.frame_timestamps = message_info['frame_timestamps']
         else:
             logger.warning(f'do not know how to handle message type {message_type}')
 
-    def set_dest_host(self, host):
-        logger.info(f'set dest host {host}')
-        self.udpsink.set_property('host', host)
+    def send_profile_report(self, viewer):
+        if self.profiler is None:
+            report = {'error': 'server is not running with --profile'}
+        else:
+            report = self.profiler.report()
+        try:
+            message = MessageBuilder.profile_report(report)
+        except ValueError as e:
+            logger.warning(str(e))
+            message = MessageBuilder.profile_report({'error': str(e)})
+        viewer.sock_manager.sendall(message)
 
     def camsrc_probe(self, pad, probe_info):
-        event_structure = Gst.Structure.new_empty('camsrc_time')
-        event_structure.set_value('time', time.monotonic())
-        pad.get_peer().send_event(Gst.Event.new_custom(Gst.EventType.CUSTOM_DOWNSTREAM, event_structure))
+        buffer = probe_info.get_buffer()
+        if buffer.offset != Gst.BUFFER_OFFSET_NONE:
+            # v4l2src numbers frames with the buffer offset, so a gap means the camera dropped frames
+            if self.last_camsrc_offset is not None and buffer.offset > self.last_camsrc_offset + 1:
+                self.frames_dropped += buffer.offset - self.last_camsrc_offset - 1
+            self.last_camsrc_offset = buffer.offset
+
+        self.camsrc_buffers += 1
+        if self.camsrc_buffers % self.latency_sample_interval == 0 and buffer.pts != Gst.CLOCK_TIME_NONE:
+            self.camsrc_times[buffer.pts] = time.monotonic()
+            if len(self.camsrc_times) > CAMSRC_TIMES_LEN:
+                # the encoder dropped it, or it is still on its way
+                self.camsrc_times.popitem(last=False)
         return Gst.PadProbeReturn.OK
 
-    def buffer_processed_probe(self, pad, probe_info):
-        event = probe_info.get_event()
-        if event.type == Gst.EventType.CUSTOM_DOWNSTREAM:
-            structure = event.get_structure()
-            if structure.has_name('camsrc_time'):
-                camsrc_time = event.get_structure().get_value('time')
-                now = time.monotonic()
-                time_diff = now - camsrc_time
-                self.measure_stats(time_diff)
+    def encoder_output_probe(self, pad, probe_info):
+        if probe_info.type & Gst.PadProbeType.BUFFER:
+            now = time.monotonic()
+            self.frames_encoded += 1
+            if self.resolution_switch_caps_seen:
+                self.resolution_switch_caps_seen = False
+                self.resolution_switch_gap = now - self.last_frame_time
+                logger.info(f'resolution switch gap {self.resolution_switch_gap * 1e3:.1f} ms')
+            self.last_frame_time = now
+            camsrc_time = self.camsrc_times.get(probe_info.get_buffer().pts)
+            if camsrc_time is not None:
+                self.encoder_latency_stats.add(now - camsrc_time)
+        else:
+            if self.resolution_switch_pending and probe_info.get_event().type == Gst.EventType.CAPS:
+                self.resolution_switch_pending = False
+                self.resolution_switch_caps_seen = self.last_frame_time is not None
+        return Gst.PadProbeReturn.OK
+
+    def payloader_probe(self, pad, probe_info):
+        camsrc_time = self.camsrc_times.get(probe_info.get_buffer().pts)
+        if camsrc_time is not None:
+            self.payloader_latency_stats.add(time.monotonic() - camsrc_time)
         return Gst.PadProbeReturn.OK
 
-    def get_average_stats(self):
-        num_measurements = len(self.stats_buffer)
-        if num_measurements > 0:
-            latency_sum = 0
-            queue0_sum = 0
-            queue1_sum = 0
-            for latency, queue0_level, queue1_level in self.stats_buffer:
-                latency_sum += latency
-                queue0_sum += queue0_level
-                queue1_sum += queue1_level
-            latency_avg = latency_sum / num_measurements
-            queue0_avg = queue0_sum / num_measurements
-            queue1_avg = queue1_sum / num_measurements
-            return latency_avg, queue0_avg, queue1_avg
+    def get_clock_time(self):
+        """Time of the pipeline clock, which the camera's timestamps are in. Same as the client's clock (Gst.SystemClock)
+        unless the pipeline picked another one, which it does not for v4l2src or videotestsrc"""
+        return self.pipeline.get_pipeline_clock().get_time()
+
+    def frame_timestamp_probe(self, pad, probe_info):
+        if not any(viewer.frame_timestamps and viewer.playing for viewer in self.viewers):
+            return Gst.PadProbeReturn.OK
+        if probe_info.type & Gst.PadProbeType.BUFFER_LIST:
+            buffer = probe_info.get_buffer_list().get(0)
         else:
-            return 0, 0, 0
+            buffer = probe_info.get_buffer()
+        # a frame is split into several rtp packets with the same timestamp, only the first one is sent
+        rtp_timestamp = RTP_TIMESTAMP_STRUCT.unpack(buffer.extract_dup(RTP_TIMESTAMP_OFFSET, RTP_TIMESTAMP_STRUCT.size))[0]
+        if rtp_timestamp == self.last_frame_timestamp_rtp_timestamp:
+            return Gst.PadProbeReturn.OK
+        self.last_frame_timestamp_rtp_timestamp = rtp_timestamp
+
+        segment_event = pad.get_sticky_event(Gst.EventType.SEGMENT, 0)
+        if segment_event is None or buffer.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        running_time = segment_event.parse_segment().to_running_time(Gst.Format.TIME, buffer.pts)
+        if running_time == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        # the camera timestamps each buffer with the running time it was captured at
+        capture_time = self.pipeline.get_base_time() + running_time
+        GLib.idle_add(self.send_frame_timestamp, rtp_timestamp, capture_time)
+        return Gst.PadProbeReturn.OK
+
+    def send_frame_timestamp(self, rtp_timestamp, capture_time):
+        message = MessageBuilder.frame_timestamp(rtp_timestamp, capture_time)
+        for viewer in self.viewers:
+            if viewer.frame_timestamps and viewer.playing:
+                viewer.sock_manager.sendall(message)
+        return GLib.SOURCE_REMOVE
+
+    def buffer_processed_probe(self, pad, probe_info):
+        buffer = probe_info.get_buffer()
+        self.bytes_sent += buffer.get_size()
+        self.packets_sent += 1
+        connect_time = self.connect_time
+        if connect_time is not None:
+            self.connect_time = None
+            logger.info(f'time to first rtp packet {(time.monotonic() - connect_time) * 1e3:.1f} ms '
+                        f'({"warm" if self.connect_warm else "cold"})')
+        # the rtp packets of a frame keep its pts. the frame is sent once the packet with the marker bit is
+        if buffer.pts in self.camsrc_times and buffer.extract_dup(RTP_MARKER_OFFSET, 1)[0] & 0x80:
+            camsrc_time = self.camsrc_times.pop(buffer.pts, None)
+            if camsrc_time is not None:
+                self.measure_stats(time.monotonic() - camsrc_time)
+        return Gst.PadProbeReturn.OK
+
+    def get_stats(self, viewer):
+        """Stats for a STATS_RESPONSE message to viewer"""
+        now = time.monotonic()
+        bytes_sent = self.get_viewer_bytes_sent(viewer)
+        elapsed = now - viewer.last_stats_time
+        actual_bitrate = int((bytes_sent - viewer.last_stats_bytes_sent) * 8 / elapsed) if elapsed > 0 else 0
+        viewer.last_stats_time = now
+        viewer.last_stats_bytes_sent = bytes_sent
+
+        latency = self.latency_stats.summary()
+        # each stage is measured from the camera, so the time spent in a stage is the difference from the previous one
+        encoder_latency = self.encoder_latency_stats.mean()
+        payloader_latency = self.payloader_latency_stats.mean()
+
+        return {
+            'pipeline_latency': latency['mean'],
+            'pipeline_latency_p50': latency['p50'],
+            'pipeline_latency_p95': latency['p95'],
+            'pipeline_latency_p99': latency['p99'],
+            'pipeline_latency_jitter': latency['jitter'],
+            'encoder_latency': encoder_latency,
+            'payloader_latency': max(payloader_latency - encoder_latency, 0),
+            'udpsink_latency': max(latency['mean'] - payloader_latency, 0),
+            'rtp_queue_level': self.rtp_queue_stats.mean(),
+            'appsink_queue_level': self.appsink_queue_stats.mean(),
+            'h264enc_queue_level': self.h264enc_queue_stats.mean(),
+            'frames_encoded': self.frames_encoded & 0xffffffff,
+            'frames_dropped': self.frames_dropped & 0xffffffff,
+            'bytes_sent': bytes_sent,
+            'actual_bitrate': actual_bitrate,
+            'target_bitrate': self.target_bitrate,
+            'resolution_switch_gap': self.resolution_switch_gap,
+            'viewers': min(len(self.viewers), 0xff),  # one byte in STATS_RESPONSE
+            'owner': int(viewer is self.viewers[0]),
+            'vision_processing_time': self.vision_worker.processing_stats.mean() if self.image_processing else 0,
+            'vision_frames_processed': (self.vision_worker.frames_processed if self.image_processing else 0) & 0xffffffff,
+            'vision_frames_dropped': (self.vision_worker.frames_dropped if self.image_processing else 0) & 0xffffffff,
+            'recording': int(self.recorder.recording),
+            'recording_frames_dropped': self.recorder.frames_dropped & 0xffffffff
+        }
+
+    def collect_metrics(self):
+        """Metrics for a scrape of the metrics server. Runs on the main loop and only reads what the probes already count"""
+        queues = [('rtp_queue', self.rtp_queue)]
+        if self.image_processing:
+            queues += [('appsink_queue', self.appsink_queue), ('h264enc_queue', self.h264enc_queue)]
+        queue_levels = metrics.gauge('rpividctrl_queue_level_buffers', 'Buffers in each queue right now')
+        for name, queue in queues:
+            queue_levels.add(queue.get_property('current-level-buffers'), queue=name)
+
+        pipeline_state = self.pipeline.get_state(0)[1]
+        result = [
+            metrics.counter('rpividctrl_frames_captured_total', 'Frames that left the camera').add(self.camsrc_buffers),
+            metrics.counter('rpividctrl_frames_encoded_total', 'Frames that left the h264 encoder').add(self.frames_encoded),
+            metrics.counter('rpividctrl_frames_dropped_total', 'Frames the camera dropped').add(self.frames_dropped),
+            metrics.counter('rpividctrl_bytes_sent_total', 'Bytes of rtp sent to each viewer').add(self.bytes_sent),
+            metrics.counter('rpividctrl_rtp_packets_sent_total', 'Rtp packets sent to each viewer, including fec').add(self.packets_sent),
+            metrics.counter_by_label('rpividctrl_control_messages_total', 'Control messages received, by type',
+                                     'type', self.control_messages),
+            metrics.histogram('rpividctrl_pipeline_latency_seconds', 'Time from the camera to udpsink, every nth frame')
+                .add(self.latency_histogram),
+            metrics.gauge('rpividctrl_stage_latency_seconds', 'Mean time from the camera to each stage, over the last samples')
+                .add(self.encoder_latency_stats.mean(), stage='encoder')
+                .add(self.payloader_latency_stats.mean(), stage='payloader')
+                .add(self.latency_stats.mean(), stage='udpsink'),
+            queue_levels,
+            metrics.gauge('rpividctrl_camera_active', '1 if the camera element exists').add(self.camsrc is not None),
+            metrics.gauge('rpividctrl_pipeline_playing', '1 if the pipeline is playing').add(pipeline_state == Gst.State.PLAYING),
+            metrics.gauge('rpividctrl_viewers', 'Connected viewers')
+                .add(len(self.viewers), state='connected')
+                .add(sum(viewer.playing for viewer in self.viewers), state='playing'),
+            metrics.gauge('rpividctrl_target_bitrate_bits', 'Encoder target bitrate').add(self.target_bitrate),
+            metrics.gauge('rpividctrl_fec_percentage', 'Forward error correction overhead').add(self.fec_percentage),
+            metrics.gauge('rpividctrl_resolution_pixels', 'Resolution of the camera')
+                .add(self.width or 0, dimension='width')
+                .add(self.height or 0, dimension='height'),
+            metrics.gauge('rpividctrl_framerate', 'Framerate of the camera').add(self.framerate or 0),
+            metrics.gauge('rpividctrl_recording', '1 if recording to a file').add(self.recorder.recording),
+            metrics.counter('rpividctrl_recording_frames_dropped_total', 'Frames dropped because the file could not be written fast enough')
+                .add(self.recorder.frames_dropped)
+        ]
+        if self.image_processing:
+            result += [
+                metrics.counter('rpividctrl_vision_frames_processed_total', 'Frames the vision plugins processed')
+                    .add(self.vision_worker.frames_processed),
+                metrics.counter('rpividctrl_vision_frames_dropped_total', 'Frames the vision plugins were too busy for')
+                    .add(self.vision_worker.frames_dropped)
+            ]
+        return result
 
     def measure_stats(self, last_pipeline_latency):
-        # TODO: fix queue stats
-        queue0_level = 0 #self.queue0.get_property('current-level-buffers')
-        queue1_level = 0 #self.queue1.get_property('current-level-buffers')
-        self.stats_buffer.append((last_pipeline_latency, queue0_level, queue1_level, 0.0))
+        self.latency_stats.add(last_pipeline_latency)
+        self.latency_histogram.observe(last_pipeline_latency)
+        self.rtp_queue_stats.add(self.rtp_queue.get_property('current-level-buffers'))
+        if self.image_processing:
+            self.appsink_queue_stats.add(self.appsink_queue.get_property('current-level-buffers'))
+            self.h264enc_queue_stats.add(self.h264enc_queue.get_property('current-level-buffers'))
 
     def generate_camsrc_controls(self):
         # `v4l2-ctl -L` to list controls
@@ -251,26 +706,79 @@ class Main:
         self.height = new_height
         self.framerate = new_framerate
 
-        self.pipeline.set_state(Gst.State.PAUSED)
-        self.camsrc_caps_filter.set_property('caps', self.generate_camsrc_caps())
-        self.pipeline.set_state(Gst.State.PLAYING)
+        new_caps = self.generate_camsrc_caps()
+        if new_caps.is_equal(self.camsrc_caps_filter.get_property('caps')):
+            # for example, when a client reconnects to a warm camera
+            return
+        self.resolution_switch_pending = self.camsrc is not None
+
+        if self.camsrc is None:
+            self.camsrc_caps_filter.set_property('caps', new_caps)
+        elif self.live_renegotiation:
+            # the idle probe runs once no buffer is going through the camera's src pad, and keeps it blocked until
+            # the probe returns. setting the caps sends a reconfigure event upstream, and the camera
+            # renegotiates before pushing the next buffer. everything downstream keeps running
+            src_pad = get_pad(self.camsrc.iterate_src_pads())
+            src_pad.add_probe(Gst.PadProbeType.IDLE, self.swap_camsrc_caps_probe, new_caps)
+        else:
+            self.pipeline.set_state(Gst.State.PAUSED)
+            self.camsrc_caps_filter.set_property('caps', new_caps)
+            self.pipeline.set_state(Gst.State.PLAYING)
+
+    def swap_camsrc_caps_probe(self, pad, probe_info, new_caps):
+        self.camsrc_caps_filter.set_property('caps', new_caps)
+        return Gst.PadProbeReturn.REMOVE
 
     def set_target_bitrate(self, bitrate):
         logger.info(f'set target bitrate {bitrate}')
         self.target_bitrate = bitrate
         if self.image_processing:
-            self.h264enc.set_property('extra_controls', dict_to_struct(self.generate_h264enc_controls()))
+            self.set_h264enc_controls()
+        elif self.camsrc is not None:
+            self.set_camsrc_controls()
+
+    def set_fec_percentage(self, percentage):
+        percentage = min(percentage, 100)
+        logger.info(f'set fec percentage {percentage}')
+        self.fec_percentage = percentage
+        self.rtpulpfecenc.set_property('percentage', percentage)
+        # while fec is on, every packet is wrapped in RED, the same as webrtc does. while it is off, rtpredenc passes
+        # the h264 packets through untouched, so a client without the fec decoders can still play the stream
+        self.rtpredenc.set_property('allow-no-red-blocks', percentage > 0)
+
+    def force_keyframe(self):
+        """Makes the encoder send a keyframe as soon as possible"""
+        now = time.monotonic()
+        if self.camsrc is None or (self.last_keyframe_time is not None and now - self.last_keyframe_time < KEYFRAME_MIN_INTERVAL):
+            return
+        self.last_keyframe_time = now
+        logger.debug('force keyframe')
+        if not self.image_processing and self.source == 'v4l2src':
+            # the camera encodes h264 itself, and v4l2src does not handle force-key-unit events
+            self.camsrc.set_property('extra_controls', dict_to_struct({**self.generate_camsrc_controls(), **self.generate_h264enc_controls(),
+                                                                       'force_key_frame': 1}))
         else:
-            self.camsrc.set_property('extra_controls', dict_to_struct({**self.generate_h264enc_controls(), **self.generate_camsrc_controls()}))
+            # goes upstream from the payloader to the encoder (v4l2h264enc, or x264enc for videotestsrc)
+            event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+            get_pad(self.rtph264pay.iterate_sink_pads()).push_event(event)
 
     def run(self):
         logger.info('run')
         self.pipeline.set_state(Gst.State.PAUSED)
+        if self.record_on_start:
+            self.set_recording(True)
         self.mainloop.run()
 
     def quit(self):
         logger.info('quit')
-        self.mainloop.quit()
+        if self.image_processing:
+            self.vision_worker.stop()
+        if self.recorder.active:
+            # let the muxer finish the last file first, an unfinished mp4 cannot be played
+            self.quitting = True
+            self.recorder.stop()
+        else:
+            self.mainloop.quit()
 
     def resume(self):
         logger.info('resume')
@@ -280,13 +788,47 @@ class Main:
         logger.info('pause')
         self.pipeline.set_state(Gst.State.PAUSED)
 
-    def create_camera_element(self):
-        logger.info('create camera element')
-        self.camsrc = Gst.ElementFactory.make('v4l2src')
-        if self.image_processing:
+    def set_h264enc_controls(self):
+        if self.source == 'v4l2src':
+            self.h264enc.set_property('extra_controls', dict_to_struct(self.generate_h264enc_controls()))
+        else:
+            self.h264enc.set_property('bitrate', max(self.target_bitrate // 1000, 1))  # kbit/s
+
+    def set_camsrc_controls(self):
+        if self.source != 'v4l2src':
+            if self.camsrc_encoder is not None:
+                self.camsrc_encoder.set_property('bitrate', max(self.target_bitrate // 1000, 1))  # kbit/s
+        elif self.image_processing:
             self.camsrc.set_property('extra_controls', dict_to_struct(self.generate_camsrc_controls()))
         else:
             self.camsrc.set_property('extra_controls', dict_to_struct({**self.generate_camsrc_controls(), **self.generate_h264enc_controls()}))
+
+    def create_camera_element(self):
+        logger.info(f'create camera element ({self.source})')
+        if self.source == 'videotestsrc':
+            if self.image_processing:
+                self.camsrc = Gst.ElementFactory.make('videotestsrc')
+                self.camsrc.set_property('is-live', True)
+            else:
+                # stands in for the camera's h264 encoder
+                self.camsrc = Gst.parse_bin_from_description(
+                    'videotestsrc is-live=true pattern=ball ! '
+                    'x264enc name=camsrc_encoder tune=zerolatency speed-preset=ultrafast key-int-max=60', True)
+                self.camsrc_encoder = self.camsrc.get_by_name('camsrc_encoder')
+        elif self.source == 'filesrc':
+            # decoded and scaled to whatever resolution and framerate the client asks for, and played back in real time.
+            # plays once, the pipeline gets eos at the end of the file
+            description = (f'filesrc location="{self.source_file}" ! decodebin ! identity sync=true ! '
+                           'videoconvert ! videoscale ! videorate')
+            if not self.image_processing:
+                description += ' ! x264enc name=camsrc_encoder tune=zerolatency speed-preset=ultrafast key-int-max=60'
+            self.camsrc = Gst.parse_bin_from_description(description, True)
+            self.camsrc_encoder = self.camsrc.get_by_name('camsrc_encoder')
+        else:
+            self.camsrc = Gst.ElementFactory.make('v4l2src')
+        self.set_camsrc_controls()
+        self.last_camsrc_offset = None
+        self.camsrc_times.clear()  # a new camera starts its timestamps over
         src_pad = get_pad(self.camsrc.iterate_src_pads())
         src_pad.add_probe(Gst.PadProbeType.BUFFER, self.camsrc_probe)
         self.pipeline.add(self.camsrc)
@@ -298,15 +840,45 @@ class Main:
         self.camsrc.set_state(Gst.State.NULL)
         self.camsrc.unlink(self.camsrc_caps_filter)
         self.camsrc = None
+        self.camsrc_encoder = None
         self.width = None
         self.height = None
         self.framerate = None
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--profile', nargs='?', const='.', metavar='DIR',
+                        help='collect gstreamer tracer stats, and write a report to DIR (default: current directory) on exit')
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        profiling.setup_environment()
+
     Gst.init(None)
     start = Main({
         'host': os.environ.get('RPIVIDCTRL_SERVER_HOST'),
-        'mtu': os.environ.get('RPIVIDCTRL_SERVER_MTU')
+        'mtu': os.environ.get('RPIVIDCTRL_SERVER_MTU'),
+        'live_renegotiation': os.environ.get('RPIVIDCTRL_SERVER_LIVE_RENEGOTIATION'),  # 0 to pause the pipeline instead
+        'source': os.environ.get('RPIVIDCTRL_SERVER_SOURCE'),  # v4l2src, videotestsrc or filesrc
+        'source_file': os.environ.get('RPIVIDCTRL_SERVER_SOURCE_FILE'),  # video to play back with filesrc
+        'warm_standby': os.environ.get('RPIVIDCTRL_SERVER_WARM_STANDBY'),  # ms to keep the camera after disconnect
+        'multi_viewer': os.environ.get('RPIVIDCTRL_SERVER_MULTI_VIEWER'),  # 1 to let several clients watch at once
+        'image_processing': os.environ.get('RPIVIDCTRL_SERVER_IMAGE_PROCESSING'),  # 1 to run vision plugins
+        'vision_plugins': os.environ.get('RPIVIDCTRL_SERVER_VISION_PLUGINS'),  # comma separated display names
+        'latency_sample_interval': os.environ.get('RPIVIDCTRL_SERVER_LATENCY_SAMPLE_INTERVAL'),  # measure every nth frame
+        'metrics_port': os.environ.get('RPIVIDCTRL_SERVER_METRICS_PORT'),  # http port for prometheus metrics
+        'record': os.environ.get('RPIVIDCTRL_SERVER_RECORD'),  # 1 to start recording right away, without a client
+        'record_dir': os.environ.get('RPIVIDCTRL_SERVER_RECORD_DIR'),  # default ./recordings
+        'record_format': os.environ.get('RPIVIDCTRL_SERVER_RECORD_FORMAT'),  # mkv or mp4
+        'record_segment_time': os.environ.get('RPIVIDCTRL_SERVER_RECORD_SEGMENT_TIME'),  # seconds per file, 0 for no limit
+        'record_segment_size': os.environ.get('RPIVIDCTRL_SERVER_RECORD_SEGMENT_SIZE')  # MB per file, 0 for no limit
     })
+    if args.profile is not None:
+        start.profiler = profiling.Profiler('rpividctrl_server', start.pipeline)
+        start.profiler.start()
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, start.quit)
     start.run()
+    if start.profiler is not None:
+        start.profiler.stop()
+        profiling.write_report(start.profiler.report(), args.profile)
@@ -3,19 +3,25 @@
 #include <stdexcept>
 #include <limits>
 #include <cstring>
+#include <initializer_list>
 
 uint16_t Message::readUint16Unaligned(const uint8_t *pointer) {
     return ((*pointer + 0) << 8) | (*(pointer + 1) << 0);
 }
 
 uint32_t Message::readUint32Unaligned(const uint8_t *pointer) {
-    return (*(pointer + 0) << 24) | (*(pointer + 1) << 16) | (*(pointer + 2) << 8) | (*(pointer + 3) << 0);
+    return ((uint32_t) *(pointer + 0) << 24) | ((uint32_t) *(pointer + 1) << 16) | ((uint32_t) *(pointer + 2) << 8) | ((uint32_t) *(pointer + 3) << 0);
+}
+
+uint64_t Message::readUint64Unaligned(const uint8_t *pointer) {
+    return ((uint64_t) Message::readUint32Unaligned(pointer) << 32) | Message::readUint32Unaligned(pointer + sizeof(uint32_t));
 }
 
 static_assert(std::numeric_limits<float>::is_iec559 && std::numeric_limits<float>::digits == 24, "type `float` is not 32-bit ieee754 float");
 float Message::readFloatUnaligned(const uint8_t *pointer) {
+    uint32_t floatBits = Message::readUint32Unaligned(pointer);
     float alignedFloat;
-    memcpy(&alignedFloat, pointer, sizeof(float));
+    memcpy(&alignedFloat, &floatBits, sizeof(float));
     return alignedFloat;
 }
 
@@ -24,8 +30,22 @@ void Message::writeUint16Unaligned(uint16_t value, uint8_t *pointer) {
     pointer[1] = value & 0xff;
 }
 
+void Message::writeUint32Unaligned(uint32_t value, uint8_t *pointer) {
+    pointer[0] = (value >> 24) & 0xff;
+    pointer[1] = (value >> 16) & 0xff;
+    pointer[2] = (value >> 8) & 0xff;
+    pointer[3] = value & 0xff;
+}
+
+void Message::writeUint64Unaligned(uint64_t value, uint8_t *pointer) {
+    Message::writeUint32Unaligned(value >> 32, pointer);
+    Message::writeUint32Unaligned(value & 0xffffffff, pointer + sizeof(uint32_t));
+}
+
 void Message::writeFloatUnaligned(float value, uint8_t *pointer) {
-    memcpy(pointer, &value, sizeof(float));
+    uint32_t floatBits;
+    memcpy(&floatBits, &value, sizeof(float));
+    Message::writeUint32Unaligned(floatBits, pointer);
 }
 
 enum MessageType {
@@ -36,7 +56,17 @@ enum MessageType {
     STATS_RESPONSE = 4,
     SET_ANNOTATION_MODE = 5,
     SET_DRC_LEVEL = 6,
-    SET_TARGET_BITRATE = 7
+    SET_TARGET_BITRATE = 7,
+    FORCE_KEYFRAME = 8,
+    SET_FEC_PERCENTAGE = 9,
+    VISION_RESULT = 10,
+    TIME_SYNC_REQUEST = 11,
+    TIME_SYNC_RESPONSE = 12,
+    SET_FRAME_TIMESTAMPS = 13,
+    FRAME_TIMESTAMP = 14,
+    PROFILE_REQUEST = 15,
+    PROFILE_REPORT = 16,
+    SET_RECORDING = 17
 };
 
 std::pair<uint8_t *, size_t> Message::serialize() {
@@ -60,6 +90,18 @@ Message * Message::parse(uint8_t *bytes, size_t len) {
             return new StatsRequestMessage();
         case SET_TARGET_BITRATE:
             return SetBitrateMessage::parse(bytes, len);
+        case FORCE_KEYFRAME:
+            return new ForceKeyframeMessage();
+        case SET_FEC_PERCENTAGE:
+            return SetFecPercentageMessage::parse(bytes, len);
+        case TIME_SYNC_REQUEST:
+            return TimeSyncRequestMessage::parse(bytes, len);
+        case SET_FRAME_TIMESTAMPS:
+            return SetFrameTimestampsMessage::parse(bytes, len);
+        case PROFILE_REQUEST:
+            return new ProfileRequestMessage();
+        case SET_RECORDING:
+            return SetRecordingMessage::parse(bytes, len);
         default:
             throw std::runtime_error("unknown message type");
     }
@@ -83,21 +125,58 @@ Message * SetResFramerateMessage::parse(uint8_t *bytes, size_t len) {
 
 // StatsResponseMessage
 
-static const size_t STATS_RESPONSE_MSG_LEN = sizeof(uint8_t) + sizeof(float) * 4; // size does not incldue uint16_t length prefix
+const uint8_t StatsResponseMessage::VERSION;
 
-StatsResponseMessage::StatsResponseMessage(float pipelineLatency, float rtpQueueLevel, float appsinkQueueLevel, float h264encQueueLevel)
-                                           : pipelineLatency(pipelineLatency), rtpQueueLevel(rtpQueueLevel), appsinkQueueLevel(appsinkQueueLevel), h264encQueueLevel(h264encQueueLevel) {}
+// size does not include uint16_t length prefix
+static const size_t STATS_RESPONSE_MSG_LEN = sizeof(uint8_t) // message type
+                                             + sizeof(uint8_t) // version
+                                             + sizeof(float) * 11 + sizeof(uint32_t) * 2 + sizeof(uint64_t) + sizeof(uint32_t) * 2 // version 1
+                                             + sizeof(float) // version 2
+                                             + sizeof(uint8_t) * 2 // version 3
+                                             + sizeof(float) + sizeof(uint32_t) * 2 // version 4
+                                             + sizeof(uint8_t) + sizeof(uint32_t); // version 5
 
 std::pair<uint8_t *, size_t> StatsResponseMessage::serialize() {
-    // <uitn16_t len><uint8_t messageType><float><float><float><float>
+    // <uint16_t len><uint8_t messageType><uint8_t version><version 1 fields><version 2 fields>..., all big-endian
     auto *bytes = new uint8_t[sizeof(uint16_t) + STATS_RESPONSE_MSG_LEN];
     Message::writeUint16Unaligned(STATS_RESPONSE_MSG_LEN, bytes);
     auto *message = bytes + sizeof(uint16_t);
-    bytes[sizeof(uint16_t)] = MessageType::STATS_RESPONSE;
-    Message::writeFloatUnaligned(pipelineLatency, message + sizeof(uint8_t) + sizeof(float) * 0);
-    Message::writeFloatUnaligned(rtpQueueLevel, message + sizeof(uint8_t) + sizeof(float) * 1);
-    Message::writeFloatUnaligned(appsinkQueueLevel, message + sizeof(uint8_t) + sizeof(float) * 2);
-    Message::writeFloatUnaligned(h264encQueueLevel, message + sizeof(uint8_t) + sizeof(float) * 3);
+    message[0] = MessageType::STATS_RESPONSE;
+    message[1] = VERSION;
+    uint8_t *pointer = message + 2;
+
+    for (float value : {pipelineLatency, pipelineLatencyP50, pipelineLatencyP95, pipelineLatencyP99, pipelineLatencyJitter,
+                        encoderLatency, payloaderLatency, udpsinkLatency,
+                        rtpQueueLevel, appsinkQueueLevel, h264encQueueLevel}) {
+        Message::writeFloatUnaligned(value, pointer);
+        pointer += sizeof(float);
+    }
+    for (uint32_t value : {framesEncoded, framesDropped}) {
+        Message::writeUint32Unaligned(value, pointer);
+        pointer += sizeof(uint32_t);
+    }
+    Message::writeUint64Unaligned(bytesSent, pointer);
+    pointer += sizeof(uint64_t);
+    for (uint32_t value : {actualBitrate, targetBitrate}) {
+        Message::writeUint32Unaligned(value, pointer);
+        pointer += sizeof(uint32_t);
+    }
+    Message::writeFloatUnaligned(resolutionSwitchGap, pointer);
+    pointer += sizeof(float);
+    pointer[0] = viewers;
+    pointer[1] = owner;
+    pointer += sizeof(uint8_t) * 2;
+    Message::writeFloatUnaligned(visionProcessingTime, pointer);
+    pointer += sizeof(float);
+    for (uint32_t value : {visionFramesProcessed, visionFramesDropped}) {
+        Message::writeUint32Unaligned(value, pointer);
+        pointer += sizeof(uint32_t);
+    }
+    pointer[0] = recording;
+    pointer += sizeof(uint8_t);
+    Message::writeUint32Unaligned(recordingFramesDropped, pointer);
+    pointer += sizeof(uint32_t);
+
     return {bytes, sizeof(uint16_t) + STATS_RESPONSE_MSG_LEN};
 }
 
@@ -113,4 +192,76 @@ Message * SetBitrateMessage::parse(uint8_t *bytes, size_t len) {
     }
     uint32_t bitrate = Message::readUint32Unaligned(bytes + sizeof(uint8_t));
     return new SetBitrateMessage(bitrate);
-}
\ No newline at end of file
+}
+
+// SetFecPercentageMessage
+
+static const size_t SET_FEC_PERCENTAGE_MSG_LEN = sizeof(uint8_t) + sizeof(uint8_t);
+
+SetFecPercentageMessage::SetFecPercentageMessage(uint8_t percentage) : percentage(percentage) {}
+
+Message * SetFecPercentageMessage::parse(uint8_t *bytes, size_t len) {
+    if (len != SET_FEC_PERCENTAGE_MSG_LEN) {
+        throw std::runtime_error("improper message len");
+    }
+    return new SetFecPercentageMessage(bytes[1]);
+}
+
+// TimeSyncRequestMessage
+
+static const size_t TIME_SYNC_REQUEST_MSG_LEN = sizeof(uint8_t) + sizeof(uint64_t);
+
+TimeSyncRequestMessage::TimeSyncRequestMessage(uint64_t clientTime) : clientTime(clientTime) {}
+
+Message * TimeSyncRequestMessage::parse(uint8_t *bytes, size_t len) {
+    if (len != TIME_SYNC_REQUEST_MSG_LEN) {
+        throw std::runtime_error("improper message len");
+    }
+    return new TimeSyncRequestMessage(Message::readUint64Unaligned(bytes + sizeof(uint8_t)));
+}
+
+// TimeSyncResponseMessage
+
+static const size_t TIME_SYNC_RESPONSE_MSG_LEN = sizeof(uint8_t) + sizeof(uint64_t) * 3;
+
+TimeSyncResponseMessage::TimeSyncResponseMessage(uint64_t clientTime, uint64_t serverReceiveTime, uint64_t serverSendTime)
+        : clientTime(clientTime), serverReceiveTime(serverReceiveTime), serverSendTime(serverSendTime) {}
+
+std::pair<uint8_t *, size_t> TimeSyncResponseMessage::serialize() {
+    auto *bytes = new uint8_t[sizeof(uint16_t) + TIME_SYNC_RESPONSE_MSG_LEN];
+    Message::writeUint16Unaligned(TIME_SYNC_RESPONSE_MSG_LEN, bytes);
+    auto *message = bytes + sizeof(uint16_t);
+    message[0] = MessageType::TIME_SYNC_RESPONSE;
+    uint8_t *pointer = message + 1;
+    for (uint64_t value : {clientTime, serverReceiveTime, serverSendTime}) {
+        Message::writeUint64Unaligned(value, pointer);
+        pointer += sizeof(uint64_t);
+    }
+    return {bytes, sizeof(uint16_t) + TIME_SYNC_RESPONSE_MSG_LEN};
+}
+
+// SetFrameTimestampsMessage
+
+static const size_t SET_FRAME_TIMESTAMPS_MSG_LEN = sizeof(uint8_t) + sizeof(uint8_t);
+
+SetFrameTimestampsMessage::SetFrameTimestampsMessage(bool enabled) : enabled(enabled) {}
+
+Message * SetFrameTimestampsMessage::parse(uint8_t *bytes, size_t len) {
+    if (len != SET_FRAME_TIMESTAMPS_MSG_LEN) {
+        throw std::runtime_error("improper message len");
+    }
+    return new SetFrameTimestampsMessage(bytes[1] != 0);
+}
+
+// SetRecordingMessage
+
+static const size_t SET_RECORDING_MSG_LEN = sizeof(uint8_t) + sizeof(uint8_t);
+
+SetRecordingMessage::SetRecordingMessage(bool enabled) : enabled(enabled) {}
+
+Message * SetRecordingMessage::parse(uint8_t *bytes, size_t len) {
+    if (len != SET_RECORDING_MSG_LEN) {
+        throw std::runtime_error("improper message len");
+    }
+    return new SetRecordingMessage(bytes[1] != 0);
+}
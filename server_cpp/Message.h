@@ -26,9 +26,12 @@ public:
     // assume big-endian (network order)
     static uint16_t readUint16Unaligned(const uint8_t *pointer);
     static uint32_t readUint32Unaligned(const uint8_t *pointer);
+    static uint64_t readUint64Unaligned(const uint8_t *pointer);
     static float readFloatUnaligned(const uint8_t *pointer);
 
     static void writeUint16Unaligned(uint16_t value, uint8_t *pointer);
+    static void writeUint32Unaligned(uint32_t value, uint8_t *pointer);
+    static void writeUint64Unaligned(uint64_t value, uint8_t *pointer);
     static void writeFloatUnaligned(float value, uint8_t *pointer);
 
     virtual ~Message() = default;
@@ -52,10 +55,39 @@ class ResumeMessage : public Message {
 class StatsRequestMessage : public Message {
 };
 
+// after packet loss or a decoder change, so the client's decoder does not have to wait for the next IDR
+class ForceKeyframeMessage : public Message {
+};
+
+// versioned, see STATS_RESPONSE_SECTIONS in rpividctrl_lib/protocol.py
+// latencies are in seconds, queue levels in buffers, bitrates in bits per second
 class StatsResponseMessage : public Message {
 public:
-    float pipelineLatency, rtpQueueLevel, appsinkQueueLevel, h264encQueueLevel;
-    StatsResponseMessage(float pipelineLatency, float rtpQueueLevel, float appsinkQueueLevel, float h264encQueueLevel);
+    static const uint8_t VERSION = 5;
+
+    // version 1
+    float pipelineLatency = 0, pipelineLatencyP50 = 0, pipelineLatencyP95 = 0, pipelineLatencyP99 = 0, pipelineLatencyJitter = 0;
+    float encoderLatency = 0, payloaderLatency = 0, udpsinkLatency = 0; // camsrc->encoder, encoder->payloader, payloader->udpsink
+    float rtpQueueLevel = 0, appsinkQueueLevel = 0, h264encQueueLevel = 0;
+    uint32_t framesEncoded = 0, framesDropped = 0;
+    uint64_t bytesSent = 0;
+    uint32_t actualBitrate = 0, targetBitrate = 0;
+
+    // version 2
+    float resolutionSwitchGap = 0; // last frame before a resolution change to the first frame after
+
+    // version 3
+    uint8_t viewers = 1; // clients connected to the server
+    uint8_t owner = 1; // 1 if the client receiving the stats can change resolution/framerate/bitrate
+
+    // version 4
+    float visionProcessingTime = 0; // per frame, all vision plugins together
+    uint32_t visionFramesProcessed = 0, visionFramesDropped = 0;
+
+    // version 5
+    uint8_t recording = 0; // 1 if the server is recording to a file
+    uint32_t recordingFramesDropped = 0; // dropped because the file could not be written fast enough
+
     std::pair<uint8_t *, size_t> serialize() override;
 };
 
@@ -66,4 +98,47 @@ public:
     static Message * parse(uint8_t *bytes, size_t len);
 };
 
+// percentage of forward error correction packets, 0 turns it off
+class SetFecPercentageMessage : public Message {
+public:
+    uint8_t percentage;
+    explicit SetFecPercentageMessage(uint8_t percentage);
+    static Message * parse(uint8_t *bytes, size_t len);
+};
+
+// asks for the report of a python server running with --profile
+class ProfileRequestMessage : public Message {
+};
+
+// times are nanoseconds of the sender's monotonic clock
+class TimeSyncRequestMessage : public Message {
+public:
+    uint64_t clientTime;
+    explicit TimeSyncRequestMessage(uint64_t clientTime);
+    static Message * parse(uint8_t *bytes, size_t len);
+};
+
+class TimeSyncResponseMessage : public Message {
+public:
+    uint64_t clientTime, serverReceiveTime, serverSendTime;
+    TimeSyncResponseMessage(uint64_t clientTime, uint64_t serverReceiveTime, uint64_t serverSendTime);
+    std::pair<uint8_t *, size_t> serialize() override;
+};
+
+// turns FRAME_TIMESTAMP messages on or off, for measuring glass-to-glass latency
+class SetFrameTimestampsMessage : public Message {
+public:
+    bool enabled;
+    explicit SetFrameTimestampsMessage(bool enabled);
+    static Message * parse(uint8_t *bytes, size_t len);
+};
+
+// starts or stops recording to a file on the server
+class SetRecordingMessage : public Message {
+public:
+    bool enabled;
+    explicit SetRecordingMessage(bool enabled);
+    static Message * parse(uint8_t *bytes, size_t len);
+};
+
 #endif //RPIVIDCTRL_SERVER_CPP_MESSAGE_H
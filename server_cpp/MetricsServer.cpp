@@ -0,0 +1,184 @@
+#include "MetricsServer.h"
+
+#include <fcntl.h>
+#include <stdexcept>
+#include <sys/socket.h>
+#include <netinet/in.h>
+#include <arpa/inet.h>
+#include <iostream>
+#include <sstream>
+#include <cstring>
+#include <unistd.h>
+
+// a scrape request is a few hundred bytes, anything bigger is not a scraper
+#define MAX_REQUEST_LEN 4096
+#define CONTENT_TYPE "text/plain; version=0.0.4; charset=utf-8"
+
+/**
+ * One http request from a scraper. Reads the request, answers, closes, and deletes itself
+ */
+class MetricsConnection {
+
+private:
+    int fd;
+    GIOChannel *channel;
+    MetricsServer *server;
+    std::string request;
+    std::string response;
+    size_t numWritten;
+
+    static gboolean ioInWrapper(GIOChannel *source, GIOCondition condition, gpointer data) {
+        return ((MetricsConnection *) data)->ioIn();
+    }
+
+    static gboolean ioOutWrapper(GIOChannel *source, GIOCondition condition, gpointer data) {
+        return ((MetricsConnection *) data)->ioOut();
+    }
+
+    gboolean ioIn() {
+        char buf[MAX_REQUEST_LEN];
+        ssize_t recvAmount = recv(this->fd, buf, sizeof(buf), 0);
+        if (recvAmount < 0 && (errno == EAGAIN || errno == EWOULDBLOCK)) {
+            return true;
+        }
+        if (recvAmount <= 0) {
+            delete this;
+            return false;
+        }
+        this->request.append(buf, recvAmount);
+        if (this->request.find("\r\n\r\n") == std::string::npos && this->request.find("\n\n") == std::string::npos) {
+            if (this->request.size() > MAX_REQUEST_LEN) {
+                delete this;
+                return false;
+            }
+            return true;
+        }
+
+        std::istringstream requestLine(this->request.substr(0, this->request.find('\n')));
+        std::string method, path;
+        requestLine >> method >> path;
+        path = path.substr(0, path.find('?'));
+        if (method != "GET" && method != "HEAD") {
+            this->response = buildResponse("405 Method Not Allowed", "", 0);
+        } else if (path != "/metrics") {
+            this->response = buildResponse("404 Not Found", "", 0);
+        } else {
+            std::string body = this->server->collect(this->server->cbData);
+            this->response = buildResponse("200 OK", method == "GET" ? body : "", body.size());
+        }
+        g_io_add_watch(this->channel, G_IO_OUT, ioOutWrapper, this);
+        return false; // removes the G_IO_IN watch
+    }
+
+    gboolean ioOut() {
+        // the response usually fits in the socket buffer, so this sends it all on the first try
+        ssize_t bytesSent = send(this->fd, this->response.data() + this->numWritten, this->response.size() - this->numWritten, MSG_NOSIGNAL);
+        if (bytesSent < 0 && (errno == EAGAIN || errno == EWOULDBLOCK)) {
+            return true;
+        }
+        if (bytesSent < 0) {
+            std::cout << "metrics connection send() failed: " << strerror(errno) << std::endl;
+            delete this;
+            return false;
+        }
+        this->numWritten += bytesSent;
+        if (this->numWritten < this->response.size()) {
+            return true;
+        }
+        delete this;
+        return false;
+    }
+
+    static std::string buildResponse(const char *status, const std::string& body, size_t contentLength) {
+        return std::string("HTTP/1.1 ") + status + "\r\n"
+               "Content-Type: " CONTENT_TYPE "\r\n"
+               "Content-Length: " + std::to_string(contentLength) + "\r\n"
+               "Connection: close\r\n\r\n" + body;
+    }
+
+public:
+    MetricsConnection(int fd, MetricsServer *server) : fd(fd), server(server), numWritten(0) {
+        int prevFlags = fcntl(fd, F_GETFL);
+        fcntl(fd, F_SETFL, prevFlags | O_NONBLOCK);
+        this->channel = g_io_channel_unix_new(fd);
+        g_io_add_watch(this->channel, G_IO_IN, ioInWrapper, this);
+    }
+
+    ~MetricsConnection() {
+        // the watch that is running removes itself by returning false
+        g_io_channel_unref(this->channel);
+        close(this->fd);
+    }
+
+};
+
+MetricsServer::MetricsServer(const char *host, int port, collectCb collect, void *cbData) : collect(collect), cbData(cbData) {
+    this->serverSockFd = socket(AF_INET, SOCK_STREAM, 0);
+    if (this->serverSockFd < 0) {
+        this->error("failed to create metrics socket");
+    }
+    int reuseAddrVal = 1;
+    if (setsockopt(this->serverSockFd, SOL_SOCKET, SO_REUSEADDR, &reuseAddrVal, sizeof(reuseAddrVal))) {
+        this->error("setsockopt(SO_REUSEADDR) failed");
+    }
+
+    struct sockaddr_in addr{};
+    addr.sin_family = AF_INET;
+    if (strlen(host) == 0) {
+        // blank string -> listen on all interfaces
+        addr.sin_addr.s_addr = INADDR_ANY;
+    } else if (inet_pton(AF_INET, host, &addr.sin_addr) == 0) {
+        throw std::runtime_error("invalid ipv4 address provided: " + std::string(host));
+    }
+    addr.sin_port = htons(port);
+
+    if (bind(this->serverSockFd, (struct sockaddr*) &addr, sizeof(addr)) < 0) {
+        this->error("metrics bind() failed");
+    }
+    if (listen(this->serverSockFd, 5) < 0) {
+        this->error("metrics listen() failed");
+    }
+    std::cout << "metrics on port " << port << ", path /metrics" << std::endl;
+
+    this->serverSockChannel = g_io_channel_unix_new(this->serverSockFd);
+    this->newConnListenerId = g_io_add_watch(this->serverSockChannel, G_IO_IN, newConnWrapper, this);
+}
+
+MetricsServer::~MetricsServer() {
+    g_source_remove(this->newConnListenerId);
+    g_io_channel_unref(this->serverSockChannel);
+    close(this->serverSockFd);
+}
+
+gboolean MetricsServer::newConnWrapper(GIOChannel *source, GIOCondition condition, gpointer data) {
+    return ((MetricsServer *) data)->newConn(source, condition);
+}
+
+gboolean MetricsServer::newConn(GIOChannel *source, GIOCondition condition) {
+    int connFd = accept(this->serverSockFd, nullptr, nullptr);
+    if (connFd < 0) {
+        std::cout << "metrics accept() failed: " << strerror(errno) << std::endl;
+        return true;
+    }
+    new MetricsConnection(connFd, this); // deletes itself once the response is sent
+    return true;
+}
+
+void MetricsServer::error(const std::string& reason) const {
+    throw std::runtime_error(reason + ": " + std::string(strerror(errno)));
+}
+
+void appendMetricHeader(std::string& out, const char *name, const char *type, const char *help) {
+    out += std::string("# HELP ") + name + ' ' + help + "\n# TYPE " + name + ' ' + type + '\n';
+}
+
+void appendMetric(std::string& out, const char *name, double value, const std::string& labels) {
+    std::ostringstream line;
+    line.precision(17);
+    line << name;
+    if (!labels.empty()) {
+        line << '{' << labels << '}';
+    }
+    line << ' ' << value << '\n';
+    out += line.str();
+}
@@ -0,0 +1,40 @@
+#ifndef RPIVIDCTRL_SERVER_CPP_METRICSSERVER_H
+#define RPIVIDCTRL_SERVER_CPP_METRICSSERVER_H
+
+#include <glib.h>
+#include <string>
+
+/**
+ * Serves GET /metrics in the prometheus text format, on the GLib main loop (see metrics.py in the python version)
+ *
+ * collect is called on the main loop for every scrape. It should only read counters the streaming threads already
+ * keep up to date, so scraping never adds work to them.
+ */
+class MetricsServer {
+
+private:
+    static gboolean newConnWrapper(GIOChannel *source, GIOCondition condition, gpointer data);
+    gboolean newConn(GIOChannel *source, GIOCondition condition);
+    void error(const std::string& reason) const;
+
+    int serverSockFd;
+    GIOChannel *serverSockChannel;
+    guint newConnListenerId;
+
+public:
+    typedef std::string(*collectCb)(void *data);
+
+    MetricsServer(const char *host, int port, collectCb collect, void *cbData);
+    ~MetricsServer();
+
+    collectCb collect;
+    void *cbData;
+
+};
+
+// helpers for building the text format in a collectCb
+void appendMetricHeader(std::string& out, const char *name, const char *type, const char *help);
+void appendMetric(std::string& out, const char *name, double value, const std::string& labels = "");
+
+
+#endif //RPIVIDCTRL_SERVER_CPP_METRICSSERVER_H
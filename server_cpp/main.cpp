@@ -1,5 +1,6 @@
 #include <iostream>
 #include <gst/gst.h>
+#include <gst/video/video.h>
 #include <glib.h>
 #include <glib-unix.h>
 #include <csignal>
@@ -8,15 +9,27 @@
 #include <arpa/inet.h>
 #include <string>
 #include <stdexcept>
+#include <atomic>
+#include <algorithm>
+#include <map>
 
 #include "SocketManager.h"
 #include "Message.h"
+#include "MetricsServer.h"
 
 // 20 byte IPv4 header + 8 byte UDP header
 #define IPV4_UDP_OVERHEAD (20 + 8)
+// a fec packet is as big as the biggest packet it protects, plus a 1 byte RED header, 10 byte ULPFEC header and
+// 6 byte ULPFEC level header (with the long mask)
+#define FEC_OVERHEAD (1 + 10 + 6)
 
 #define REMOTE_CONTROL_PORT 1875
 #define RTP_PORT 1874
+#define ULPFEC_PAYLOAD_TYPE 122
+#define RED_PAYLOAD_TYPE 123
+
+// ignore keyframe requests that come in faster than this
+#define KEYFRAME_MIN_INTERVAL_US (200 * 1000)
 
 class Main {
 
@@ -24,13 +37,24 @@ private:
     GMainLoop *mainLoop;
     GstPipeline *pipeline;
     GstElement *camsrc, *camsrcCapsFilter, *rtpQueue, *tee, *appsinkQueue, *appsink, *h264encQueue, *h264enc,
-        *h264encCapsFilter, *h264parse, *rtph264pay, *udpsink;
+        *h264encCapsFilter, *h264parse, *rtph264pay, *rtpulpfecenc, *rtpredenc, *udpsink;
+
+    std::atomic<uint64_t> bytesSent;
+    std::atomic<uint64_t> packetsSent;
+    std::atomic<uint64_t> framesCaptured;
+    std::atomic<uint64_t> framesEncoded;
+    std::map<std::string, uint64_t> controlMessages; // message type -> messages received, only used on the main loop
+    MetricsServer *metricsServer;
+    uint64_t lastStatsBytesSent;
+    gint64 lastStatsTime;
+    gint64 lastKeyframeTime;
 
     bool imageProcessing;
     int width;
     int height;
     int framerate;
     int targetBitrate;
+    int fecPercentage;
 
     int serverSockFd;
     GIOChannel *serverSockChannel;
@@ -43,6 +67,8 @@ private:
 
     void resume();
     void pause();
+    void forceKeyframe();
+    void setFecPercentage(int percentage);
 
     GstCaps *generateCamsrcCaps() const;
     void addCamsrcControls(GstStructure *structure) const;
@@ -53,10 +79,15 @@ private:
     void error(const std::string& reason) const;
 
 public:
-    Main(const char *host, int mtu);
+    Main(const char *host, int mtu, int metricsPort);
     ~Main();
     static gboolean busCallWrapper(GstBus *bus, GstMessage *msg, gpointer data);
     gboolean busCall(GstBus *bus, GstMessage *msg);
+    static GstPadProbeReturn udpsinkProbeWrapper(GstPad *pad, GstPadProbeInfo *info, gpointer data);
+    static GstPadProbeReturn camsrcProbeWrapper(GstPad *pad, GstPadProbeInfo *info, gpointer data);
+    static GstPadProbeReturn encoderOutputProbeWrapper(GstPad *pad, GstPadProbeInfo *info, gpointer data);
+    static std::string collectMetricsWrapper(void *data);
+    std::string collectMetrics();
     static GstFlowReturn newSampleWrapper(GstElement *element, gpointer data);
     GstFlowReturn newSample(GstElement *element);
     static gboolean sigintWrapper(gpointer data);
@@ -109,6 +140,93 @@ gboolean Main::busCall(GstBus *bus, GstMessage *msg) {
     return true;
 }
 
+GstPadProbeReturn Main::udpsinkProbeWrapper(GstPad *pad, GstPadProbeInfo *info, gpointer data) {
+    // called from the streaming thread
+    Main *main = (Main*) data;
+    main->bytesSent += gst_buffer_get_size(GST_PAD_PROBE_INFO_BUFFER(info));
+    main->packetsSent++;
+    return GST_PAD_PROBE_OK;
+}
+
+GstPadProbeReturn Main::camsrcProbeWrapper(GstPad *pad, GstPadProbeInfo *info, gpointer data) {
+    // called from the streaming thread
+    ((Main*) data)->framesCaptured++;
+    return GST_PAD_PROBE_OK;
+}
+
+GstPadProbeReturn Main::encoderOutputProbeWrapper(GstPad *pad, GstPadProbeInfo *info, gpointer data) {
+    // called from the streaming thread
+    ((Main*) data)->framesEncoded++;
+    return GST_PAD_PROBE_OK;
+}
+
+// same names as MessageType in rpividctrl_lib/protocol.py, so both servers have the same metric labels
+static const char *messageTypeName(Message *message) {
+    if (dynamic_cast<SetResFramerateMessage*>(message) != nullptr) return "SET_RESOLUTION_FRAMERATE";
+    if (dynamic_cast<PauseMessage*>(message) != nullptr) return "PAUSE";
+    if (dynamic_cast<ResumeMessage*>(message) != nullptr) return "RESUME";
+    if (dynamic_cast<StatsRequestMessage*>(message) != nullptr) return "STATS_REQUEST";
+    if (dynamic_cast<SetBitrateMessage*>(message) != nullptr) return "SET_TARGET_BITRATE";
+    if (dynamic_cast<ForceKeyframeMessage*>(message) != nullptr) return "FORCE_KEYFRAME";
+    if (dynamic_cast<SetFecPercentageMessage*>(message) != nullptr) return "SET_FEC_PERCENTAGE";
+    if (dynamic_cast<TimeSyncRequestMessage*>(message) != nullptr) return "TIME_SYNC_REQUEST";
+    if (dynamic_cast<SetFrameTimestampsMessage*>(message) != nullptr) return "SET_FRAME_TIMESTAMPS";
+    if (dynamic_cast<ProfileRequestMessage*>(message) != nullptr) return "PROFILE_REQUEST";
+    if (dynamic_cast<SetRecordingMessage*>(message) != nullptr) return "SET_RECORDING";
+    return "OTHER";
+}
+
+std::string Main::collectMetricsWrapper(void *data) {
+    return ((Main*) data)->collectMetrics();
+}
+
+std::string Main::collectMetrics() {
+    // runs on the main loop, and only reads what the probes already count
+    std::string out;
+    appendMetricHeader(out, "rpividctrl_frames_captured_total", "counter", "Frames that left the camera");
+    appendMetric(out, "rpividctrl_frames_captured_total", this->framesCaptured);
+    appendMetricHeader(out, "rpividctrl_frames_encoded_total", "counter", "Frames that left the h264 encoder");
+    appendMetric(out, "rpividctrl_frames_encoded_total", this->framesEncoded);
+    appendMetricHeader(out, "rpividctrl_bytes_sent_total", "counter", "Bytes of rtp sent to each viewer");
+    appendMetric(out, "rpividctrl_bytes_sent_total", this->bytesSent);
+    appendMetricHeader(out, "rpividctrl_rtp_packets_sent_total", "counter", "Rtp packets sent to each viewer, including fec");
+    appendMetric(out, "rpividctrl_rtp_packets_sent_total", this->packetsSent);
+    appendMetricHeader(out, "rpividctrl_control_messages_total", "counter", "Control messages received, by type");
+    for (const auto& entry : this->controlMessages) {
+        appendMetric(out, "rpividctrl_control_messages_total", entry.second, "type=\"" + entry.first + "\"");
+    }
+
+    appendMetricHeader(out, "rpividctrl_queue_level_buffers", "gauge", "Buffers in each queue right now");
+    guint queueLevel;
+    g_object_get(this->rtpQueue, "current-level-buffers", &queueLevel, nullptr);
+    appendMetric(out, "rpividctrl_queue_level_buffers", queueLevel, "queue=\"rtp_queue\"");
+    if (this->imageProcessing) {
+        g_object_get(this->appsinkQueue, "current-level-buffers", &queueLevel, nullptr);
+        appendMetric(out, "rpividctrl_queue_level_buffers", queueLevel, "queue=\"appsink_queue\"");
+        g_object_get(this->h264encQueue, "current-level-buffers", &queueLevel, nullptr);
+        appendMetric(out, "rpividctrl_queue_level_buffers", queueLevel, "queue=\"h264enc_queue\"");
+    }
+
+    GstState state;
+    gst_element_get_state(GST_ELEMENT(this->pipeline), &state, nullptr, 0);
+    appendMetricHeader(out, "rpividctrl_camera_active", "gauge", "1 if the camera element exists");
+    appendMetric(out, "rpividctrl_camera_active", this->camsrc != nullptr);
+    appendMetricHeader(out, "rpividctrl_pipeline_playing", "gauge", "1 if the pipeline is playing");
+    appendMetric(out, "rpividctrl_pipeline_playing", state == GST_STATE_PLAYING);
+    appendMetricHeader(out, "rpividctrl_viewers", "gauge", "Connected viewers");
+    appendMetric(out, "rpividctrl_viewers", this->clientSockManager != nullptr, "state=\"connected\"");
+    appendMetricHeader(out, "rpividctrl_target_bitrate_bits", "gauge", "Encoder target bitrate");
+    appendMetric(out, "rpividctrl_target_bitrate_bits", this->targetBitrate);
+    appendMetricHeader(out, "rpividctrl_fec_percentage", "gauge", "Forward error correction overhead");
+    appendMetric(out, "rpividctrl_fec_percentage", this->fecPercentage);
+    appendMetricHeader(out, "rpividctrl_resolution_pixels", "gauge", "Resolution of the camera");
+    appendMetric(out, "rpividctrl_resolution_pixels", this->width, "dimension=\"width\"");
+    appendMetric(out, "rpividctrl_resolution_pixels", this->height, "dimension=\"height\"");
+    appendMetricHeader(out, "rpividctrl_framerate", "gauge", "Framerate of the camera");
+    appendMetric(out, "rpividctrl_framerate", this->framerate);
+    return out;
+}
+
 GstFlowReturn Main::newSampleWrapper(GstElement *element, gpointer data) {
     Main *main = (Main*) data;
     return main->newSample(element);
@@ -168,6 +286,8 @@ void Main::clientSockMessageWrapper(Message *message, void *data) {
 }
 
 void Main::clientSockMessage(Message *message) {
+    this->controlMessages[messageTypeName(message)]++;
+
     auto *setResFramerateMsg = dynamic_cast<SetResFramerateMessage*>(message);
     if (setResFramerateMsg != nullptr) {
         std::cout << "set res framerate message, width=" << setResFramerateMsg->width << ", height=" << setResFramerateMsg->height << ", framerate=" << setResFramerateMsg->framerate << std::endl;
@@ -191,11 +311,73 @@ void Main::clientSockMessage(Message *message) {
     auto *statsRequestMessage = dynamic_cast<StatsRequestMessage*>(message);
     if (statsRequestMessage != nullptr) {
         std::cout << "stats req message" << std::endl;
-        auto response = StatsResponseMessage(0.0, 0.0, 0.0, 0.0);
+        StatsResponseMessage response;
+        guint queueLevel;
+        g_object_get(this->rtpQueue, "current-level-buffers", &queueLevel, nullptr);
+        response.rtpQueueLevel = queueLevel;
+        if (this->imageProcessing) {
+            g_object_get(this->appsinkQueue, "current-level-buffers", &queueLevel, nullptr);
+            response.appsinkQueueLevel = queueLevel;
+            g_object_get(this->h264encQueue, "current-level-buffers", &queueLevel, nullptr);
+            response.h264encQueueLevel = queueLevel;
+        }
+
+        uint64_t bytesSentNow = this->bytesSent;
+        gint64 now = g_get_monotonic_time(); // microseconds
+        gint64 elapsed = now - this->lastStatsTime;
+        response.bytesSent = bytesSentNow;
+        response.actualBitrate = elapsed > 0 ? (bytesSentNow - this->lastStatsBytesSent) * 8 * G_USEC_PER_SEC / elapsed : 0;
+        response.targetBitrate = this->targetBitrate;
+        this->lastStatsBytesSent = bytesSentNow;
+        this->lastStatsTime = now;
+
+        this->clientSockManager->sendMessage(&response);
+        return;
+    }
+
+    auto *forceKeyframeMessage = dynamic_cast<ForceKeyframeMessage*>(message);
+    if (forceKeyframeMessage != nullptr) {
+        this->forceKeyframe();
+        return;
+    }
+
+    auto *setFecPercentageMessage = dynamic_cast<SetFecPercentageMessage*>(message);
+    if (setFecPercentageMessage != nullptr) {
+        this->setFecPercentage(setFecPercentageMessage->percentage);
+        return;
+    }
+
+    auto *profileRequestMessage = dynamic_cast<ProfileRequestMessage*>(message);
+    if (profileRequestMessage != nullptr) {
+        std::cout << "profiling is not supported, use GST_TRACERS and GST_DEBUG=GST_TRACER:7 instead" << std::endl;
+        return;
+    }
+
+    auto *timeSyncRequestMessage = dynamic_cast<TimeSyncRequestMessage*>(message);
+    if (timeSyncRequestMessage != nullptr) {
+        // same clock as the python server (CLOCK_MONOTONIC), in nanoseconds
+        uint64_t receiveTime = g_get_monotonic_time() * 1000;
+        TimeSyncResponseMessage response(timeSyncRequestMessage->clientTime, receiveTime, g_get_monotonic_time() * 1000);
         this->clientSockManager->sendMessage(&response);
         return;
     }
 
+    auto *setFrameTimestampsMessage = dynamic_cast<SetFrameTimestampsMessage*>(message);
+    if (setFrameTimestampsMessage != nullptr) {
+        if (setFrameTimestampsMessage->enabled) {
+            std::cout << "frame timestamps are not supported, glass-to-glass latency will not be measured" << std::endl;
+        }
+        return;
+    }
+
+    auto *setRecordingMessage = dynamic_cast<SetRecordingMessage*>(message);
+    if (setRecordingMessage != nullptr) {
+        if (setRecordingMessage->enabled) {
+            std::cout << "recording is not supported, use the python server to record" << std::endl;
+        }
+        return;
+    }
+
     auto *setBitrateMessage = dynamic_cast<SetBitrateMessage*>(message);
     if (setBitrateMessage != nullptr) {
         std::cout << "set bitrate " << setBitrateMessage->bitrate << std::endl;
@@ -218,7 +400,7 @@ void Main::clientSockDestroy(const std::string& reason) {
     this->destroyCameraElement();
 }
 
-Main::Main(const char *host, int mtu) {
+Main::Main(const char *host, int mtu, int metricsPort) {
     this->mainLoop = g_main_loop_new(nullptr, false);
 
     this->pipeline = GST_PIPELINE(gst_pipeline_new(nullptr));
@@ -301,28 +483,61 @@ Main::Main(const char *host, int mtu) {
         gst_bin_add(GST_BIN(this->pipeline), this->h264encCapsFilter);
         gst_element_link_many(this->h264enc, this->h264encCapsFilter, this->rtpQueue, nullptr);
 
+        GstPad *encoderOutputPad = gst_element_get_static_pad(this->h264encCapsFilter, "src");
+        gst_pad_add_probe(encoderOutputPad, GST_PAD_PROBE_TYPE_BUFFER, encoderOutputProbeWrapper, this, nullptr);
+        gst_object_unref(encoderOutputPad);
+
     } else {
 
         this->h264parse = gst_element_factory_make("h264parse", nullptr);
         gst_bin_add(GST_BIN(this->pipeline), this->h264parse);
         gst_element_link_many(this->camsrcCapsFilter, this->h264parse, this->rtpQueue, nullptr);
 
+        // the camera encodes h264 itself
+        GstPad *encoderOutputPad = gst_element_get_static_pad(this->h264parse, "src");
+        gst_pad_add_probe(encoderOutputPad, GST_PAD_PROBE_TYPE_BUFFER, encoderOutputProbeWrapper, this, nullptr);
+        gst_object_unref(encoderOutputPad);
+
     }
 
-    // ... -> queue -> rtph264pay -> udpsink
+    // ... -> queue -> rtph264pay -> rtpulpfecenc -> rtpredenc -> udpsink
 
     this->rtph264pay = gst_element_factory_make("rtph264pay", nullptr);
-    g_object_set(this->rtph264pay, "mtu", mtu - IPV4_UDP_OVERHEAD, nullptr);
+    g_object_set(this->rtph264pay, "mtu", mtu - IPV4_UDP_OVERHEAD - FEC_OVERHEAD, nullptr);
     gst_bin_add(GST_BIN(this->pipeline), this->rtph264pay);
     gst_element_link(this->rtpQueue, this->rtph264pay);
 
+    // forward error correction, off until the client sets a percentage
+    this->fecPercentage = 0;
+    this->rtpulpfecenc = gst_element_factory_make("rtpulpfecenc", nullptr);
+    g_object_set(this->rtpulpfecenc, "pt", ULPFEC_PAYLOAD_TYPE,
+                 "percentage", 0,
+                 nullptr);
+    gst_bin_add(GST_BIN(this->pipeline), this->rtpulpfecenc);
+    gst_element_link(this->rtph264pay, this->rtpulpfecenc);
+
+    this->rtpredenc = gst_element_factory_make("rtpredenc", nullptr);
+    g_object_set(this->rtpredenc, "pt", RED_PAYLOAD_TYPE, nullptr);
+    gst_bin_add(GST_BIN(this->pipeline), this->rtpredenc);
+    gst_element_link(this->rtpulpfecenc, this->rtpredenc);
+
     this->udpsink = gst_element_factory_make("udpsink", nullptr);
     g_object_set(this->udpsink, "port", RTP_PORT,
                  "sync", false,
                  nullptr);
     //TODO: buffer_processed_pad stuff
+    this->bytesSent = 0;
+    this->packetsSent = 0;
+    this->framesCaptured = 0;
+    this->framesEncoded = 0;
+    this->lastStatsBytesSent = 0;
+    this->lastStatsTime = g_get_monotonic_time();
+    this->lastKeyframeTime = 0;
+    GstPad *udpsinkPad = gst_element_get_static_pad(this->udpsink, "sink");
+    gst_pad_add_probe(udpsinkPad, GST_PAD_PROBE_TYPE_BUFFER, udpsinkProbeWrapper, this, nullptr);
+    gst_object_unref(udpsinkPad);
     gst_bin_add(GST_BIN(this->pipeline), this->udpsink);
-    gst_element_link(this->rtph264pay, this->udpsink);
+    gst_element_link(this->rtpredenc, this->udpsink);
 
     std::cout << "init server" << std::endl;
     this->serverSockFd = socket(AF_INET, SOCK_STREAM, 0);
@@ -356,6 +571,8 @@ Main::Main(const char *host, int mtu) {
     this->clientSockManager = nullptr;
     this->newConnListenerId = g_io_add_watch(this->serverSockChannel, G_IO_IN, newConnWrapper, this);
 
+    // 0 -> no metrics server
+    this->metricsServer = metricsPort > 0 ? new MetricsServer(host, metricsPort, collectMetricsWrapper, this) : nullptr;
 }
 
 Main::~Main() {
@@ -363,6 +580,8 @@ Main::~Main() {
         this->clientSockManager->destroy("main destructor"); // destroy handler calls `delete` and pauses pipeline
     }
 
+    delete this->metricsServer;
+
     gst_element_set_state(GST_ELEMENT(this->pipeline), GST_STATE_NULL);
     gst_object_unref(this->pipeline);
 
@@ -394,6 +613,39 @@ void Main::pause() {
     gst_element_set_state(GST_ELEMENT(this->pipeline), GST_STATE_PAUSED);
 }
 
+void Main::setFecPercentage(int percentage) {
+    this->fecPercentage = std::min(percentage, 100);
+    std::cout << "set fec percentage " << this->fecPercentage << std::endl;
+    // while fec is on, every packet is wrapped in RED. while it is off, rtpredenc passes the h264 packets through untouched
+    g_object_set(this->rtpulpfecenc, "percentage", this->fecPercentage, nullptr);
+    g_object_set(this->rtpredenc, "allow-no-red-blocks", this->fecPercentage > 0, nullptr);
+}
+
+void Main::forceKeyframe() {
+    gint64 now = g_get_monotonic_time();
+    if (this->camsrc == nullptr || (this->lastKeyframeTime != 0 && now - this->lastKeyframeTime < KEYFRAME_MIN_INTERVAL_US)) {
+        return;
+    }
+    this->lastKeyframeTime = now;
+    std::cout << "force keyframe" << std::endl;
+
+    if (this->imageProcessing) {
+        // goes upstream from the payloader to v4l2h264enc
+        GstEvent *event = gst_video_event_new_upstream_force_key_unit(GST_CLOCK_TIME_NONE, true, 0);
+        GstPad *rtph264payPad = gst_element_get_static_pad(this->rtph264pay, "sink");
+        gst_pad_push_event(rtph264payPad, event); // takes ownership of event
+        gst_object_unref(rtph264payPad);
+    } else {
+        // the camera encodes h264 itself, and v4l2src does not handle force-key-unit events
+        GstStructure *camsrcExtraControls = gst_structure_new_empty("extra_controls");
+        this->addCamsrcControls(camsrcExtraControls);
+        this->addH264EncControls(camsrcExtraControls);
+        gst_structure_set(camsrcExtraControls, "force_key_frame", G_TYPE_INT, 1, nullptr);
+        g_object_set(this->camsrc, "extra_controls", camsrcExtraControls, nullptr);
+        gst_structure_free(camsrcExtraControls); // g_object_set copies it
+    }
+}
+
 GstCaps *Main::generateCamsrcCaps() const {
     if (this->imageProcessing) {
         return gst_caps_new_simple("video/x-raw",
@@ -439,6 +691,9 @@ void Main::generateCameraElement() {
     }
     g_object_set(this->camsrc, "extra_controls", camsrcExtraControls, nullptr);
     //TODO: pad probe stuff
+    GstPad *camsrcPad = gst_element_get_static_pad(this->camsrc, "src");
+    gst_pad_add_probe(camsrcPad, GST_PAD_PROBE_TYPE_BUFFER, camsrcProbeWrapper, this, nullptr);
+    gst_object_unref(camsrcPad);
     gst_bin_add(GST_BIN(this->pipeline), this->camsrc);
     gst_element_link(this->camsrc, this->camsrcCapsFilter);
 }
@@ -476,6 +731,10 @@ int main(int argc, char** argv) {
         mtu = std::stoi(mtuStr);
     }
 
-    Main main(host, mtu);
+    // http port for prometheus metrics, off if not set
+    const char* metricsPortStr = std::getenv("RPIVIDCTRL_SERVER_METRICS_PORT");
+    int metricsPort = metricsPortStr == nullptr ? 0 : std::stoi(metricsPortStr);
+
+    Main main(host, mtu, metricsPort);
     main.run();
 }
@@ -0,0 +1,84 @@
+import math
+import numpy as np
+
+STATS_BUFFER_LEN = 50  # average last n samples
+
+
+class RollingStats:
+    """
+    Statistics over the last n samples of one metric
+
+    Samples are stored in a preallocated ring, so adding a sample (for example from a pad probe) does not grow
+    anything. The mean is kept as a running sum of floats, so it is O(1). Percentiles are only computed when asked for.
+
+    The ring is a plain list, because setting an element of a list is the cheapest store Python has (an array.array
+    or numpy array converts the float on every store). numpy only sees the samples when min, max or percentiles
+    are asked for.
+    """
+
+    JITTER_GAIN = 1 / 16  # smoothing of the jitter estimate, same as RFC 3550 interarrival jitter
+
+    def __init__(self, size=STATS_BUFFER_LEN):
+        self.size = size
+        self.samples = [0.0] * size
+        self.count = 0
+        self.index = 0
+        self.total = 0.0
+        self.jitter = 0.0
+
+    def add(self, value):
+        samples = self.samples
+        index = self.index
+        count = self.count
+        if count == self.size:
+            self.total += value - samples[index]
+        else:
+            self.count = count = count + 1
+            self.total += value
+        samples[index] = value
+
+        if count > 1:  # samples[index - 1] is the previous sample, also right after wrapping around
+            self.jitter += (abs(value - samples[index - 1]) - self.jitter) * self.JITTER_GAIN
+
+        index += 1
+        if index == self.size:
+            index = 0
+            # re-sum once per lap, so rounding errors from adding and subtracting do not pile up
+            self.total = math.fsum(samples)
+        self.index = index
+
+    def clear(self):
+        self.count = 0
+        self.index = 0
+        self.total = 0.0
+        self.jitter = 0.0
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def min(self):
+        return min(self.samples[:self.count]) if self.count > 0 else 0.0
+
+    def max(self):
+        return max(self.samples[:self.count]) if self.count > 0 else 0.0
+
+    def percentiles(self, percents):
+        """Returns a list with a value for each percent (0-100) in percents"""
+        if self.count == 0:
+            return [0.0] * len(percents)
+        return np.percentile(self.samples[:self.count], percents).tolist()
+
+    def percentile(self, percent):
+        return self.percentiles((percent, ))[0]
+
+    def summary(self):
+        p50, p95, p99 = self.percentiles((50, 95, 99))
+        return {
+            'mean': self.mean(),
+            'min': self.min(),
+            'max': self.max(),
+            'p50': p50,
+            'p95': p95,
+            'p99': p99,
+            'jitter': self.jitter
+        }
@@ -0,0 +1,85 @@
+import pytest
+
+from rpividctrl_lib.abr import AimdBitrateController
+
+INTERVAL = 0.5  # seconds between updates, like the client's stats requests
+
+
+def run(controller, trace, start=0.0):
+    """trace is a list of (loss_rate, rtt), one per update. Returns the bitrate after each update"""
+    bitrates = []
+    for i, (loss_rate, rtt) in enumerate(trace):
+        bitrates.append(controller.update(loss_rate, rtt, now=start + i * INTERVAL))
+    return bitrates
+
+
+def test_floor_above_ceiling():
+    with pytest.raises(ValueError):
+        AimdBitrateController(2000000, 1000000)
+
+
+def test_clean_channel_increases_to_ceiling():
+    controller = AimdBitrateController(150000, 1000000, initial=500000)
+    bitrates = run(controller, [(0.0, 0.01)] * 30)
+    assert bitrates == sorted(bitrates)
+    assert bitrates[-1] == 1000000
+
+
+def test_high_loss_decreases_to_floor():
+    controller = AimdBitrateController(150000, 2000000, initial=2000000)
+    bitrates = run(controller, [(0.3, 0.01)] * 30)
+    assert bitrates[0] == int(2000000 * 0.85)
+    assert bitrates == sorted(bitrates, reverse=True)
+    assert bitrates[-1] == 150000
+
+
+def test_moderate_loss_holds():
+    controller = AimdBitrateController(150000, 2000000, initial=1000000)
+    assert run(controller, [(0.05, 0.01)] * 10) == [1000000] * 10
+
+
+def test_holds_after_decrease():
+    controller = AimdBitrateController(150000, 2000000, initial=1000000, hold_updates=4)
+    bitrates = run(controller, [(0.5, 0.01)] + [(0.0, 0.01)] * 6)
+    decreased = bitrates[0]
+    assert bitrates[1:5] == [decreased] * 4
+    assert bitrates[5] == decreased + controller.increase_step
+
+
+def test_does_not_increase_past_what_the_encoder_produces():
+    controller = AimdBitrateController(150000, 2000000, initial=1000000)
+    for i in range(10):
+        assert controller.update(0.0, 0.01, actual_bitrate=300000, now=i * INTERVAL) == 1000000
+
+
+def test_rtt_increase_decreases():
+    controller = AimdBitrateController(150000, 2000000, initial=1000000)
+    bitrates = run(controller, [(0.0, 0.01)] * 4 + [(0.0, 0.2)])
+    assert bitrates[-1] < bitrates[-2]
+
+
+def test_min_rtt_follows_lasting_rtt_increase():
+    controller = AimdBitrateController(150000, 2000000, initial=1000000, min_rtt_window=10)
+    run(controller, [(0.0, 0.01)] * 20)
+    # the route changes and every round trip takes 200 ms from now on, without any loss
+    bitrates = run(controller, [(0.0, 0.2)] * 120, start=20 * INTERVAL)
+    assert controller.min_rtt == 0.2
+    # congested until the 10 ms samples leave the window, then it climbs back up
+    assert bitrates[int(10 / INTERVAL) - 2] == 150000
+    assert bitrates[-1] == 2000000
+
+
+def test_min_rtt_is_windowed_minimum():
+    controller = AimdBitrateController(150000, 2000000, min_rtt_window=2)
+    rtts = [0.05, 0.03, 0.04, 0.06, 0.08, 0.07, 0.09, 0.1]
+    for i, rtt in enumerate(rtts):
+        controller.update(0.0, rtt, now=i * INTERVAL)
+        window = [rtts[j] for j in range(i + 1) if j * INTERVAL >= i * INTERVAL - 2]
+        assert controller.min_rtt == min(window)
+
+
+def test_reset():
+    controller = AimdBitrateController(150000, 2000000, initial=1000000)
+    controller.reset(5000000)
+    assert controller.bitrate == 2000000
+    assert controller.update(0.0, 0.01, now=0) == 2000000
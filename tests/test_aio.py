@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from rpividctrl_lib.aio import AsyncControlClient
+from rpividctrl_lib.protocol import MessageBuilder
+
+
+async def serve_silently(reader, writer):
+    # like the C++ server with a PROFILE_REQUEST: reads it and never answers
+    while await reader.read(4096):
+        pass
+    writer.close()
+
+
+def test_timed_out_requests_stop_waiting():
+    async def run():
+        server = await asyncio.start_server(serve_silently, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            async with await AsyncControlClient.connect('127.0.0.1', port) as client:
+                for i in range(3):
+                    with pytest.raises(asyncio.TimeoutError):
+                        await client.request_profile_report(timeout=0.01)
+                    with pytest.raises(asyncio.TimeoutError):
+                        await client.request_stats(timeout=0.01)
+                # the replies that never came are a count, not a waiter each
+                assert len(client.profile_waiters) == 1
+                assert len(client.stats_waiters) == 1
+
+    asyncio.run(run())
+
+
+def serve_late(delays):
+    """Answers the n-th PROFILE_REQUEST with the report {'n': n}, after delays[n] seconds. In order, like the server"""
+    async def serve(reader, writer):
+        n = 0
+        try:
+            while True:
+                await reader.readexactly(len(MessageBuilder.PROFILE_REQUEST))
+                await asyncio.sleep(delays.get(n, 0))
+                writer.write(MessageBuilder.profile_report({'n': n}))
+                n += 1
+        except asyncio.IncompleteReadError:
+            writer.close()
+    return serve
+
+
+def test_late_reply_after_timeout():
+    async def run():
+        server = await asyncio.start_server(serve_late({0: 0.2}), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            async with await AsyncControlClient.connect('127.0.0.1', port) as client:
+                with pytest.raises(asyncio.TimeoutError):
+                    await client.request_profile_report(timeout=0.05)
+                # the late reply to the first request is dropped, not taken as the answer to this one
+                assert await client.request_profile_report(timeout=2) == {'n': 1}
+                assert await client.request_profile_report(timeout=2) == {'n': 2}
+                assert len(client.profile_waiters) == 0
+
+    asyncio.run(run())
+
+
+def test_timeout_behind_a_waiting_request():
+    async def run():
+        # both replies come late, the second request gives up before they do
+        server = await asyncio.start_server(serve_late({0: 0.2, 1: 0.2}), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            async with await AsyncControlClient.connect('127.0.0.1', port) as client:
+                first = asyncio.ensure_future(client.request_profile_report(timeout=2))
+                await asyncio.sleep(0.01)
+                with pytest.raises(asyncio.TimeoutError):
+                    await client.request_profile_report(timeout=0.05)
+                assert await first == {'n': 0}
+                assert await client.request_profile_report(timeout=2) == {'n': 2}
+
+    asyncio.run(run())
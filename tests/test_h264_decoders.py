@@ -0,0 +1,58 @@
+import pytest
+
+gi = pytest.importorskip('gi')
+try:
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst  # noqa: E402
+except (ValueError, ImportError):
+    pytest.skip('needs GStreamer', allow_module_level=True)
+
+Gst.init(None)
+
+import h264_decoders  # noqa: E402
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(h264_decoders, 'get_cache_dir', lambda: str(tmp_path))
+    return tmp_path
+
+
+def test_benchmark_cached(cache_dir, monkeypatch):
+    runs = []
+    results = [{'decoder': 'fakesink', 'works': True, 'latency_p50': 0.001, 'cpu_per_frame': 0.001}]
+    monkeypatch.setattr(h264_decoders, 'benchmark_all', lambda width, height: runs.append(1) or results)
+    assert h264_decoders.get_ranking(320, 240, benchmark=False, fingerprint='a') is None
+    assert h264_decoders.get_ranking(320, 240, fingerprint='a') == results
+    assert h264_decoders.get_ranking(320, 240, benchmark=False, fingerprint='a') == results
+    assert len(runs) == 1
+    # different hardware or decoders
+    assert h264_decoders.get_ranking(320, 240, benchmark=False, fingerprint='b') is None
+
+
+def test_nothing_works_is_cached(cache_dir, monkeypatch):
+    runs = []
+    results = [{'decoder': 'broken', 'works': False, 'error': 'cannot start'}]
+    monkeypatch.setattr(h264_decoders, 'get_fingerprint', lambda: 'a')
+    monkeypatch.setattr(h264_decoders, 'benchmark_all', lambda width, height: runs.append(1) or results)
+    fallback = h264_decoders.fallback_decoder()
+    assert h264_decoders.select_decoder(320, 240, benchmark=False) is None  # not benchmarked yet
+    assert h264_decoders.select_decoder(320, 240) == fallback
+    # the next start does not benchmark again
+    assert h264_decoders.select_decoder(320, 240, benchmark=False) == fallback
+    assert h264_decoders.select_decoder(320, 240) == fallback
+    assert len(runs) == 1
+
+
+def test_no_encoder_is_cached(cache_dir, monkeypatch):
+    runs = []
+
+    def benchmark_all(width, height):
+        runs.append(1)
+        raise RuntimeError('no h264 encoder')
+
+    monkeypatch.setattr(h264_decoders, 'get_fingerprint', lambda: 'a')
+    monkeypatch.setattr(h264_decoders, 'benchmark_all', benchmark_all)
+    assert h264_decoders.get_ranking(320, 240) == []
+    assert h264_decoders.get_ranking(320, 240) == []
+    assert len(runs) == 1
@@ -0,0 +1,44 @@
+import socket
+import struct
+
+import pytest
+
+pytest.importorskip('gi')
+from gi.repository import GLib  # noqa: E402
+
+from rpividctrl_lib.messaging import SocketManager  # noqa: E402
+
+
+@pytest.fixture
+def connected_pair():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sock = socket.create_connection(listener.getsockname())
+        peer, addr = listener.accept()
+    yield sock, peer
+    peer.close()
+
+
+def test_destroyed_when_peer_resets_with_bytes_queued(connected_pair):
+    sock, peer = connected_pair
+    sock_manager = SocketManager(sock)
+    destroy_reasons = []
+    sock_manager.on_destroy = destroy_reasons.append
+    while not sock_manager.send_queue:  # the peer does not read, so this fills the socket buffers
+        sock_manager.sendall(bytes(1 << 20))
+
+    # only the out watch gets to see the reset, like when nothing arrives to read
+    GLib.source_remove(sock_manager.in_listener_id)
+    sock_manager.in_listener_id = None
+    peer.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    peer.close()
+
+    context = GLib.MainContext.default()
+    for i in range(100):
+        if destroy_reasons:
+            break
+        context.iteration(True)
+    assert len(destroy_reasons) == 1
+    assert sock_manager.sock is None
+    assert not context.pending()
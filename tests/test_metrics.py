@@ -0,0 +1,84 @@
+import time
+import socket
+
+import pytest
+
+pytest.importorskip('gi')
+from gi.repository import GLib  # noqa: E402
+
+import metrics  # noqa: E402
+
+
+def run_until(predicate, timeout=2):
+    context = GLib.MainContext.default()
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        if not context.iteration(False):
+            time.sleep(0.001)
+    return predicate()
+
+
+def is_closed_by_server(sock):
+    try:
+        return sock.recv(65536, socket.MSG_DONTWAIT) == b''
+    except BlockingIOError:
+        return False
+    except ConnectionResetError:
+        return True
+
+
+@pytest.fixture
+def server():
+    server = metrics.MetricsServer('127.0.0.1', 0, lambda: [metrics.gauge('rpividctrl_test', 'Test').add(1)],
+                                   request_timeout=200)
+    yield server
+    server.close()
+
+
+def connect(server):
+    return socket.create_connection(server.sock.getsockname())
+
+
+def test_scrape(server):
+    with connect(server) as sock:
+        sock.sendall(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = b''
+
+        def read_response():
+            nonlocal response
+            try:
+                data = sock.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return False
+            response += data
+            return not data
+
+        assert run_until(read_response)
+    assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert b'rpividctrl_test 1\n' in response
+    assert run_until(lambda: not server.connections)
+
+
+def test_idle_connection_times_out(server):
+    with connect(server) as sock:
+        assert run_until(lambda: len(server.connections) == 1)
+        assert run_until(lambda: is_closed_by_server(sock))
+    assert not server.connections
+
+
+def test_request_too_big(server):
+    with connect(server) as sock:
+        sock.sendall(b'GET /' + b'a' * metrics.MAX_REQUEST_LEN)
+        assert run_until(lambda: is_closed_by_server(sock), timeout=0.1)
+
+
+def test_connection_limit(server):
+    socks = []
+    for i in range(metrics.MAX_CONNECTIONS):  # one at a time, the listen backlog is short
+        socks.append(connect(server))
+        assert run_until(lambda: len(server.connections) == len(socks))
+    with connect(server) as sock:
+        assert run_until(lambda: is_closed_by_server(sock), timeout=0.1)
+    assert len(server.connections) == metrics.MAX_CONNECTIONS
+    for sock in socks:
+        sock.close()
@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip('cairo')
+gi = pytest.importorskip('gi')
+try:
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst  # noqa: E402,F401 overlay imports common, which needs it
+except (ValueError, ImportError):
+    pytest.skip('needs GStreamer', allow_module_level=True)
+
+from overlay import scan_module  # noqa: E402
+
+
+def scan(tmp_path, source):
+    path = tmp_path / 'mine_overlay.py'
+    path.write_text(source)
+    return scan_module(str(path), 'overlays.mine_overlay')
+
+
+def test_scan_module(tmp_path):
+    assert scan(tmp_path, '''
+from overlay import Overlay
+
+
+class Helper:
+    pass
+
+
+class MineOverlay(Overlay):
+    @staticmethod
+    def get_display_name() -> str:
+        return 'mine'
+''') == [['mine', 'MineOverlay']]
+
+
+def test_scan_module_needs_import(tmp_path):
+    # not a plain string
+    assert scan(tmp_path, '''
+from overlay import Overlay
+
+
+class MineOverlay(Overlay):
+    @staticmethod
+    def get_display_name() -> str:
+        return 'mine'.upper()
+''') is None
+    # derives from another overlay
+    assert scan(tmp_path, '''
+from overlays.test_lines_overlay import TestLinesOverlay
+
+
+class MineOverlay(TestLinesOverlay):
+    @staticmethod
+    def get_display_name() -> str:
+        return 'mine'
+''') is None
@@ -0,0 +1,41 @@
+from rpividctrl_lib.protocol import (MessageType, MessageReader, MessageBuilder, Detection, VISION_RESULT_STRUCT,
+                                     DETECTION_STRUCT, DETECTION_MAX)
+
+MAX_DETECTIONS = (min(0xffff, MessageReader.MAX_BYTES_AVAILABLE - 2) - 1 - VISION_RESULT_STRUCT.size) // DETECTION_STRUCT.size
+
+
+def make_detections(n):
+    # values that are sent exactly, so they come back equal
+    return [Detection(i % 256, i / DETECTION_MAX, 0x8000 / DETECTION_MAX, 1.0, 0.0, (i % 256) / 0xff)
+            for i in range(n)]
+
+
+def read_all(message_bytes):
+    message_reader = MessageReader()
+    message_reader.append(message_bytes)
+    message = message_reader.read_message()
+    assert message_reader.read_message() is None
+    return message
+
+
+def test_vision_result_round_trip():
+    detections = make_detections(3)
+    message = read_all(MessageBuilder.vision_result(1234, 0x1_0000_0005, detections))
+    assert message['message_type'] == MessageType.VISION_RESULT
+    vision_result = message['vision_result']
+    assert vision_result.frame_number == 1234
+    assert vision_result.rtp_timestamp == 5
+    assert vision_result.detections == detections
+
+
+def test_vision_result_round_trip_at_cap():
+    assert MAX_DETECTIONS == 4998
+    message_bytes = MessageBuilder.vision_result(1, 2, make_detections(MAX_DETECTIONS))
+    assert len(message_bytes) <= MessageReader.MAX_BYTES_AVAILABLE
+    assert read_all(message_bytes)['vision_result'].detections == make_detections(MAX_DETECTIONS)
+
+
+def test_vision_result_over_cap_is_truncated():
+    message_bytes = MessageBuilder.vision_result(1, 2, make_detections(6000))
+    assert len(message_bytes) <= MessageReader.MAX_BYTES_AVAILABLE
+    assert read_all(message_bytes)['vision_result'].detections == make_detections(MAX_DETECTIONS)
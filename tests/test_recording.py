@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+gi = pytest.importorskip('gi')
+try:
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib  # noqa: E402
+except (ValueError, ImportError):
+    pytest.skip('needs GStreamer', allow_module_level=True)
+
+Gst.init(None)
+for element_name in ('videotestsrc', 'x264enc', 'h264parse', 'splitmuxsink', 'matroskamux'):
+    if Gst.ElementFactory.find(element_name) is None:
+        pytest.skip(f'needs the {element_name} element', allow_module_level=True)
+
+from recording import Recorder  # noqa: E402
+
+NUM_FRAMES = 90
+
+
+def make_pipeline():
+    """videotestsrc -> x264enc -> tee -> fakesink, like the server's encoder -> record_tee -> rtp branch"""
+    return Gst.parse_launch(
+        f'videotestsrc is-live=true num-buffers={NUM_FRAMES} ! '
+        'capsfilter name=caps caps=video/x-raw,width=320,height=240,framerate=30/1 ! videoconvert ! '
+        'x264enc tune=zerolatency speed-preset=ultrafast key-int-max=10 ! h264parse ! '
+        'video/x-h264,stream-format=byte-stream,alignment=au ! tee name=tee allow-not-linked=true ! '
+        'queue ! fakesink name=live sync=false')
+
+
+def run(pipeline, recorder, during=None):
+    """Records the whole stream, calling during(pipeline) halfway. Returns (frames the live branch got, errors)"""
+    loop = GLib.MainLoop()
+    errors = []
+    live_frames = []
+    live_pad = pipeline.get_by_name('live').get_static_pad('sink')
+    live_pad.add_probe(Gst.PadProbeType.BUFFER, lambda pad, info: live_frames.append(1) or Gst.PadProbeReturn.OK)
+
+    bus = pipeline.get_bus()
+    bus.add_signal_watch()
+    bus.connect('message::error', lambda bus, message: errors.append(str(message.parse_error().gerror)) or loop.quit())
+    eos = []
+
+    def on_eos(bus, message):
+        eos.append(message)
+        if not recorder.stop() and not recorder.active:
+            loop.quit()
+
+    def on_stopped():
+        if eos:
+            loop.quit()
+
+    bus.connect('message::eos', on_eos)
+    recorder.on_stopped = on_stopped
+    if during is not None:
+        GLib.timeout_add(NUM_FRAMES // 2 * 1000 // 30, lambda: during(pipeline) or GLib.SOURCE_REMOVE)
+    timeout_id = GLib.timeout_add(20000, loop.quit)
+
+    recorder.start()
+    pipeline.set_state(Gst.State.PLAYING)
+    loop.run()
+    GLib.source_remove(timeout_id)
+    pipeline.set_state(Gst.State.NULL)
+    bus.remove_signal_watch()
+    return len(live_frames), errors
+
+
+def test_record(tmp_path):
+    pipeline = make_pipeline()
+    recorder = Recorder(pipeline, pipeline.get_by_name('tee'), str(tmp_path), 'test')
+    live_frames, errors = run(pipeline, recorder)
+    assert errors == []
+    assert live_frames == NUM_FRAMES
+    assert not recorder.active
+    files = os.listdir(tmp_path)
+    assert len(files) == 1 and files[0].endswith('_00000.mkv')
+    assert os.path.getsize(tmp_path / files[0]) > 0
+
+
+def test_resolution_change_while_recording(tmp_path):
+    def change_resolution(pipeline):
+        pipeline.get_by_name('caps').set_property(
+            'caps', Gst.Caps.from_string('video/x-raw,width=640,height=480,framerate=30/1'))
+
+    pipeline = make_pipeline()
+    recorder = Recorder(pipeline, pipeline.get_by_name('tee'), str(tmp_path), 'test')
+    live_frames, errors = run(pipeline, recorder, change_resolution)
+    # the live stream does not notice, and the recording goes on in a new file
+    assert errors == []
+    assert live_frames == NUM_FRAMES
+    assert not recorder.active
+    files = sorted(os.listdir(tmp_path))
+    assert len(files) == 2
+    assert '_part2_' in files[1]
+    assert all(os.path.getsize(tmp_path / file_name) > 0 for file_name in files)
+
+
+def test_write_error_does_not_stop_the_stream(tmp_path, monkeypatch):
+    monkeypatch.setattr('recording.time.strftime', lambda time_format: 'now')
+    # a directory where the first file should go, so the filesink cannot open it
+    os.mkdir(tmp_path / 'test_now_00000.mkv')
+    pipeline = make_pipeline()
+    recorder = Recorder(pipeline, pipeline.get_by_name('tee'), str(tmp_path), 'test')
+    live_frames, errors = run(pipeline, recorder)
+    assert errors == []
+    assert live_frames == NUM_FRAMES
+    assert not recorder.active
+
+
+def test_pipeline_restart_while_recording(tmp_path):
+    def restart(pipeline):
+        # what the client does when it rebuilds the decoder without live renegotiation
+        recorder.finish_file()
+        pipeline.set_state(Gst.State.NULL)
+        pipeline.set_state(Gst.State.PLAYING)
+
+    pipeline = make_pipeline()
+    recorder = Recorder(pipeline, pipeline.get_by_name('tee'), str(tmp_path), 'test')
+    live_frames, errors = run(pipeline, recorder, restart)
+    # the first file was finished before the timestamps started over, the recording goes on in a new one
+    assert errors == []
+    assert not recorder.active
+    files = sorted(os.listdir(tmp_path))
+    assert len(files) == 2
+    assert '_part2_' in files[1]
+    assert all(os.path.getsize(tmp_path / file_name) > 0 for file_name in files)
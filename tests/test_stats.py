@@ -0,0 +1,90 @@
+import random
+
+import numpy as np
+import pytest
+
+from stats import RollingStats
+
+
+def make_values(n, seed=1874):
+    rand = random.Random(seed)
+    return [rand.gauss(0.05, 0.005) for i in range(n)]
+
+
+def test_empty():
+    stats = RollingStats(10)
+    assert stats.mean() == 0.0
+    assert stats.min() == 0.0
+    assert stats.max() == 0.0
+    assert stats.percentiles((50, 95)) == [0.0, 0.0]
+    assert stats.jitter == 0.0
+
+
+def test_mean_before_wraparound():
+    values = make_values(7)
+    stats = RollingStats(10)
+    for value in values:
+        stats.add(value)
+    assert stats.count == 7
+    assert stats.mean() == pytest.approx(np.mean(values))
+
+
+@pytest.mark.parametrize('num_values', [10, 11, 25, 1003])
+def test_mean_after_wraparound(num_values):
+    values = make_values(num_values)
+    stats = RollingStats(10)
+    for value in values:
+        stats.add(value)
+    assert stats.count == 10
+    assert stats.mean() == pytest.approx(np.mean(values[-10:]))
+    assert stats.min() == min(values[-10:])
+    assert stats.max() == max(values[-10:])
+
+
+def test_mean_does_not_drift():
+    # large values going out and small ones coming in, the running sum has to be re-summed to stay exact
+    stats = RollingStats(10)
+    for value in [1e9] * 10 + make_values(95):
+        stats.add(value)
+    assert stats.mean() == pytest.approx(np.mean(stats.samples))
+
+
+def test_percentiles_match_numpy():
+    values = make_values(137)
+    stats = RollingStats(50)
+    for value in values:
+        stats.add(value)
+    percents = (0, 50, 95, 99, 100)
+    assert stats.percentiles(percents) == pytest.approx(np.percentile(values[-50:], percents).tolist())
+    assert stats.percentile(95) == pytest.approx(np.percentile(values[-50:], 95))
+    summary = stats.summary()
+    assert summary['p99'] == pytest.approx(np.percentile(values[-50:], 99))
+    assert summary['mean'] == pytest.approx(np.mean(values[-50:]))
+
+
+def test_clear():
+    stats = RollingStats(10)
+    for value in make_values(25):
+        stats.add(value)
+    stats.clear()
+    assert stats.count == 0
+    assert stats.mean() == 0.0
+    assert stats.jitter == 0.0
+    stats.add(2.0)
+    stats.add(4.0)
+    assert stats.mean() == 3.0
+    assert stats.min() == 2.0
+    assert stats.max() == 4.0
+    assert stats.jitter == pytest.approx(2.0 * RollingStats.JITTER_GAIN)
+
+
+@pytest.mark.parametrize('size', [5, 50])
+def test_jitter(size):
+    values = make_values(123)
+    stats = RollingStats(size)
+    for value in values:
+        stats.add(value)
+    jitter = 0.0
+    for last, value in zip(values, values[1:]):
+        jitter += (abs(value - last) - jitter) * RollingStats.JITTER_GAIN
+    assert stats.jitter == pytest.approx(jitter)
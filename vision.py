@@ -0,0 +1,133 @@
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstVideo
+import numpy as np
+import pkgutil
+import importlib
+import inspect
+import threading
+import logging
+import time
+import vision_plugins
+from stats import RollingStats
+
+logger = logging.getLogger('vision')
+
+
+class VisionPlugin:
+    def process(self, frame: np.ndarray, frame_number: int, pts: int):
+        """
+        Called on the vision thread for each frame the thread gets to
+
+        frame is a read-only (height, width, 3) BGR view of the camera's buffer. It is only valid until process
+        returns, copy anything that needs to be kept (frame.copy()).
+
+        frame_number counts frames from the camera, pts is the buffer's presentation timestamp in nanoseconds.
+        Returns a list of rpividctrl_lib.messaging.Detection, which are sent to the clients, or None"""
+        raise NotImplementedError
+
+    @staticmethod
+    def get_display_name() -> str:
+        raise NotImplementedError
+
+    @staticmethod
+    def list_plugins():
+        """Lists all vision plugins found in the vision_plugins directory"""
+        plugins = set()
+        for finder, name, ispkg in pkgutil.iter_modules(vision_plugins.__path__, vision_plugins.__name__ + '.'):
+            module = importlib.import_module(name)
+            for cls_name, cls in module.__dict__.items():
+                if inspect.isclass(cls) and issubclass(cls, VisionPlugin) and not cls == VisionPlugin:
+                    plugins.add(cls)
+
+        return plugins
+
+
+class VisionWorker:
+    """
+    Runs vision plugins on appsink samples on its own thread
+
+    The appsink hands samples over through a single slot. If the plugins are still busy when a new sample comes in,
+    the one waiting in the slot is dropped, so slow plugins never back up the appsink, the tee, or the h264 branch.
+    """
+
+    def __init__(self, plugins):
+        self.plugins = plugins
+        # called on the vision thread with frame_number, the frame's running time and a list of results, one per plugin
+        self.on_results = None
+
+        self.processing_stats = RollingStats()
+        self.frames_processed = 0
+        self.frames_dropped = 0
+
+        self.condition = threading.Condition()
+        self.pending_sample = None
+        self.running = True
+        self.video_info_caps = None
+        self.video_info = None
+
+        self.thread = threading.Thread(target=self.run, name='vision', daemon=True)
+        self.thread.start()
+
+    def submit(self, sample):
+        """Called from the streaming thread"""
+        with self.condition:
+            if self.pending_sample is not None:
+                self.frames_dropped += 1
+            self.pending_sample = sample
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.pending_sample = None
+            self.condition.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending_sample is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                sample = self.pending_sample
+                self.pending_sample = None
+            self.process_sample(sample)
+
+    def get_video_info(self, caps):
+        # get_caps() returns a new wrapper every time, so compare the caps, not the objects
+        if self.video_info_caps is None or not caps.is_equal(self.video_info_caps):
+            self.video_info = GstVideo.VideoInfo.new_from_caps(caps)
+            self.video_info_caps = caps
+        return self.video_info
+
+    def process_sample(self, sample):
+        start = time.perf_counter()
+        buffer = sample.get_buffer()
+        video_info = self.get_video_info(sample.get_caps())
+        # the camera may lay out rows differently from the default for the caps, in which case it says so in a meta
+        video_meta = GstVideo.buffer_get_video_meta(buffer)
+        if video_meta is not None:
+            offset, stride = video_meta.offset[0], video_meta.stride[0]
+        else:
+            offset, stride = video_info.offset[0], video_info.stride[0]
+
+        success, map_info = buffer.map(Gst.MapFlags.READ)
+        if not success:
+            logger.warning('could not map buffer')
+            return
+        try:
+            frame = np.ndarray((video_info.height, video_info.width, 3), dtype=np.uint8, buffer=map_info.data,
+                               offset=offset, strides=(stride, 3, 1))
+            results = [plugin.process(frame, buffer.offset, buffer.pts) for plugin in self.plugins]
+        finally:
+            buffer.unmap(map_info)
+
+        self.processing_stats.add(time.perf_counter() - start)
+        self.frames_processed += 1
+        if self.on_results is not None:
+            running_time = sample.get_segment().to_running_time(Gst.Format.TIME, buffer.pts)
+            self.on_results(buffer.offset, running_time, results)
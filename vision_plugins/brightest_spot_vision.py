@@ -0,0 +1,18 @@
+from vision import VisionPlugin
+from rpividctrl_lib.messaging import Detection
+import numpy as np
+
+
+class BrightestSpotVision(VisionPlugin):
+    """Finds the brightest spot in the frame, for example retroreflective tape lit by a green LED ring"""
+
+    STEP = 4  # only look at every 4th pixel in each direction
+
+    def process(self, frame: np.ndarray, frame_number: int, pts: int):
+        green = frame[::BrightestSpotVision.STEP, ::BrightestSpotVision.STEP, 1]
+        y, x = np.unravel_index(np.argmax(green), green.shape)
+        return [Detection(0, x / green.shape[1], y / green.shape[0], 0, 0, green[y, x] / 255)]
+
+    @staticmethod
+    def get_display_name() -> str:
+        return 'brightest spot'